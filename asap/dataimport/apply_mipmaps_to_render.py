@@ -8,6 +8,7 @@ from asap.module.render_module import StackTransitionModule
 from asap.dataimport.schemas import (
     AddMipMapsToStackParameters, AddMipMapsToStackOutput)
 from asap.utilities import uri_utils
+from asap.utilities.threads import worker_pool_kwargs
 
 
 if __name__ == "__main__" and __package__ is None:
@@ -80,7 +81,10 @@ class AddMipMapsToStack(StackTransitionModule):
             self.args['mipmap_prefix'], self.args['imgformat'],
             self.args['levels'])
 
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
+        with renderapi.client.WithPool(
+                self.args['pool_size'], **worker_pool_kwargs(
+                    self.args['pool_size'],
+                    self.args['threads_per_worker'])) as pool:
             allresolved = pool.map(mypartial, zvalues)
 
         tilespecs = [ts for ts_l in (
@@ -9,6 +9,7 @@ from asap.module.render_module import (
     StackInputModule, RenderModuleException)
 from asap.dataimport.schemas import (
     GenerateMipMapsParameters, GenerateMipMapsOutput)
+from asap.utilities.threads import worker_pool_kwargs
 
 if __name__ == "__main__" and __package__ is None:
     __package__ = "asap.dataimport.generate_mipmaps"
@@ -65,7 +66,7 @@ def get_filepath_from_tilespec(ts):
 
 def make_tilespecs_and_cmds(render, inputStack, output_prefix, zvalues, levels,
                             imgformat, convert_to_8bit, force_redo, pool_size,
-                            method):
+                            method, threads_per_worker=None):
     mipmap_args = []
 
     for z in zvalues:
@@ -81,7 +82,8 @@ def make_tilespecs_and_cmds(render, inputStack, output_prefix, zvalues, levels,
         convertTo8bit=convert_to_8bit, force_redo=force_redo,
         imgformat=imgformat)
 
-    with renderapi.client.WithPool(pool_size) as pool:
+    with renderapi.client.WithPool(pool_size, **worker_pool_kwargs(
+            pool_size, threads_per_worker)) as pool:
         results = pool.map(mypartial, mipmap_args)
 
     return mipmap_args
@@ -117,7 +119,8 @@ class GenerateMipMaps(StackInputModule):
                                               self.args['convert_to_8bit'],
                                               self.args['force_redo'],
                                               self.args['pool_size'],
-                                              self.args['method'])
+                                              self.args['method'],
+                                              self.args['threads_per_worker'])
 
         self.output({"levels": self.args["levels"],
                      "output_prefix": self.args["output_prefix"]})
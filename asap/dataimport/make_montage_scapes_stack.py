@@ -15,6 +15,7 @@ from asap.dataimport.schemas import (
     MakeMontageScapeSectionStackParameters, MakeMontageScapeSectionStackOutput)
 from asap.module.render_module import (
     StackOutputModule, RenderModuleException)
+from asap.utilities.threads import worker_pool_kwargs
 
 example = {
     "render": {
@@ -207,7 +208,9 @@ class MakeMontageScapeSectionStack(StackOutputModule):
             do_mp=False)
 
         with renderapi.client.WithPool(
-                self.args['pool_size_materialize']) as pool:
+                self.args['pool_size_materialize'], **worker_pool_kwargs(
+                    self.args['pool_size_materialize'],
+                    self.args['threads_per_worker'])) as pool:
             pool.map(mypartial, Z)
 
         # get all the output tilespec json files
@@ -8,7 +8,8 @@ from argschema.fields import (
     InputDir, InputFile, Str, Int, Boolean, Float, List)
 
 from asap.module.schemas import (
-    StackTransitionParameters, InputStackParameters, OutputStackParameters)
+    StackTransitionParameters, InputStackParameters, OutputStackParameters,
+    ProcessPoolParameters)
 import asap.utilities.schema_utils
 
 
@@ -17,7 +18,7 @@ class GenerateMipMapsOutput(DefaultSchema):
     output_prefix = Str(required=True)
 
 
-class GenerateMipMapsParameters(InputStackParameters):
+class GenerateMipMapsParameters(InputStackParameters, ProcessPoolParameters):
     output_dir = mm.fields.Str(
         required=False,
         description='directory to which the mipmaps will be stored')
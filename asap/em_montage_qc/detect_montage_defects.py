@@ -17,6 +17,7 @@ from asap.em_montage_qc.schemas import (
 from asap.module.render_module import (
     RenderModule, RenderModuleException)
 from asap.em_montage_qc.plots import plot_section_maps
+from asap.utilities.threads import worker_pool_kwargs
 
 from asap.em_montage_qc.distorted_montages import (
     get_scales_from_tilespecs,
@@ -132,13 +133,9 @@ def detect_seams(tilespecs, matches, residual_threshold=10,
     stats, allmatches = cr.compute_residuals(tilespecs, matches)
 
     # get mean positions of the point matches as numpy array
-    pt_match_positions = np.concatenate(
-        list(stats['pt_match_positions'].values()), 0
-    )
+    pt_match_positions = stats['pt_match_positions'].flat
     # get the tile residuals
-    tile_residuals = np.concatenate(
-        list(stats['tile_residuals'].values())
-    )
+    tile_residuals = stats['tile_residuals'].flat
 
     # threshold the points based on residuals
     new_pts = pt_match_positions[
@@ -359,13 +356,14 @@ def run_analysis(
 def detect_stitching_mistakes(
         render, prestitched_stack, poststitched_stack, match_collection,
         match_collection_owner, threshold_cutoff, residual_threshold, neighbor_distance,
-        min_cluster_size, zvalues, pool_size=20):
+        min_cluster_size, zvalues, pool_size=20, threads_per_worker=None):
     mypartial0 = partial(
         run_analysis, render, prestitched_stack, poststitched_stack,
         match_collection, match_collection_owner, residual_threshold,
         neighbor_distance, min_cluster_size, threshold_cutoff)
 
-    with renderapi.client.WithPool(pool_size) as pool:
+    with renderapi.client.WithPool(pool_size, **worker_pool_kwargs(
+            pool_size, threads_per_worker)) as pool:
         (disconnected_tiles, gap_tiles, seam_centroids,
          distorted_zs, post_tspecs, matches, stats) = zip(*pool.map(
             mypartial0, zvalues))
@@ -432,7 +430,8 @@ class DetectMontageDefectsModule(RenderModule):
             self.args['neighbors_distance'],
             self.args['min_cluster_size'],
             zvalues,
-            pool_size=self.args['pool_size'])
+            pool_size=self.args['pool_size'],
+            threads_per_worker=self.args['threads_per_worker'])
 
         # find the indices of sections having holes
         hole_indices = [i for i, dt in enumerate(disconnected_tiles)
@@ -461,7 +460,8 @@ class DetectMontageDefectsModule(RenderModule):
                 seam_centroids,
                 stats,
                 zvalues,
-                out_html_dir=self.args['out_html_dir'])
+                out_html_dir=self.args['out_html_dir'],
+                threads_per_worker=self.args['threads_per_worker'])
 
         self.output({'output_html': self.args['output_html'],
                      'qc_passed_sections': qc_passed_sections,
@@ -11,6 +11,7 @@ import renderapi
 from asap.module.render_module import (
     RenderModule, RenderModuleException)
 from asap.em_montage_qc.schemas import DetectDistortionParameters, DetectDistortionParametersOutput
+from asap.utilities.threads import worker_pool_kwargs
 
 example = {
     "render": {
@@ -149,7 +150,10 @@ class DetectDistortedMontagesModule(RenderModule):
         final_zs = list(set(zs).intersection(set(self.args['zValues'])))
 
         # get scale factor for each section
-        with concurrent.futures.ProcessPoolExecutor(max_workers=self.args['pool_size']) as e:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.args['pool_size'], **worker_pool_kwargs(
+                    self.args['pool_size'],
+                    self.args['threads_per_worker'])) as e:
             fut_to_z = {
                 e.submit(
                     do_get_z_scales_nopm,
@@ -16,6 +16,7 @@ from bokeh.models import (HoverTool, ColumnDataSource,
                           Tabs, TabPanel)
 
 from asap.residuals import compute_residuals as cr
+from asap.utilities.threads import worker_pool_kwargs
 
 try:
     # Python 2
@@ -322,7 +323,7 @@ def run_montage_qc_plots_legacy(render, stack, out_html_dir, args):
 def plot_section_maps(
         render, stack, post_tspecs, matches, disconnected_tiles,
         gap_tiles, seam_centroids, stats, zvalues,
-        out_html_dir=None, pool_size=5):
+        out_html_dir=None, pool_size=5, threads_per_worker=None):
     if out_html_dir is None:
         out_html_dir = tempfile.mkdtemp()
 
@@ -333,7 +334,8 @@ def plot_section_maps(
     args = zip(post_tspecs, matches, disconnected_tiles, gap_tiles,
                seam_centroids, stats, zvalues)
 
-    with renderapi.client.WithPool(pool_size) as pool:
+    with renderapi.client.WithPool(pool_size, **worker_pool_kwargs(
+            pool_size, threads_per_worker)) as pool:
         html_files = pool.map(mypartial, args)
 
     return html_files
@@ -26,6 +26,7 @@ from asap.module.render_module import (
     RenderModule, RenderModuleException)
 from asap.em_montage_qc.schemas import (
     RoughQCSchema, RoughQCOutputSchema)
+from asap.utilities.threads import worker_pool_kwargs
 
 
 example = {
@@ -409,7 +410,10 @@ class RoughAlignmentQC(RenderModule):
         # get the boundary polygon for each section
         mypartial1 = partial(
             get_poly, self.args['output_downsampled_stack'], self.render)
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
+        with renderapi.client.WithPool(
+                self.args['pool_size'], **worker_pool_kwargs(
+                    self.args['pool_size'],
+                    self.args['threads_per_worker'])) as pool:
             boundary_polygons = pool.map(mypartial1, zvalues)
 
         post_polys = {}
@@ -418,7 +422,10 @@ class RoughAlignmentQC(RenderModule):
 
         mypartial2 = partial(
             get_poly, self.args['input_downsampled_stack'], self.render)
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
+        with renderapi.client.WithPool(
+                self.args['pool_size'], **worker_pool_kwargs(
+                    self.args['pool_size'],
+                    self.args['threads_per_worker'])) as pool:
             pre_boundary_polygons = pool.map(mypartial2, zvalues)
 
         pre_polys = {}
@@ -148,7 +148,7 @@ class DetectMontageDefectsParametersOutput(argschema.schemas.DefaultSchema):
     )
 
 
-class RoughQCSchema(RenderParameters):
+class RoughQCSchema(RenderParameters, ProcessPoolParameters):
     input_downsampled_stack = Str(
         required=True,
         description="Pre rough aligned downsampled stack")
@@ -11,6 +11,7 @@ import tifffile
 from asap.module.render_module import StackTransitionModule
 from asap.module.render_module import RenderModuleException
 from asap.intensity_correction.schemas import MultIntensityCorrParams
+from asap.utilities.threads import worker_pool_kwargs
 
 if __name__ == "__main__" and __package__ is None:
     __package__ = "asap.intensity_correction.apply_muliplicative_correction"
@@ -195,7 +196,10 @@ class MultIntensityCorr(StackTransitionModule):
             self.args['clip_min'],
             self.args['clip_max'],
             corr_dict=corr_dict)
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
+        with renderapi.client.WithPool(
+                self.args['pool_size'], **worker_pool_kwargs(
+                    self.args['pool_size'],
+                    self.args['threads_per_worker'])) as pool:
             output_tilespecs = pool.map(mypartial, inp_tilespecs)
 
         # upload to render
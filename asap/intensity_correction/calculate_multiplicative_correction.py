@@ -12,6 +12,7 @@ from asap.intensity_correction.apply_multiplicative_correction import getImage
 from asap.intensity_correction.schemas import MakeMedianParams
 from asap.module.render_module import (
     RenderModule, RenderModuleException)
+from asap.utilities.threads import worker_pool_kwargs
 
 if __name__ == "__main__" and __package__ is None:
     __package__ = "asap.intensity_correction.calculate_multiplicative_correction"
@@ -56,13 +57,14 @@ def randomly_subsample_tilespecs(alltilespecs, numtiles):
 
 
 def make_median_image(alltilespecs, numtiles, outImage, pool_size,
-                      chan=None, gauss_size=10):
+                      chan=None, gauss_size=10, threads_per_worker=None):
     # read images and create stack
     N, M, img0 = getImage(alltilespecs[0], channel=chan)
     stack = np.zeros((N, M, numtiles), dtype=img0.dtype)
     mypartial = partial(getImageFromTilespecs, alltilespecs, channel=chan)
     indexes = range(0, numtiles)
-    with renderapi.client.WithPool(pool_size) as pool:
+    with renderapi.client.WithPool(pool_size, **worker_pool_kwargs(
+            pool_size, threads_per_worker)) as pool:
         images = pool.map(mypartial, indexes)
 
     # calculate median
@@ -141,7 +143,9 @@ class MakeMedian(RenderModule):
                               numtiles,
                               outImage,
                               self.args['pool_size'],
-                              chan=chan_name)
+                              chan=chan_name,
+                              threads_per_worker=self.args[
+                                  'threads_per_worker'])
             out_images.append(outImage)
 
         for ind, z in enumerate(range(
@@ -10,6 +10,7 @@ from asap.materialize.schemas import (RenderSectionAtScaleParameters,
                                       RenderSectionAtScaleOutput)
 from asap.module.render_module import (
     RenderModule, RenderModuleException)
+from asap.utilities.threads import worker_pool_kwargs
 
 
 example = {
@@ -95,9 +96,11 @@ class RenderSectionAtScale(RenderModule):
             cls, zvalues, input_stack=None, level=1, pool_size=1,
             image_directory=None, scale=None, imgformat=None, doFilter=None,
             fillWithNoise=None, filterListName=None,
-            render=None, do_mp=True, bounds=None, **kwargs):
+            render=None, do_mp=True, bounds=None, threads_per_worker=None,
+            **kwargs):
         # temporary hack for nested pooling woes
-        poolclass = (renderapi.client.WithPool if do_mp else WithThreadPool)
+        poolclass = (partial(renderapi.client.WithPool, **worker_pool_kwargs(
+            pool_size, threads_per_worker)) if do_mp else WithThreadPool)
 
         stack_has_mipmaps = check_stack_for_mipmaps(
             render, input_stack, zvalues)
@@ -8,7 +8,8 @@ from marshmallow import post_load
 
 from asap.module.schemas import (
     RenderParameters, SparkParameters, MaterializedBoxParameters,
-    ZRangeParameters, RenderParametersRenderWebServiceParameters)
+    ZRangeParameters, RenderParametersRenderWebServiceParameters,
+    ProcessPoolParameters)
 
 
 class Bounds(argschema.schemas.DefaultSchema):
@@ -34,7 +35,8 @@ class Bounds(argschema.schemas.DefaultSchema):
         description="maxY of bounds")
 
 
-class RenderSectionAtScaleParameters(RenderParameters):
+class RenderSectionAtScaleParameters(
+        RenderParameters, ProcessPoolParameters):
     input_stack = Str(
         required=True,
         description='Input stack to make the downsample version of')
@@ -21,6 +21,8 @@ from asap.dataimport.generate_EM_tilespecs_from_metafile \
         import GenerateEMTileSpecsModule
 from asap.pointmatch.create_tilepairs \
         import TilePairClientModule
+from asap.pointmatch.generate_tile_pairs \
+        import metafile_tile_pairs, render_parameters_url_template
 from asap.pointmatch.generate_point_matches_opencv \
         import GeneratePointMatchesOpenCV
 from asap.utilities import uri_utils
@@ -165,6 +167,21 @@ class MeshLensCorrection(RenderModule):
         ex['outfile'] = self.args['outfile']
         return ex
 
+    def write_metafile_tilepairs(self, metafile):
+        tilepairJsonFile = os.path.join(
+            self.args['output_dir'],
+            "tile_pairs_%s_z_%d_rowcol.json" % (
+                self.args['input_stack'], self.args['z_index']))
+        with open(tilepairJsonFile, 'w') as f:
+            json.dump({
+                "renderParametersUrlTemplate": render_parameters_url_template(
+                    self.render, self.args['input_stack']),
+                "neighborPairs": metafile_tile_pairs(
+                    metafile, self.args['z_index'],
+                    sectionId=self.args['sectionId'],
+                    excludeCornerNeighbors=False)}, f, indent=2)
+        return tilepairJsonFile
+
     def get_pm_args(self):
         args_for_pm = dict(self.args)
         args_for_pm['render'] = self.args['render']
@@ -217,15 +234,19 @@ class MeshLensCorrection(RenderModule):
 
         if self.args['rerun_pointmatch']:
             # generate tile pairs for this section in the input stack
-            tp_example = self.generate_tilepair_example()
-            tp_mod = TilePairClientModule(
-                    input_data=tp_example,
-                    args=['--output_json', out_file.name])
-            tp_mod.run()
-
-            with open(tp_mod.args['output_json'], 'r') as f:
-                js = json.load(f)
-            self.args['pairJson'] = js['tile_pair_file']
+            if self.args['useRowColPositions']:
+                self.args['pairJson'] = self.write_metafile_tilepairs(
+                    metafile)
+            else:
+                tp_example = self.generate_tilepair_example()
+                tp_mod = TilePairClientModule(
+                        input_data=tp_example,
+                        args=['--output_json', out_file.name])
+                tp_mod.run()
+
+                with open(tp_mod.args['output_json'], 'r') as f:
+                    js = json.load(f)
+                self.args['pairJson'] = js['tile_pair_file']
 
             self.logger.setLevel(self.args['log_level'])
             delete_matches_if_exist(
@@ -22,6 +22,9 @@ import em_stitch.montage.meta_to_collection
 import asap.em_montage_qc.plots
 import em_stitch.lens_correction.mesh_and_solve_transform
 import asap.pointmatch.generate_point_matches_opencv
+import asap.pointmatch.generate_tile_pairs
+import asap.pointmatch.tile_overlap
+import asap.utilities.threads
 
 
 # FIXME this should be in em-stitch
@@ -187,11 +190,30 @@ def solve_lc(rts, matches, transformId=None):
     return lc_tform
 
 
-def match_tiles_rts(rts, tpairs, concurrency=10):
+def match_tiles_rts(rts, tpairs, concurrency=10,
+                    guided=False, guided_search_radius=200.,
+                    threads_per_worker=None):
     sectionId_tId_to_ts = {(ts.layout.sectionId, ts.tileId): ts for ts in rts.tilespecs}
     matches_rp = []
-        
-    with concurrent.futures.ProcessPoolExecutor(max_workers=concurrency) as e:
+
+    def pair_tilespecs(tpair):
+        return [
+            sectionId_tId_to_ts[(tpair[k]["groupId"], tpair[k]["id"])]
+            for k in ("p", "q")]
+
+    def guided_kwargs(tpair):
+        if not guided:
+            return {}
+        return {
+            "pq_tform": asap.pointmatch.tile_overlap.predicted_pq_affine(
+                *pair_tilespecs(tpair), ref_tforms=rts.transforms),
+            "guided_search_radius": guided_search_radius
+        }
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=concurrency,
+            **asap.utilities.threads.worker_pool_kwargs(
+                concurrency, threads_per_worker)) as e:
         futs = [
             e.submit(
                 asap.pointmatch.generate_point_matches_opencv.process_matches,
@@ -225,7 +247,8 @@ def match_tiles_rts(rts, tpairs, concurrency=10):
                 FLANN_ntree=5,
                 ratio_of_dist=0.7,
                 CLAHE_grid=None,
-                CLAHE_clip=None)
+                CLAHE_clip=None,
+                **guided_kwargs(tpair))
             for tpair in tpairs
         ]
         for fut in concurrent.futures.as_completed(futs):
@@ -239,6 +262,22 @@ class CalculateLensCorrectionParams(argschema.ArgSchema):
     image_prefix = argschema.fields.Str(required=True)
     transformId = argschema.fields.Str(required=True)
     concurrency = argschema.fields.Int(required=False, default=10)
+    threads_per_worker = argschema.fields.Int(
+        required=False, default=None, allow_none=True,
+        description="threads opencv, OpenMP and BLAS may use in each "
+                    "matching process (default cpus / concurrency)")
+    useRowColPositions = argschema.fields.Bool(
+        required=False, default=False,
+        description="pair tiles by metadata raster position rather "
+                    "than by tile bounds")
+    guided_matching = argschema.fields.Bool(
+        required=False, default=False,
+        description="match each p keypoint only against q keypoints "
+                    "near its location predicted by the tile positions")
+    guided_search_radius = argschema.fields.Float(
+        required=False, default=200.,
+        description="full resolution search radius around the predicted "
+                    "location of a p keypoint in guided matching")
 
 
 class CalculateLensCorrectionOutputSchema(argschema.schemas.DefaultSchema):
@@ -252,14 +291,23 @@ class CalculateLensCorrectionModule(argschema.ArgSchemaParser):
     @staticmethod
     def compute_lc_from_metadata_uri(
             md_uri, image_prefix, sectionId=None,
-            transformId=None, match_concurrency=10):
+            transformId=None, match_concurrency=10,
+            useRowColPositions=False, threads_per_worker=None,
+            guided=False, guided_search_radius=200.):
         md = json.loads(uri_handler.uri_functions.uri_readbytes(md_uri))
         rts = resolvedtiles_from_temca_md(
             md, image_prefix, 0, sectionId=sectionId)
         apply_resolvedtiles_bboxes(rts)
-        tpairs = pair_tiles_rts(rts)
-
-        matches = match_tiles_rts(rts, tpairs)
+        if useRowColPositions:
+            tpairs = asap.pointmatch.generate_tile_pairs.rowcol_tile_pairs(
+                rts.tilespecs)
+        else:
+            tpairs = pair_tiles_rts(rts)
+
+        matches = match_tiles_rts(
+            rts, tpairs, concurrency=match_concurrency,
+            threads_per_worker=threads_per_worker, guided=guided,
+            guided_search_radius=guided_search_radius)
         lc_tform = solve_lc(rts, matches, transformId=transformId)
         return lc_tform
 
@@ -269,7 +317,11 @@ class CalculateLensCorrectionModule(argschema.ArgSchemaParser):
             self.args["image_prefix"],
             sectionId=self.args["transformId"],
             transformId=self.args["transformId"],
-            match_concurrency=self.args["concurrency"]
+            match_concurrency=self.args["concurrency"],
+            useRowColPositions=self.args["useRowColPositions"],
+            threads_per_worker=self.args["threads_per_worker"],
+            guided=self.args["guided_matching"],
+            guided_search_radius=self.args["guided_search_radius"]
         )
         self.output({
             "lc_transform": json.loads(renderapi.utils.renderdumps(lc_tform))
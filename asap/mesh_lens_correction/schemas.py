@@ -67,6 +67,13 @@ class MeshLensCorrectionSchema(PointMatchOpenCVParameters):
         default=True,
         missing=True,
         description="Close input stack")
+    useRowColPositions = Bool(
+        required=False,
+        default=False,
+        missing=False,
+        description="pair tiles by the raster_pos row and column of "
+        "the metafile images instead of running the tile pair client "
+        "on the input stack")
     do_montage_QC = Bool(
         required=False,
         default=True,
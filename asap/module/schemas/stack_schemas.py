@@ -27,6 +27,13 @@ class OverridableParameterSchema(argschema.schemas.DefaultSchema):
 
 class ProcessPoolParameters(argschema.schemas.DefaultSchema):
     pool_size = argschema.fields.Int(required=False, default=1)
+    threads_per_worker = argschema.fields.Int(
+        required=False, default=None, missing=None, allow_none=True,
+        description=(
+            "threads opencv, OpenMP and BLAS may use in each pool "
+            "process.  By default the cpus are shared equally between "
+            "the pool_size processes, and 0 leaves the libraries' own "
+            "defaults"))
 
 
 class ZValueParameters(OverridableParameterSchema):
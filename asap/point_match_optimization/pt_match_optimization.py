@@ -14,6 +14,7 @@ from shapely.geometry import Polygon
 from asap.module.render_module import RenderModule
 from asap.point_match_optimization.schemas import (
     PtMatchOptimizationParameters, PtMatchOptimizationParametersOutput)
+from asap.utilities.threads import worker_pool_kwargs
 
 
 ex = {
@@ -317,7 +318,8 @@ def compute_point_matches(render, stack, tileID, output_dir, url_options,
     return return_struct
 
 
-def filter_tile_pairs(stack, neighborPairs, render, pool_size=5):
+def filter_tile_pairs(stack, neighborPairs, render, pool_size=5,
+                      threads_per_worker=None):
     # returns a list of filtered tilepairs in the neighborPairs format
     do_overlap = []
     t0 = time.time()
@@ -330,7 +332,8 @@ def filter_tile_pairs(stack, neighborPairs, render, pool_size=5):
     t1 = time.time()
     print(t1-t0)
     mypartial = partial(polys_overlap)
-    with renderapi.client.WithPool(pool_size) as pool:
+    with renderapi.client.WithPool(pool_size, **worker_pool_kwargs(
+            pool_size, threads_per_worker)) as pool:
         do_overlap = pool.map(mypartial, zip(ts1, ts2))
 
     filtered_tilepairs = [
@@ -355,7 +358,8 @@ class PtMatchOptimization(RenderModule):
             # this takes a lot of time
             tilepairs = filter_tile_pairs(
                 self.args['stack'], tilepairf['neighborPairs'],
-                self.render, self.args['pool_size'])
+                self.render, self.args['pool_size'],
+                self.args['threads_per_worker'])
 
         # get no_tilepairs_to_test # of random integers
         tp_indices = np.random.choice(range(
@@ -412,7 +416,10 @@ class PtMatchOptimization(RenderModule):
                             self.args['url_options'],
                             keys)
 
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
+        with renderapi.client.WithPool(
+                self.args['pool_size'], **worker_pool_kwargs(
+                    self.args['pool_size'],
+                    self.args['threads_per_worker'])) as pool:
             return_struct = pool.map(mypartial, options)
 
         m = render_from_template(
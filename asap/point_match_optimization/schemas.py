@@ -4,6 +4,7 @@ from marshmallow import post_load
 from marshmallow import fields
 
 from asap.module.render_module import RenderParameters
+from asap.module.schemas import ProcessPoolParameters
 
 
 class url_options(DefaultSchema):
@@ -139,7 +140,7 @@ class SIFT_options(DefaultSchema):
         description='Render canvases at this scale')
 
 
-class PtMatchOptimizationParameters(RenderParameters):
+class PtMatchOptimizationParameters(RenderParameters, ProcessPoolParameters):
     stack = Str(
         required=True,
         description=(
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+compare feature detectors for point matching on a sample of the tile
+pairs of a pairJson, reporting the time per pair, match yield and match
+residuals of each detector relative to a reference detector
+"""
+import time
+
+import numpy as np
+import renderapi
+
+from asap.pointmatch.generate_point_matches_opencv import (
+    GeneratePointMatchesOpenCV, affine_residuals, load_pairjson,
+    load_resolvedtiles, match_pair, parse_tile_groupids, parse_tileids,
+    read_pair)
+from asap.pointmatch.schemas import (
+    PointMatchBenchmarkParameters, PointMatchBenchmarkOutputSchema)
+from asap.pointmatch.tile_overlap import fit_affine
+
+if __name__ == "__main__" and __package__ is None:
+    __package__ = "asap.pointmatch.benchmark_point_matches"
+
+
+example = {
+    "ndiv": 8,
+    "matchMax": 1000,
+    "downsample_scale": 0.3,
+    "SIFT_nfeature": 50001,
+    "SIFT_noctave": 8,
+    "SIFT_sigma": 2.5,
+    "ORB_nfeature": 50000,
+    "benchmark_detectors": ["SIFT", "ORB", "AKAZE"],
+    "benchmark_pairs": 20,
+    "pairJson": "/allen/programs/celltypes/production/wijem/workflow_data/production/reference_2018_06_21_21_44_56_00_00/jobs/job_27418/tasks/task_25846/tile_pairs_em_2d_raw_lc_stack_z_2908_to_2908_dist_0.json",
+    "input_stack": "em_2d_raw_lc_stack",
+    "render": {
+        "owner": "TEM",
+        "project": "em_2d_montage_staging",
+        "host": "em-131db",
+        "port": 8080,
+        "client_scripts": "/allen/aibs/pipeline/image_processing/volume_assembly/render-jars/production/scripts"
+    }
+}
+
+MIN_AFFINE_MATCHES = 3
+
+
+def pm_locs(pm):
+    """Nx2 p and q match locations of a point match dictionary"""
+    return (np.array(pm['matches']['p'], dtype=float).reshape(2, -1).T,
+            np.array(pm['matches']['q'], dtype=float).reshape(2, -1).T)
+
+
+def _median(values):
+    values = np.concatenate(values) if values else np.empty(0)
+    return float(np.median(values)) if values.size else None
+
+
+def time_detector(rargs, detector):
+    """match_pair results for read_pair outputs rargs using detector,
+    with the total time taken
+    """
+    results = []
+    start = time.perf_counter()
+    for impaths, ids, gids, args, pair_kwargs, inputs in rargs:
+        results.append(match_pair([
+            impaths, ids, gids, dict(args, detector=detector),
+            pair_kwargs, inputs]))
+    return results, time.perf_counter() - start
+
+
+def benchmark_detectors(rargs, detectors):
+    """benchmark detectors on the same read tile pairs
+
+    Parameters
+    ----------
+    rargs : list
+        read_pair outputs of the tile pairs, read without a feature cache
+    detectors : list of str
+        detectors to benchmark, the first being the reference
+
+    Returns
+    -------
+    list of dict
+        DetectorBenchmark results in the order of detectors
+    """
+    runs = [(d,) + time_detector(rargs, d) for d in detectors]
+
+    # the reference detector's mapping from p to q for each pair
+    reference_affines = []
+    for r in runs[0][1]:
+        p, q = pm_locs(r[5])
+        reference_affines.append(
+            fit_affine(p, q) if p.shape[0] >= MIN_AFFINE_MATCHES else None)
+    reference_seconds = runs[0][2]
+    reference_matches = np.mean([r[3] for r in runs[0][1]])
+
+    summaries = []
+    for detector, results, seconds in runs:
+        residuals = []
+        reference_residuals = []
+        for r, A in zip(results, reference_affines):
+            p, q = pm_locs(r[5])
+            if p.shape[0] >= MIN_AFFINE_MATCHES:
+                residuals.append(affine_residuals(p, q))
+            if A is not None and p.shape[0]:
+                reference_residuals.append(np.linalg.norm(
+                    p.dot(A[:2, :2].T) + A[:2, 2] - q, axis=1))
+        matches = np.mean([r[3] for r in results])
+        summaries.append({
+            "detector": detector,
+            "pairs": len(results),
+            "seconds_per_pair": seconds / max(len(results), 1),
+            "features_per_tile": float(np.mean(
+                [r[1:3] for r in results])),
+            "matches_per_pair": float(matches),
+            "median_residual": _median(residuals),
+            "median_reference_residual": _median(reference_residuals),
+            "relative_speed": reference_seconds / seconds,
+            "relative_yield": (float(matches / reference_matches)
+                               if reference_matches else None)
+        })
+    return summaries
+
+
+class BenchmarkPointMatchDetectors(GeneratePointMatchesOpenCV):
+    default_schema = PointMatchBenchmarkParameters
+    default_output_schema = PointMatchBenchmarkOutputSchema
+
+    def sample_pairs(self, pairs):
+        rng = np.random.RandomState(self.args['benchmark_seed'])
+        n = min(self.args['benchmark_pairs'], len(pairs))
+        return [pairs[i] for i in np.sort(
+            rng.choice(len(pairs), n, replace=False))]
+
+    def run(self):
+        render = renderapi.connect(**self.args['render'])
+        tpjson = load_pairjson(self.args['pairJson'], logger=self.logger)
+        tpjson['neighborPairs'] = self.sample_pairs(tpjson['neighborPairs'])
+
+        unique_ids, tile_index = parse_tileids(tpjson, logger=self.logger)
+        tilespecs, ref_tforms = load_resolvedtiles(
+            render,
+            self.args['input_stack'],
+            unique_ids,
+            parse_tile_groupids(tpjson),
+            concurrency=self.args['tilespec_concurrency'],
+            logger=self.logger)
+
+        # images are read once and features computed by every detector
+        rargs = [read_pair(fargs) for fargs in self.pair_fargs(
+            tilespecs, tile_index, pairs=tpjson['neighborPairs'],
+            ref_tforms=ref_tforms,
+            args=dict(self.args, feature_cache_dir=None))]
+
+        summaries = benchmark_detectors(
+            rargs, self.args['benchmark_detectors'])
+        for s in summaries:
+            self.logger.info(
+                "%s: %.3fs/pair (%.2fx), %.0f matches/pair (%sx), "
+                "median residual %s px" % (
+                    s['detector'], s['seconds_per_pair'],
+                    s['relative_speed'], s['matches_per_pair'],
+                    s['relative_yield'], s['median_reference_residual']))
+
+        self.output({
+            "reference_detector": self.args['benchmark_detectors'][0],
+            "detectors": summaries})
+
+
+if __name__ == "__main__":
+    mod = BenchmarkPointMatchDetectors()
+    mod.run()
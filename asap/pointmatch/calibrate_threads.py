@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+recommend how to split the cpus of a node between point matching worker
+processes and the threads each may use, by timing synthetic tile pairs
+(see synthetic_benchmark) matched with each split
+"""
+import multiprocessing
+import shutil
+import tempfile
+import time
+
+from argschema import ArgSchemaParser
+import numpy as np
+import renderapi
+
+from asap.pointmatch.generate_point_matches_opencv import (
+    find_matches_kwargs, process_matches)
+from asap.pointmatch.schemas import (
+    ThreadCalibrationOutputSchema, ThreadCalibrationParameters)
+from asap.pointmatch.synthetic_benchmark import (
+    matcher_defaults, synthetic_tile_pairs, write_pair_images)
+from asap.utilities.threads import worker_pool_kwargs
+
+if __name__ == "__main__" and __package__ is None:
+    __package__ = "asap.pointmatch.calibrate_threads"
+
+
+example = {
+    "pairs_per_cpu": 2,
+    "tile_shape": [1000, 1000],
+    "matching_parameters": {
+        "downsample_scale": 0.3,
+        "SIFT_nfeature": 20000
+    },
+    "output_json": "thread_calibration.json"
+}
+
+
+def calibration_splits(cpus, worker_counts=None):
+    """(workers, threads_per_worker) splits of cpus to time, by default
+    for powers of two workers up to cpus, and cpus workers
+    """
+    if not worker_counts:
+        worker_counts = {2 ** i for i in range(int(np.log2(cpus)) + 1)}
+        worker_counts.add(cpus)
+    return [(w, max(cpus // w, 1)) for w in sorted(set(worker_counts))
+            if 0 < w <= cpus]
+
+
+def _match_uris(fargs):
+    (puri, quri), kwargs = fargs
+    return process_matches('p', 'p', puri, 'q', 'q', quri, **kwargs)[1]
+
+
+def time_split(uris, kwargs, workers, threads_per_worker, npairs):
+    """seconds taken to match npairs of the tile pair uris in a pool of
+    workers processes each limited to threads_per_worker threads
+    """
+    fargs = [(uris[i % len(uris)], kwargs) for i in range(npairs)]
+    start = time.perf_counter()
+    with renderapi.client.WithPool(workers, **worker_pool_kwargs(
+            workers, threads_per_worker)) as pool:
+        pool.map(_match_uris, fargs)
+    return time.perf_counter() - start
+
+
+class CalibrateThreads(ArgSchemaParser):
+    default_schema = ThreadCalibrationParameters
+    default_output_schema = ThreadCalibrationOutputSchema
+
+    def run(self):
+        cpus = self.args['cpus'] or multiprocessing.cpu_count()
+        npairs = self.args['pairs_per_cpu'] * cpus
+        kwargs = find_matches_kwargs(
+            dict(matcher_defaults(), **self.args['matching_parameters']),
+            {})
+
+        pairs = synthetic_tile_pairs(
+            self.args['distinct_pairs'], tuple(self.args['tile_shape']),
+            seed=self.args['seed'])
+        workdir = tempfile.mkdtemp()
+        try:
+            uris = write_pair_images(pairs, workdir)
+            trials = []
+            for workers, threads in calibration_splits(
+                    cpus, self.args['worker_counts']):
+                seconds = time_split(uris, kwargs, workers, threads, npairs)
+                trials.append({
+                    "workers": workers,
+                    "threads_per_worker": threads,
+                    "seconds": seconds,
+                    "pairs_per_second": npairs / seconds})
+                self.logger.info(
+                    "%d workers x %d threads: %.2f pairs/s" % (
+                        workers, threads, npairs / seconds))
+        finally:
+            shutil.rmtree(workdir)
+
+        best = max(trials, key=lambda t: t['pairs_per_second'])
+        self.output({
+            "cpus": cpus,
+            "trials": trials,
+            "recommended_workers": best['workers'],
+            "recommended_threads_per_worker": best['threads_per_worker']})
+
+
+if __name__ == "__main__":
+    mod = CalibrateThreads()
+    mod.run()
@@ -0,0 +1,78 @@
+"""
+on-disk store of per-tile keypoints and descriptors so that a tile
+participating in several tile pairs only has its features computed once
+"""
+import collections
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+# keypoint locations (x, y) in the downsampled image, descriptors,
+#   shape of the region features were extracted from and its (x, y) origin
+TileFeatures = collections.namedtuple(
+    "TileFeatures", ["loc", "des", "shape", "origin"])
+
+# preprocessed image (or region of it) awaiting feature extraction, its
+#   (x, y) origin and the FeatureCache key its features will be stored at
+TileImage = collections.namedtuple(
+    "TileImage", ["im", "origin", "cache_key"])
+
+
+class FeatureCache(object):
+    """directory of uncompressed .npz files holding the TileFeatures
+    of a tile.
+
+    Files are keyed by a hash of everything that changes the features
+    (tile, image, scale, equalization and detector parameters) and are
+    written atomically, so concurrent workers can share one directory.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(tileId, image_uri, downsample_scale,
+                 CLAHE_grid=None, CLAHE_clip=None,
+                 sift_kwargs=None, **kwargs):
+        keyd = {
+            "tileId": tileId,
+            "image_uri": list(image_uri),
+            "downsample_scale": downsample_scale,
+            "CLAHE_grid": CLAHE_grid,
+            "CLAHE_clip": CLAHE_clip,
+            "sift_kwargs": sift_kwargs or {},
+            **{k: v for k, v in kwargs.items() if v is not None}}
+        return hashlib.sha1(
+            json.dumps(keyd, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, "{}.npz".format(key))
+
+    def get(self, key):
+        try:
+            with np.load(self.path(key)) as npz:
+                return TileFeatures(
+                    npz["loc"].astype(np.float64), npz["des"],
+                    tuple(npz["shape"]), tuple(npz["origin"]))
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+    def put(self, key, features):
+        loc, des, shape, origin = features
+        fd, tmpfn = tempfile.mkstemp(
+            dir=self.cache_dir, suffix=".npz.tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f, loc=np.asarray(loc, dtype=np.float32).reshape(-1, 2),
+                    des=des, shape=np.asarray(shape, dtype=np.int64),
+                    origin=np.asarray(origin, dtype=np.int64))
+            os.replace(tmpfn, self.path(key))
+        except Exception:
+            if os.path.exists(tmpfn):
+                os.remove(tmpfn)
+            raise
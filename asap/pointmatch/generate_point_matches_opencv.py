@@ -1,21 +1,36 @@
 #!/usr/bin/env python
 
+import concurrent.futures
 import json
 import logging
 import multiprocessing
+import os
 
 from argschema import ArgSchemaParser
 import cv2
 import numpy as np
 import pathlib2 as pathlib
 import renderapi
+from scipy.spatial import cKDTree
 
 import imageio
 
+from asap.pointmatch.feature_cache import (
+    FeatureCache, TileFeatures, TileImage)
+from asap.pointmatch.match_sinks import (
+    CompletionJournal, PairTierLog, iter_matches_jsonl, make_match_sink,
+    match_pair_key, pair_key)
 from asap.pointmatch.schemas import (
     PointMatchOpenCVParameters,
     PointMatchClientOutputSchema)
+from asap.pointmatch.pipeline import StagedPipeline
+from asap.pointmatch.robust_fit import robust_fit
+from asap.pointmatch.scheduling import (
+    LRUCache, partition_pairs, tile_centers)
+from asap.pointmatch.tile_overlap import (
+    fit_affine, overlap_rois, predicted_pq_affine)
 from asap.utilities import uri_utils
+from asap.utilities.threads import worker_pool_kwargs
 
 
 example = {
@@ -48,48 +63,13 @@ example = {
 def ransac_chunk(fargs):
     [k1xy, k2xy, des1, des2, k1ind, args] = fargs
 
-    FLANN_INDEX_KDTREE = 1
-    index_params = dict(
-            algorithm=FLANN_INDEX_KDTREE,
-            trees=args['FLANN_ntree'])
-    search_params = dict(checks=args['FLANN_ncheck'])
-    flann = cv2.FlannBasedMatcher(index_params, search_params)
-    MIN_MATCH_COUNT = 10
-
-    matches = flann.knnMatch(des1[k1ind, :], des2, k=2)
-
-    # store all the good matches as per Lowe's ratio test.
-    good = []
-    k1 = []
-    k2 = []
-    for m, n in matches:
-        if m.distance < args['ratio_of_dist']*n.distance:
-            good.append(m)
-    if len(good) > MIN_MATCH_COUNT:
-        src_pts = np.float32(
-                [k1xy[k1ind, :][m.queryIdx] for m in good]).reshape(-1, 1, 2)
-        dst_pts = np.float32(
-                [k2xy[m.trainIdx] for m in good]).reshape(-1, 1, 2)
-        M, mask = cv2.findHomography(
-                src_pts,
-                dst_pts,
-                cv2.RANSAC,
-                args['RANSAC_outlier'])
-        matchesMask = mask.ravel().tolist()
-
-        good = np.array(good)[np.array(matchesMask).astype('bool')]
-        imgIdx = np.array([g.imgIdx for g in good])
-        tIdx = np.array([g.trainIdx for g in good])
-        qIdx = np.array([g.queryIdx for g in good])
-        for i in range(len(tIdx)):
-            if imgIdx[i] == 1:
-                k1.append(k1xy[k1ind, :][tIdx[i]])
-                k2.append(k2xy[qIdx[i]])
-            else:
-                k1.append(k1xy[k1ind, :][qIdx[i]])
-                k2.append(k2xy[tIdx[i]])
-
-    return k1, k2
+    k1, k2 = match_and_ransac(
+        k1xy[k1ind, :], des1[k1ind, :], k2xy, des2,
+        FLANN_ntree=args['FLANN_ntree'],
+        FLANN_ncheck=args['FLANN_ncheck'],
+        ratio_of_dist=args['ratio_of_dist'],
+        RANSAC_outlier=args['RANSAC_outlier'])
+    return list(k1), list(k2)
 
 
 # FIXME work w/ tile min/max in layout
@@ -150,6 +130,156 @@ def read_downsample_equalize_mask(
 
 
 FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+
+
+class FlannIndex(object):
+    """FLANN index over the q descriptors returning plain index and
+    distance arrays, so it can be queried by many p chunks without
+    being rebuilt or creating per-match DMatch objects
+    """
+    def __init__(self, des_q, FLANN_ntree=5, FLANN_ncheck=50,
+                 FLANN_index=FLANN_INDEX_KDTREE, **kwargs):
+        self.num_q = des_q.shape[0]
+        self.index = cv2.flann_Index(
+            np.ascontiguousarray(des_q, dtype=np.float32),
+            dict(algorithm=FLANN_index, trees=FLANN_ntree))
+        self.search_params = dict(checks=FLANN_ncheck)
+
+    def knn_search(self, des_p, k=2, **kwargs):
+        if des_p.shape[0] == 0 or self.num_q < k:
+            return (np.empty((des_p.shape[0], k), dtype=np.int32),
+                    np.full((des_p.shape[0], k), np.inf, dtype=np.float32))
+        idx, dist = self.index.knnSearch(
+            np.ascontiguousarray(des_p, dtype=np.float32), k,
+            params=self.search_params)
+        # L2 index reports squared distances
+        return idx, np.sqrt(dist)
+
+
+class BinaryIndex(object):
+    """Hamming distance search over binary (uint8) q descriptors using
+    a FLANN LSH index ("LSH") or exact brute force ("BF"), returning the
+    same index and distance arrays as FlannIndex
+    """
+    def __init__(self, des_q, binary_matcher="LSH", FLANN_ncheck=50,
+                 LSH_table_number=6, LSH_key_size=12,
+                 LSH_multi_probe_level=1, **kwargs):
+        self.des_q = np.ascontiguousarray(des_q, dtype=np.uint8)
+        self.num_q = self.des_q.shape[0]
+        self.index = None
+        if binary_matcher == "LSH" and self.num_q:
+            self.index = cv2.flann_Index(self.des_q, dict(
+                algorithm=FLANN_INDEX_LSH, table_number=LSH_table_number,
+                key_size=LSH_key_size,
+                multi_probe_level=LSH_multi_probe_level))
+        self.search_params = dict(checks=FLANN_ncheck)
+
+    def knn_search(self, des_p, k=2, **kwargs):
+        if des_p.shape[0] == 0 or self.num_q < k:
+            return (np.empty((des_p.shape[0], k), dtype=np.int32),
+                    np.full((des_p.shape[0], k), np.inf, dtype=np.float32))
+        des_p = np.ascontiguousarray(des_p, dtype=np.uint8)
+        if self.index is not None:
+            idx, dist = self.index.knnSearch(
+                des_p, k, params=self.search_params)
+        else:
+            dist, idx = cv2.batchDistance(
+                des_p, self.des_q, -1, normType=cv2.NORM_HAMMING, K=k)
+        # LSH may find fewer than k neighbors, which fail the ratio test
+        dist = dist.astype(np.float32)
+        dist[(idx < 0).any(axis=1)] = np.inf
+        return np.maximum(idx, 0), dist
+
+
+def descriptor_distance(des_a, des_b):
+    """L2 distance of float descriptors or Hamming distance of binary
+    (uint8) descriptors, broadcasting over leading axes
+    """
+    if des_a.dtype == np.uint8:
+        return np.unpackbits(
+            np.bitwise_xor(des_a, des_b), axis=-1).sum(
+                axis=-1, dtype=np.float32)
+    return np.linalg.norm(des_a - des_b, axis=-1)
+
+
+class GuidedIndex(object):
+    """descriptor search restricted to q keypoints near the location
+    predicted for each p keypoint by a 3x3 affine pq_tform, returning
+    the same index and distance arrays as FlannIndex
+    """
+    def __init__(self, loc_q, des_q, pq_tform, search_radius=60.,
+                 max_candidates=32, chunksize=4096, **kwargs):
+        self.num_q = des_q.shape[0]
+        self.tree = cKDTree(loc_q) if self.num_q else None
+        # pad with a row for cKDTree's missing neighbor index num_q
+        dtype = np.uint8 if des_q.dtype == np.uint8 else np.float32
+        self.des_q = np.vstack([
+            np.asarray(des_q, dtype=dtype),
+            np.zeros((1, des_q.shape[1]), dtype=dtype)])
+        self.pq_tform = np.asarray(pq_tform)
+        self.search_radius = search_radius
+        self.max_candidates = max_candidates
+        self.chunksize = chunksize
+
+    def knn_search(self, des_p, k=2, loc_p=None, **kwargs):
+        idx = np.zeros((des_p.shape[0], k), dtype=np.int32)
+        dist = np.full((des_p.shape[0], k), np.inf, dtype=np.float32)
+        if des_p.shape[0] == 0 or self.tree is None:
+            return idx, dist
+
+        pred = loc_p.dot(self.pq_tform[:2, :2].T) + self.pq_tform[:2, 2]
+        _, cand = self.tree.query(
+            pred, k=max(self.max_candidates, k),
+            distance_upper_bound=self.search_radius)
+
+        des_p = np.asarray(des_p, dtype=self.des_q.dtype)
+        for s in range(0, des_p.shape[0], self.chunksize):
+            c = cand[s:s + self.chunksize]
+            d = descriptor_distance(
+                self.des_q[c], des_p[s:s + self.chunksize, None, :])
+            d[c == self.num_q] = np.inf
+            order = np.argsort(d, axis=1)[:, :k]
+            idx[s:s + self.chunksize] = np.take_along_axis(c, order, 1)
+            dist[s:s + self.chunksize] = np.take_along_axis(d, order, 1)
+        return idx, dist
+
+
+def make_flann_matcher(
+        des_q, loc_q=None, pq_tform=None,
+        guided_search_radius=60., guided_max_candidates=32, **kwargs):
+    if pq_tform is not None:
+        return GuidedIndex(
+            loc_q, des_q, pq_tform, search_radius=guided_search_radius,
+            max_candidates=guided_max_candidates)
+    if des_q.dtype == np.uint8:
+        return BinaryIndex(des_q, **kwargs)
+    return FlannIndex(des_q, **kwargs)
+
+
+def ratio_test(idx, dist, ratio_of_dist):
+    """indices into p and q of the knn matches passing Lowe's ratio test.
+    A p keypoint without a second neighbor (infinite distance, as when a
+    guided search finds a single candidate) cannot be shown unambiguous
+    and is rejected.
+    """
+    good = np.isfinite(dist[:, 1]) & (dist[:, 0] < ratio_of_dist * dist[:, 1])
+    return np.flatnonzero(good), idx[good, 0]
+
+
+def ransac_inliers(src, dst, RANSAC_outlier=5.0, min_match_count=10,
+                   RANSAC_model="HOMOGRAPHY", RANSAC_method="RANSAC",
+                   RANSAC_max_iter=2000, RANSAC_confidence=0.995):
+    """boolean mask of the matches consistent with a robust fit of
+    RANSAC_model (see asap.pointmatch.robust_fit)
+    """
+    if src.shape[0] <= min_match_count:
+        return np.zeros(src.shape[0], dtype=bool)
+    M, mask = robust_fit(
+        src, dst, model=RANSAC_model, method=RANSAC_method,
+        threshold=RANSAC_outlier, max_iter=RANSAC_max_iter,
+        confidence=RANSAC_confidence)
+    return mask
 
 
 # TODO take this from existing ransac_chunk
@@ -157,67 +287,55 @@ def match_and_ransac(
         loc_p, des_p, loc_q, des_q,
         FLANN_ntree=5, ratio_of_dist=0.7,
         FLANN_ncheck=50, RANSAC_outlier=5.0,
-        min_match_count=10, FLANN_index=FLANN_INDEX_KDTREE, **kwargs):
-    
-    index_params = dict(
-        algorithm=FLANN_INDEX_KDTREE,
-        trees=FLANN_ntree)
-    search_params = dict(checks=FLANN_ncheck)
-    flann = cv2.FlannBasedMatcher(index_params, search_params)
+        min_match_count=10, FLANN_index=FLANN_INDEX_KDTREE,
+        flann=None, RANSAC_model="HOMOGRAPHY", RANSAC_method="RANSAC",
+        RANSAC_max_iter=2000, RANSAC_confidence=0.995, **kwargs):
+    if flann is None:
+        flann = make_flann_matcher(
+            des_q, FLANN_ntree=FLANN_ntree, FLANN_ncheck=FLANN_ncheck,
+            FLANN_index=FLANN_index, **kwargs)
 
-    matches = flann.knnMatch(des_p, des_q, k=2)
+    idx, dist = flann.knn_search(des_p, k=2, loc_p=loc_p)
 
     # store all the good matches as per Lowe's ratio test.
-    good = []
-    k1 = []
-    k2 = []
-    for m, n in matches:
-        if m.distance < ratio_of_dist * n.distance:
-            good.append(m)
-    if len(good) > min_match_count:
-        src_pts = np.float32(
-            [loc_p[m.queryIdx] for m in good]).reshape(-1, 1, 2)
-        dst_pts = np.float32(
-            [loc_q[m.trainIdx] for m in good]).reshape(-1, 1, 2)
-        M, mask = cv2.findHomography(
-            src_pts,
-            dst_pts,
-            cv2.RANSAC,
-            RANSAC_outlier)
-        matchesMask = mask.ravel().tolist()
-
-        good = np.array(good)[np.array(matchesMask).astype('bool')]
-        imgIdx = np.array([g.imgIdx for g in good])
-        tIdx = np.array([g.trainIdx for g in good])
-        qIdx = np.array([g.queryIdx for g in good])
-        for i in range(len(tIdx)):
-            if imgIdx[i] == 1:
-                k1.append(loc_p[tIdx[i]])
-                k2.append(loc_q[qIdx[i]])
-            else:
-                k1.append(loc_p[qIdx[i]])
-                k2.append(loc_q[tIdx[i]])
+    p_ind, q_ind = ratio_test(idx, dist, ratio_of_dist)
+    k1 = loc_p[p_ind]
+    k2 = loc_q[q_ind]
 
-    return k1, k2
+    inliers = ransac_inliers(
+        k1, k2, RANSAC_outlier=RANSAC_outlier,
+        min_match_count=min_match_count,
+        RANSAC_model=RANSAC_model, RANSAC_method=RANSAC_method,
+        RANSAC_max_iter=RANSAC_max_iter,
+        RANSAC_confidence=RANSAC_confidence)
+    return k1[inliers], k2[inliers]
 
 
 # TODO change this to pq terminology
 def chunk_match_keypoints(
         loc1, des1, loc2, des2, ndiv=1, full_shape=None,
-        ransac_kwargs=None, **kwargs):
+        ransac_kwargs=None, origin=None, **kwargs):
     ransac_kwargs = ransac_kwargs or {}
     if full_shape is None:
-        full_shape = np.ptp(np.concatenate([loc1, loc2]), axis=0)
-
-    nr, nc = full_shape
+        full_shape = np.ptp(np.concatenate([loc1, loc2]), axis=0)[::-1]
+    if origin is None:
+        origin = (0, 0)
+
+    # full_shape is (rows, cols) of the region loc1 was extracted from
+    ny, nx = full_shape
+    x0, y0 = origin
+    match_kwargs = {**ransac_kwargs, **kwargs}
+    if match_kwargs.get("flann") is None:
+        match_kwargs["flann"] = make_flann_matcher(
+            des2, loc_q=loc2, **match_kwargs)
 
     chunk_results = []
 
     # FIXME better way than doing min and max of arrays
     for i in range(ndiv):
-        r = np.arange(nr * i / ndiv, nr * (i + 1) / ndiv)
+        r = x0 + np.arange(nx * i / ndiv, nx * (i + 1) / ndiv)
         for j in range(ndiv):
-            c = np.arange(nc * j / ndiv, nc * (j + 1) / ndiv)
+            c = y0 + np.arange(ny * j / ndiv, ny * (j + 1) / ndiv)
             k1ind = np.argwhere(
                 (loc1[:, 0] >= r.min()) &
                 (loc1[:, 0] <= r.max()) &
@@ -227,55 +345,264 @@ def chunk_match_keypoints(
             chunk_results.append(match_and_ransac(
                 loc1[k1ind, ...], des1[k1ind, ...],
                 loc2, des2,
-                **{**ransac_kwargs, **kwargs}))
+                **match_kwargs))
 
     p_results, q_results = zip(*chunk_results)
-    p_results = np.concatenate([i for i in p_results if len(i)])
-    q_results = np.concatenate([i for i in q_results if len(i)])
+    p_results = np.concatenate(p_results).reshape(-1, 2)
+    q_results = np.concatenate(q_results).reshape(-1, 2)
     return p_results, q_results
 
 
+def create_detector(detector="SIFT", **kwargs):
+    """opencv feature detector and descriptor extractor by name"""
+    if detector == "SIFT":
+        return cv2.SIFT_create(**kwargs)
+    if detector == "ORB":
+        return cv2.ORB_create(**kwargs)
+    if detector == "AKAZE":
+        try:
+            return cv2.AKAZE_create(**kwargs)
+        except AttributeError:
+            return cv2.xfeatures2d.AKAZE_create(**kwargs)
+    raise ValueError("unknown feature detector {}".format(detector))
+
+
+def extract_features(im, sift_kwargs=None, **kwargs):
+    """keypoint locations and descriptors of an image.  sift_kwargs are
+    passed to the detector, which is SIFT unless another is named by a
+    "detector" entry (see create_detector)
+    """
+    sift_kwargs = dict(sift_kwargs or {})
+    detector = sift_kwargs.pop("detector", "SIFT")
+    sift = create_detector(detector, **sift_kwargs)
+
+    kp, des = sift.detectAndCompute(im, None)
+    loc = np.array([np.array(k.pt) for k in kp]).reshape(-1, 2)
+    if des is None:
+        des = np.empty(
+            (0, sift.descriptorSize()),
+            dtype=(np.float32 if detector == "SIFT" else np.uint8))
+    return loc, des
+
+
 def sift_match_images(
         pim, qim, sift_kwargs=None,
         ransac_kwargs=None, match_kwargs=None,
-        return_num_features=False,
+        return_num_features=False, detector=None,
         **kwargs):
-    sift_kwargs = sift_kwargs or {}
-    match_kwargs = match_kwargs or {}
+    if detector is not None:
+        sift_kwargs = dict(sift_kwargs or {}, detector=detector)
+    # find the keypoints and descriptors
+    k1xy, des1 = extract_features(pim, sift_kwargs=sift_kwargs)
+    k2xy, des2 = extract_features(qim, sift_kwargs=sift_kwargs)
 
-    sift = cv2.SIFT_create(**sift_kwargs)
+    return match_features(
+        k1xy, des1, k2xy, des2, pim.shape,
+        ransac_kwargs=ransac_kwargs, match_kwargs=match_kwargs,
+        return_num_features=return_num_features, **kwargs)
 
-    # find the keypoints and descriptors
-    kp1, des1 = sift.detectAndCompute(pim, None)
-    kp2, des2 = sift.detectAndCompute(qim, None)
 
-    k1xy = np.array([np.array(k.pt) for k in kp1])
-    k2xy = np.array([np.array(k.pt) for k in kp2])
+def match_features(
+        k1xy, des1, k2xy, des2, full_shape,
+        ransac_kwargs=None, match_kwargs=None,
+        return_num_features=False, origin=None, **kwargs):
+    match_kwargs = match_kwargs or {}
 
     k1, k2 = chunk_match_keypoints(
         k1xy, des1, k2xy, des2,
-        full_shape=pim.shape,
+        full_shape=full_shape,
+        origin=origin,
         ransac_kwargs=ransac_kwargs,
         **{**match_kwargs, **kwargs}
     )
     if return_num_features:
-        return (k1, k2), (len(kp1), len(kp2))
+        return (k1, k2), (len(k1xy), len(k2xy))
     return k1, k2
 
 
+def crop_to_roi(im, roi, scale=1.0):
+    """crop an image downsampled by scale to a level 0 [minX, minY,
+    maxX, maxY] roi, returning the crop and its (x, y) origin
+    """
+    if roi is None:
+        return im, (0, 0)
+    x0, y0 = [max(int(np.floor(v * scale)), 0) for v in roi[:2]]
+    x1 = min(int(np.ceil(roi[2] * scale)), im.shape[1])
+    y1 = min(int(np.ceil(roi[3] * scale)), im.shape[0])
+    return im[y0:y1, x0:x1], (x0, y0)
+
+
+def crop_features(features, roi, scale=1.0):
+    """TileFeatures of a tile (or a region of it containing roi)
+    downsampled by scale restricted to the keypoints within a level 0
+    [minX, minY, maxX, maxY] roi, with the shape and origin crop_to_roi
+    gives that region
+    """
+    if roi is None:
+        return features
+    ny, nx = features.shape[:2]
+    ox, oy = features.origin
+    x0, y0 = [max(int(np.floor(v * scale)), 0) for v in roi[:2]]
+    x1 = min(int(np.ceil(roi[2] * scale)), ox + nx)
+    y1 = min(int(np.ceil(roi[3] * scale)), oy + ny)
+    loc = features.loc
+    inside = ((loc[:, 0] >= x0) & (loc[:, 0] < x1) &
+              (loc[:, 1] >= y0) & (loc[:, 1] < y1))
+    return TileFeatures(
+        loc[inside], features.des[inside],
+        (max(y1 - y0, 0), max(x1 - x0, 0)) + tuple(features.shape[2:]),
+        (x0, y0))
+
+
+def mipmap_level_for_scale(ip, scale):
+    """coarsest level of ImagePyramid ip with a resolution at or above
+    scale, and the remaining scale to apply to an image of that level
+    """
+    levels = [int(lvl) for lvl in ip.levels]
+    level = max([lvl for lvl in levels if 2. ** -lvl >= scale] or [0])
+    return level, scale * 2. ** level
+
+
+def tile_features_key(tileId, image_uri, downsample_scale, roi=None,
+                      **kwargs):
+    return FeatureCache.make_key(
+        tileId, image_uri, downsample_scale,
+        roi=(None if roi is None else [float(v) for v in roi]), **kwargs)
+
+
+def load_tile_input(
+        tileId, image_uri, downsample_scale,
+        CLAHE_grid=None, CLAHE_clip=None,
+        sift_kwargs=None, feature_cache=None, roi=None, level=0):
+    """I/O side of feature extraction for a tile: cached TileFeatures
+    from feature_cache (a FeatureCache) if available, otherwise the
+    downsampled, equalized image as a TileImage.  If roi is given, only
+    that level 0 [minX, minY, maxX, maxY] region is used.  image_uri may
+    refer to mipmap level, in which case it is only resized by the
+    remaining factor to reach downsample_scale.
+    """
+    key = None
+    if feature_cache is not None:
+        key = tile_features_key(
+            tileId, image_uri, downsample_scale,
+            CLAHE_grid=CLAHE_grid, CLAHE_clip=CLAHE_clip,
+            sift_kwargs=sift_kwargs, roi=roi)
+        cached = feature_cache.get(key)
+        if cached is not None:
+            return cached
+
+    im = read_downsample_equalize_mask_uri(
+        image_uri,
+        downsample_scale * 2. ** level,
+        CLAHE_grid=CLAHE_grid,
+        CLAHE_clip=CLAHE_clip)
+    im, origin = crop_to_roi(im, roi, downsample_scale)
+    return TileImage(im, origin, key)
+
+
+def tile_features_from_input(tile_input, sift_kwargs=None,
+                             feature_cache=None):
+    """compute side of feature extraction: TileFeatures from the result
+    of load_tile_input, stored in feature_cache if one is given
+    """
+    if isinstance(tile_input, TileFeatures):
+        return tile_input
+    im, origin, key = tile_input
+    loc, des = extract_features(im, sift_kwargs=sift_kwargs)
+    features = TileFeatures(loc + origin, des, im.shape, origin)
+
+    if feature_cache is not None and key is not None:
+        feature_cache.put(key, features)
+    return features
+
+
+def read_and_extract_features(
+        tileId, image_uri, downsample_scale,
+        sift_kwargs=None, feature_cache=None, **kwargs):
+    """get TileFeatures for a tile, reusing features from feature_cache
+    (a FeatureCache) if available
+    """
+    return tile_features_from_input(
+        load_tile_input(
+            tileId, image_uri, downsample_scale, sift_kwargs=sift_kwargs,
+            feature_cache=feature_cache, **kwargs),
+        sift_kwargs=sift_kwargs, feature_cache=feature_cache)
+
+
+def affine_residuals(src, dst):
+    """distance of each dst from its src mapped by the least squares
+    affine fit of all the matches
+    """
+    A = fit_affine(src, dst)
+    return np.linalg.norm(src.dot(A[:2, :2].T) + A[:2, 2] - dst, axis=1)
+
+
+def stratified_subsample(loc, match_max, grid=16, priority=None):
+    """indices of at most match_max points of Nx2 loc taken in turn from
+    the bins of a grid x grid partition of their extent, so sparsely
+    matched regions keep all their points and dense ones are thinned
+
+    Parameters
+    ----------
+    loc : numpy.ndarray
+        Nx2 point locations
+    match_max : int
+        number of points to keep
+    grid : int
+        number of bins along each axis
+    priority : numpy.ndarray, optional
+        points with lower priority are taken first within a bin, by
+        default a random order
+
+    Returns
+    -------
+    numpy.ndarray
+        sorted indices into loc
+    """
+    n = loc.shape[0]
+    if n <= match_max:
+        return np.arange(n)
+    if priority is None:
+        priority = np.random.permutation(n)
+
+    lo = loc.min(axis=0)
+    span = np.maximum(np.ptp(loc, axis=0), np.finfo(float).eps)
+    xy = np.minimum(((loc - lo) / span * grid).astype(int), grid - 1)
+    bins = xy[:, 1] * grid + xy[:, 0]
+
+    # rank of each point within its bin by priority
+    order = np.lexsort((priority, bins))
+    sorted_bins = bins[order]
+    starts = np.flatnonzero(np.r_[True, np.diff(sorted_bins) > 0])
+    rank = np.empty(n, dtype=int)
+    rank[order] = np.arange(n) - np.repeat(starts, np.diff(np.r_[starts, n]))
+
+    # round robin over bins, best ranked points first
+    keep = np.lexsort((np.random.permutation(n), rank))[:match_max]
+    return np.sort(keep)
+
+
 def locs_to_dict(
         pGroupId, pId, loc_p,
         qGroupId, qId, loc_q,
-        scale_factor=1.0, match_max=1000):
+        scale_factor=1.0, match_max=1000,
+        match_decimation="random", decimation_grid=16,
+        decimation_prefer_low_residual=False):
     if loc_p.shape[0] < 0:
         return
     loc_p *= scale_factor
     loc_q *= scale_factor
 
     if loc_p.shape[0] > match_max:
-        ind = np.arange(loc_p.shape[0])
-        np.random.shuffle(ind)
-        ind = ind[0:match_max]
+        if match_decimation == "stratified":
+            ind = stratified_subsample(
+                loc_p, match_max, grid=decimation_grid,
+                priority=(affine_residuals(loc_p, loc_q)
+                          if decimation_prefer_low_residual else None))
+        else:
+            ind = np.arange(loc_p.shape[0])
+            np.random.shuffle(ind)
+            ind = ind[0:match_max]
         loc_p = loc_p[ind, ...]
         loc_q = loc_q[ind, ...]
 
@@ -285,28 +612,66 @@ def locs_to_dict(
         loc_p, loc_q)
 
 
-def process_matches(
-        pId, pGroupId, p_image_uri,
-        qId, qGroupId, q_image_uri,
+def load_pair_inputs(
+        pId, p_image_uri, qId, q_image_uri,
         downsample_scale=1.0,
         CLAHE_grid=None, CLAHE_clip=None,
+        sift_kwargs=None,
+        feature_cache_dir=None,
+        p_roi=None, q_roi=None,
+        p_level=0, q_level=0,
+        **kwargs):
+    """load_tile_input for both tiles of a pair from process_matches
+    arguments
+    """
+    feature_cache = (
+        FeatureCache(feature_cache_dir) if feature_cache_dir else None)
+    read_kwargs = dict(
+        CLAHE_grid=CLAHE_grid, CLAHE_clip=CLAHE_clip,
+        sift_kwargs=sift_kwargs, feature_cache=feature_cache)
+    return (
+        load_tile_input(
+            pId, p_image_uri, downsample_scale,
+            roi=p_roi, level=p_level, **read_kwargs),
+        load_tile_input(
+            qId, q_image_uri, downsample_scale,
+            roi=q_roi, level=q_level, **read_kwargs))
+
+
+def match_tile_inputs(
+        pId, pGroupId, p_input,
+        qId, qGroupId, q_input,
+        downsample_scale=1.0,
         matchMax=1000,
+        match_decimation="random", decimation_grid=16,
+        decimation_prefer_low_residual=False,
         sift_kwargs=None,
+        feature_cache_dir=None,
+        pq_tform=None, guided_search_radius=200.,
+        CLAHE_grid=None, CLAHE_clip=None,
+        p_roi=None, q_roi=None,
+        p_level=0, q_level=0,
         **kwargs):
-
-    pim = read_downsample_equalize_mask_uri(
-        p_image_uri,
-        downsample_scale,
-        CLAHE_grid=CLAHE_grid,
-        CLAHE_clip=CLAHE_clip)
-    qim = read_downsample_equalize_mask_uri(
-        q_image_uri,
-        downsample_scale,
-        CLAHE_grid=CLAHE_grid,
-        CLAHE_clip=CLAHE_clip)
-
-    (loc_p, loc_q), (num_features_p, num_features_q) = sift_match_images(
-        pim, qim, sift_kwargs=sift_kwargs,
+    """extract features from the load_pair_inputs of a pair and match
+    them, taking the same arguments as process_matches
+    """
+    feature_cache = (
+        FeatureCache(feature_cache_dir) if feature_cache_dir else None)
+    p_features, q_features = [
+        tile_features_from_input(
+            tile_input, sift_kwargs=sift_kwargs, feature_cache=feature_cache)
+        for tile_input in (p_input, q_input)]
+
+    if pq_tform is not None:
+        # level 0 prior to downsampled keypoint coordinates
+        S = np.diag([downsample_scale, downsample_scale, 1.])
+        kwargs["pq_tform"] = S.dot(pq_tform).dot(np.linalg.inv(S))
+        kwargs["guided_search_radius"] = (
+            guided_search_radius * downsample_scale)
+
+    (loc_p, loc_q), (num_features_p, num_features_q) = match_features(
+        p_features.loc, p_features.des, q_features.loc, q_features.des,
+        p_features.shape, origin=p_features.origin,
         return_num_features=True,
         **kwargs)
 
@@ -314,45 +679,225 @@ def process_matches(
         pGroupId, pId, loc_p,
         qGroupId, qId, loc_q,
         scale_factor=(1. / downsample_scale),
-        match_max=matchMax)
+        match_max=matchMax,
+        match_decimation=match_decimation,
+        decimation_grid=decimation_grid,
+        decimation_prefer_low_residual=decimation_prefer_low_residual)
 
     return pm_dict, len(loc_p), num_features_p, num_features_q
 
 
-def find_matches(fargs):
-    [impaths, ids, gids, args] = fargs
-
-    pm_dict, num_matches, num_features_p, num_features_q = process_matches(
-        ids[0], gids[0], impaths[0],
-        ids[1], gids[1], impaths[1],
+def process_matches(
+        pId, pGroupId, p_image_uri,
+        qId, qGroupId, q_image_uri,
+        **kwargs):
+    p_input, q_input = load_pair_inputs(
+        pId, p_image_uri, qId, q_image_uri, **kwargs)
+    return match_tile_inputs(
+        pId, pGroupId, p_input, qId, qGroupId, q_input, **kwargs)
+
+
+def detector_kwargs(args):
+    """extract_features sift_kwargs for the detector in module args"""
+    if args["detector"] == "ORB":
+        return {
+            "detector": "ORB",
+            "nfeatures": args["ORB_nfeature"]
+        }
+    if args["detector"] == "AKAZE":
+        return {
+            "detector": "AKAZE",
+            "threshold": args["AKAZE_threshold"]
+        }
+    return {
+        "nfeatures": args["SIFT_nfeature"],
+        "nOctaveLayers": args['SIFT_noctave'],
+        "sigma": args['SIFT_sigma']
+    }
+
+
+def tier_args(args, tier=None):
+    """module args with the overrides of escalation tier applied.  The
+    tier after the last of escalation_tiers, or None, is args itself.
+    """
+    tiers = args.get("escalation_tiers") or []
+    if tier is None or tier >= len(tiers):
+        return args
+    return dict(args, **{
+        k: v for k, v in tiers[tier].items() if v is not None})
+
+
+def find_matches_kwargs(args, pair_kwargs):
+    """process_matches keyword arguments from module args, at the
+    escalation tier given in pair_kwargs if any
+    """
+    pair_kwargs = dict(pair_kwargs)
+    args = tier_args(args, pair_kwargs.pop("escalation_tier", None))
+    return dict(
         downsample_scale=args["downsample_scale"],
         CLAHE_grid=args["CLAHE_grid"],
         CLAHE_clip=args["CLAHE_clip"],
-        sift_kwargs={
-            "nfeatures": args["SIFT_nfeature"],
-            "nOctaveLayers": args['SIFT_noctave'],
-            "sigma": args['SIFT_sigma']
-        },
+        sift_kwargs=detector_kwargs(args),
         match_kwargs={
             "ndiv": args["ndiv"],
             "FLANN_ntree": args["FLANN_ntree"],
             "ratio_of_dist": args["ratio_of_dist"],
-            "FLANN_ncheck": args["FLANN_ncheck"]
+            "FLANN_ncheck": args["FLANN_ncheck"],
+            "guided_max_candidates": args["guided_max_candidates"],
+            "binary_matcher": args["binary_matcher"],
+            "LSH_table_number": args["LSH_table_number"],
+            "LSH_key_size": args["LSH_key_size"],
+            "LSH_multi_probe_level": args["LSH_multi_probe_level"]
         },
         ransac_kwargs={
-            "RANSAC_outlier": args["RANSAC_outlier"]
+            "RANSAC_outlier": args["RANSAC_outlier"],
+            "RANSAC_model": args["RANSAC_model"],
+            "RANSAC_method": args["RANSAC_method"],
+            "RANSAC_max_iter": args["RANSAC_max_iter"],
+            "RANSAC_confidence": args["RANSAC_confidence"]
         },
-        matchMax=args["matchMax"]
+        matchMax=args["matchMax"],
+        match_decimation=args["match_decimation"],
+        decimation_grid=args["decimation_grid"],
+        decimation_prefer_low_residual=args[
+            "decimation_prefer_low_residual"],
+        feature_cache_dir=args.get("feature_cache_dir"),
+        **pair_kwargs
     )
 
-    render = renderapi.connect(**args['render'])
 
-    renderapi.pointmatch.import_matches(
-        args['match_collection'],
-        [pm_dict],
-        render=render)
+def read_pair(fargs):
+    """I/O stage of find_matches"""
+    [impaths, ids, gids, args, pair_kwargs] = fargs
+    inputs = load_pair_inputs(
+        ids[0], impaths[0], ids[1], impaths[1],
+        **find_matches_kwargs(args, pair_kwargs))
+    return [impaths, ids, gids, args, pair_kwargs, inputs]
+
+
+def match_pair(rargs):
+    """compute stage of find_matches"""
+    [impaths, ids, gids, args, pair_kwargs, inputs] = rargs
 
-    return [impaths, num_features_p, num_features_q, num_matches, num_matches]
+    pm_dict, num_matches, num_features_p, num_features_q = match_tile_inputs(
+        ids[0], gids[0], inputs[0],
+        ids[1], gids[1], inputs[1],
+        **find_matches_kwargs(args, pair_kwargs))
+
+    return [impaths, num_features_p, num_features_q, num_matches, num_matches,
+            pm_dict]
+
+
+def find_matches(fargs):
+    return match_pair(read_pair(fargs))
+
+
+def pair_accepted(r, args):
+    """whether a find_matches result has at least escalation_min_matches
+    matches with a median affine residual of at most
+    escalation_max_residual
+    """
+    if r[3] < args["escalation_min_matches"]:
+        return False
+    if args.get("escalation_max_residual") is not None:
+        p = np.array(r[5]['matches']['p'], dtype=float).reshape(2, -1).T
+        q = np.array(r[5]['matches']['q'], dtype=float).reshape(2, -1).T
+        if (p.shape[0] < 3 or np.median(affine_residuals(p, q)) >
+                args["escalation_max_residual"]):
+            return False
+    return True
+
+
+def escalate_pair(r, fargs):
+    """find_matches result r of fargs, rematched at later escalation
+    tiers until it is accepted (see pair_accepted) or the tiers run out,
+    extended by the tier of the returned result (None without
+    escalation)
+    """
+    [impaths, ids, gids, args, pair_kwargs] = fargs
+    tier = pair_kwargs.get("escalation_tier")
+    if tier is None:
+        return r + [None]
+    ntiers = len(args["escalation_tiers"])
+    while tier < ntiers and not pair_accepted(r, args):
+        tier += 1
+        r = find_matches([impaths, ids, gids, args,
+                          dict(pair_kwargs, escalation_tier=tier)])
+    return r + [tier]
+
+
+def find_matches_escalating(fargs):
+    return escalate_pair(find_matches(fargs), fargs)
+
+
+def match_pair_escalating(rargs):
+    """compute stage of find_matches_escalating"""
+    return escalate_pair(match_pair(rargs), rargs[:5])
+
+
+# per-process cache of TileFeatures for find_matches_batch
+_tile_lru = LRUCache()
+
+
+def tile_feature_rois(fargs):
+    """level 0 bounding box of the overlap rois each tile has in the
+    pairs of fargs, or None for a tile matched whole in any pair
+    """
+    rois = {}
+    for impaths, ids, gids, args, pair_kwargs in fargs:
+        for tileId, k in zip(ids, ['p_roi', 'q_roi']):
+            roi = pair_kwargs.get(k)
+            if tileId not in rois:
+                rois[tileId] = None if roi is None else list(roi)
+            elif rois[tileId] is not None:
+                rois[tileId] = None if roi is None else (
+                    [min(a, b) for a, b in zip(rois[tileId][:2], roi[:2])] +
+                    [max(a, b) for a, b in zip(rois[tileId][2:], roi[2:])])
+    return rois
+
+
+def find_matches_batch(bargs):
+    """find_matches for a batch of spatially adjacent pairs, reusing
+    features of tiles shared between the pairs from a bounded cache.
+    Features are extracted once per tile from its roi in feature_rois
+    (see tile_feature_rois), and cropped to the overlap roi of each
+    pair, so a tile's features are reused across its pairs even with
+    restrict_to_overlap.
+    """
+    fargs_list, cache_size, feature_rois = bargs
+    _tile_lru.maxsize = cache_size
+
+    results = []
+    for [impaths, ids, gids, args, pair_kwargs] in fargs_list:
+        kwargs = find_matches_kwargs(args, pair_kwargs)
+        read_kwargs = dict(
+            CLAHE_grid=kwargs['CLAHE_grid'],
+            CLAHE_clip=kwargs['CLAHE_clip'],
+            sift_kwargs=kwargs['sift_kwargs'])
+        inputs = []
+        for tileId, impath, roi, level in zip(
+                ids, impaths,
+                [kwargs.get('p_roi'), kwargs.get('q_roi')],
+                [kwargs.get('p_level', 0), kwargs.get('q_level', 0)]):
+            feature_roi = feature_rois.get(tileId)
+            key = tile_features_key(
+                tileId, impath, kwargs['downsample_scale'],
+                roi=feature_roi, **read_kwargs)
+            features = _tile_lru.get(key)
+            if features is None:
+                features = read_and_extract_features(
+                    tileId, impath, kwargs['downsample_scale'],
+                    feature_cache=(
+                        FeatureCache(kwargs['feature_cache_dir'])
+                        if kwargs['feature_cache_dir'] else None),
+                    roi=feature_roi, level=level, **read_kwargs)
+                _tile_lru.put(key, features)
+            inputs.append(crop_features(
+                features, roi, kwargs['downsample_scale']))
+        results.append(escalate_pair(
+            match_pair([impaths, ids, gids, args, pair_kwargs, inputs]),
+            [impaths, ids, gids, args, pair_kwargs]))
+    return results
 
 
 def make_pm(ids, gids, k1, k2):
@@ -375,23 +920,24 @@ def parse_tileids(tpjson, logger=logging.getLogger()):
                 [[m['p']['id'], m['q']['id']]
                     for m in tpjson['neighborPairs']])
 
-    unique_ids = np.unique(tile_ids.flatten())
+    if tile_ids.ndim != 2:
+        logger.error('tile_ids has shape %s : probably no tilepairs' % (
+            str(tile_ids.shape)))
 
     # determine tile index per tile pair
-    try:
-        tile_index = np.zeros(
-                        (tile_ids.shape[0], tile_ids.shape[1])
-                        ).astype('int')
-    except IndexError as e:
-        logger.error('%s : probably no tilepairs' % str(e))
-
-    for i in range(tile_ids.shape[0]):
-        for j in range(tile_ids.shape[1]):
-            tile_index[i, j] = np.argwhere(unique_ids == tile_ids[i, j])
+    unique_ids, tile_index = np.unique(tile_ids, return_inverse=True)
+    tile_index = tile_index.reshape(tile_ids.shape)
 
     return unique_ids, tile_index
 
 
+def parse_tile_groupids(tpjson):
+    """dictionary of tileId: groupId for the tiles in a tilepair json"""
+    return {
+        m[k]['id']: m[k]['groupId']
+        for m in tpjson['neighborPairs'] for k in ('p', 'q')}
+
+
 def load_pairjson(tilepair_file, logger=logging.getLogger()):
     tpjson = []
     try:
@@ -412,6 +958,88 @@ def load_tilespecs(render, input_stack, unique_ids):
     return np.array(tilespecs)
 
 
+def load_resolvedtiles(render, input_stack, unique_ids, tile_groupids,
+                       concurrency=8, logger=logging.getLogger()):
+    """fetch tilespecs for unique_ids with one resolved tiles request per
+    z of their groups (sectionIds), made concurrently.  Tiles that cannot
+    be found this way are fetched individually.
+
+    Returns
+    -------
+    tilespecs : numpy.ndarray of renderapi.tilespec.TileSpec
+        tilespecs in the order of unique_ids
+    ref_tforms : list of renderapi.transform.Transform
+        shared transforms referenced by the tilespecs
+    """
+    def section_z(groupId):
+        try:
+            return renderapi.stack.get_section_z_value(
+                input_stack, groupId, render=render)
+        except renderapi.errors.RenderError as e:
+            logger.warning(
+                "cannot get z for group %s: %s" % (groupId, e))
+
+    def resolvedtiles_from_z(z):
+        return renderapi.resolvedtiles.get_resolved_tiles_from_z(
+            input_stack, z, render=render)
+
+    groupIds = {tile_groupids.get(tid) for tid in unique_ids}
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as e:
+        zs = {z for z in e.map(section_z, groupIds) if z is not None}
+        rtss = list(e.map(resolvedtiles_from_z, zs))
+
+    tId_to_ts = {}
+    ref_tforms = {}
+    for rts in rtss:
+        tId_to_ts.update({ts.tileId: ts for ts in rts.tilespecs})
+        ref_tforms.update({tf.transformId: tf for tf in rts.transforms})
+
+    missing_ids = [tid for tid in unique_ids if tid not in tId_to_ts]
+    if missing_ids:
+        logger.warning(
+            "fetching %d tilespecs individually" % len(missing_ids))
+        tId_to_ts.update(zip(missing_ids, load_tilespecs(
+            render, input_stack, missing_ids)))
+
+    return (np.array([tId_to_ts[tid] for tid in unique_ids]),
+            list(ref_tforms.values()))
+
+
+def completed_pairs_from_collection(
+        render, match_collection, pairs, concurrency=8,
+        logger=logging.getLogger()):
+    """pair_keys of the tile pairs in pairs that already have matches
+    in match_collection, with one request per pair of groups
+    """
+    def group_matches(gids):
+        pg, qg = gids
+        try:
+            if pg == qg:
+                return renderapi.pointmatch.get_matches_within_group(
+                    match_collection, pg, render=render)
+            return renderapi.pointmatch.get_matches_from_group_to_group(
+                match_collection, pg, qg, render=render)
+        except renderapi.errors.RenderError as e:
+            logger.warning(
+                "cannot get matches for groups %s, %s: %s" % (pg, qg, e))
+            return []
+
+    group_pairs = {
+        tuple(sorted((m['p']['groupId'], m['q']['groupId'])))
+        for m in pairs}
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as e:
+        return {match_pair_key(pm)
+                for pms in e.map(group_matches, group_pairs)
+                for pm in pms}
+
+
+def remove_completed_pairs(pairs, completed):
+    return [
+        m for m in pairs
+        if pair_key(m['p']['groupId'], m['p']['id'],
+                    m['q']['groupId'], m['q']['id']) not in completed]
+
+
 class GeneratePointMatchesOpenCV(ArgSchemaParser):
     default_schema = PointMatchOpenCVParameters
     default_output_schema = PointMatchClientOutputSchema
@@ -420,46 +1048,196 @@ class GeneratePointMatchesOpenCV(ArgSchemaParser):
         render = renderapi.connect(**self.args['render'])
         tpjson = load_pairjson(self.args['pairJson'], logger=self.logger)
 
+        npairs = len(tpjson['neighborPairs'])
+        if self.args['resume']:
+            tpjson['neighborPairs'] = self.remove_completed(
+                render, tpjson['neighborPairs'])
+        pairs_skipped = npairs - len(tpjson['neighborPairs'])
+        self.logger.info(
+            "skipping %d of %d completed tile pairs" % (
+                pairs_skipped, npairs))
+        if not tpjson['neighborPairs']:
+            self.output_pair_counts(npairs, 0, pairs_skipped)
+            return
+
         unique_ids, tile_index = parse_tileids(tpjson, logger=self.logger)
 
-        tilespecs = load_tilespecs(
+        tilespecs, ref_tforms = load_resolvedtiles(
                 render,
                 self.args['input_stack'],
-                unique_ids)
+                unique_ids,
+                parse_tile_groupids(tpjson),
+                concurrency=self.args['tilespec_concurrency'],
+                logger=self.logger)
 
-        self.match_image_pairs(
+        pairs_per_tier = self.match_image_pairs(
                 tilespecs,
-                tile_index)
+                tile_index,
+                pairs=tpjson['neighborPairs'],
+                ref_tforms=ref_tforms)
+
+        self.output_pair_counts(
+            npairs, tile_index.shape[0], pairs_skipped,
+            pairs_per_tier=pairs_per_tier)
+
+    def remove_completed(self, render, pairs):
+        completed = set()
+        if self.args['completion_journal']:
+            completed |= CompletionJournal(
+                self.args['completion_journal']).completed()
+        if (self.args['match_sink'] == 'jsonl' and
+                os.path.isfile(self.args['match_output_file'])):
+            completed |= {
+                match_pair_key(pm) for pm in iter_matches_jsonl(
+                    self.args['match_output_file'])}
+        elif self.args['match_collection']:
+            completed |= completed_pairs_from_collection(
+                render, self.args['match_collection'], pairs,
+                concurrency=self.args['tilespec_concurrency'],
+                logger=self.logger)
+        return remove_completed_pairs(pairs, completed)
+
+    def output_pair_counts(self, pair_count, pairs_computed, pairs_skipped,
+                           pairs_per_tier=None):
+        output = {}
+        output['collectionId'] = {}
+        output['collectionId']['owner'] = self.args['render']['owner']
+        output['collectionId']['name'] = self.args['match_collection']
+        output['pairCount'] = pair_count
+        output['pairsComputed'] = pairs_computed
+        output['pairsSkipped'] = pairs_skipped
+        if pairs_per_tier is not None:
+            output['pairsPerTier'] = pairs_per_tier
+        self.output(output)
 
-    def match_image_pairs(self, tilespecs, tile_index):
+    def pair_kwargs(self, tilespecs, tile_index, pairs=None,
+                    ref_tforms=None):
+        """per-pair priors from tilespec layout passed to process_matches"""
+        pair_kwargs = [{} for i in range(tile_index.shape[0])]
+        for i, kw in enumerate(pair_kwargs):
+            ts_p, ts_q = tilespecs[tile_index[i]]
+            if self.args['escalation_tiers']:
+                kw['escalation_tier'] = 0
+            if self.args['restrict_to_overlap']:
+                kw['p_roi'], kw['q_roi'] = overlap_rois(
+                    ts_p, ts_q,
+                    pair=(None if pairs is None else pairs[i]),
+                    margin=self.args['overlap_margin'],
+                    overlap_fraction=self.args['overlap_fraction'],
+                    ref_tforms=ref_tforms)
+            if self.args['use_mipmap_levels']:
+                kw['p_level'], kw['q_level'] = [
+                    mipmap_level_for_scale(
+                        ts.ip, self.args['downsample_scale'])[0]
+                    for ts in (ts_p, ts_q)]
+            if self.args['guided_matching']:
+                try:
+                    kw['pq_tform'] = predicted_pq_affine(
+                        ts_p, ts_q, ref_tforms=ref_tforms)
+                    kw['guided_search_radius'] = self.args[
+                        'guided_search_radius']
+                except (renderapi.errors.RenderError,
+                        NotImplementedError) as e:
+                    self.logger.warning(
+                        "cannot predict transform for %s, %s: %s" % (
+                            ts_p.tileId, ts_q.tileId, e))
+        return pair_kwargs
+
+    def pair_fargs(self, tilespecs, tile_index, pairs=None,
+                   ref_tforms=None, args=None):
+        """find_matches arguments for each tile pair"""
+        args = self.args if args is None else args
+        pair_kwargs = self.pair_kwargs(
+            tilespecs, tile_index, pairs=pairs, ref_tforms=ref_tforms)
+
+        fargs = []
+        for i in range(tile_index.shape[0]):
+            levels = [pair_kwargs[i].get(k, 0)
+                      for k in ('p_level', 'q_level')]
+            impaths = [[t.ip[lvl].imageUrl, t.ip[lvl].maskUrl]
+                       for t, lvl in zip(
+                           tilespecs[tile_index[i]], levels)]
+            ids = [t.tileId for t in tilespecs[tile_index[i]]]
+            gids = [t.layout.sectionId
+                    for t in tilespecs[tile_index[i]]]
+            fargs.append(
+                [impaths, ids, gids, args, pair_kwargs[i]])
+        return fargs
+
+    def match_image_pairs(self, tilespecs, tile_index, pairs=None,
+                          ref_tforms=None):
         ncpus = self.args['ncpus']
         if self.args['ncpus'] == -1:
             ncpus = multiprocessing.cpu_count()
-
-        with renderapi.client.WithPool(ncpus) as pool:
-            index_list = range(tile_index.shape[0])
-
-            fargs = []
-            for i in index_list:
-                impaths = [[t.ip[0].imageUrl, t.ip[0].maskUrl]
-                           for t in tilespecs[tile_index[i]]]
-                ids = [t.tileId for t in tilespecs[tile_index[i]]]
-                gids = [t.layout.sectionId
-                        for t in tilespecs[tile_index[i]]]
-                fargs.append([impaths, ids, gids, self.args])
-
-            for r in pool.imap_unordered(find_matches, fargs):
+        pool_kwargs = worker_pool_kwargs(
+            ncpus, self.args['threads_per_worker'])
+
+        fargs = self.pair_fargs(
+            tilespecs, tile_index, pairs=pairs, ref_tforms=ref_tforms)
+
+        batches = [np.arange(len(fargs))]
+        if self.args['tile_affinity']:
+            batches = partition_pairs(
+                tile_index, tile_centers(tilespecs, ref_tforms),
+                batch_size=self.args['affinity_batch_size'])
+            fargs = [fargs[i] for batch in batches for i in batch]
+
+        ntiers = len(self.args['escalation_tiers'] or []) + 1
+        pairs_per_tier = [0] * ntiers
+        tier_log = (PairTierLog(self.args['escalation_log'])
+                    if self.args['escalation_log'] else None)
+
+        with make_match_sink(self.args) as sink:
+            def write_result(r):
                 log = "\n%s\n%s\n" % (r[0][0], r[0][1])
                 log += "  (%d, %d) features found" % (r[1], r[2])
                 log += "  (%d, %d) matches made" % (r[3], r[4])
+                if r[6] is not None:
+                    log += "  at escalation tier %d" % r[6]
+                    pairs_per_tier[r[6]] += 1
+                    if tier_log is not None:
+                        tier_log.record(r[5], r[6], r[3])
                 self.logger.debug(log)
-
-        output = {}
-        output['collectionId'] = {}
-        output['collectionId']['owner'] = self.args['render']['owner']
-        output['collectionId']['name'] = self.args['match_collection']
-        output['pairCount'] = tile_index.shape[0]
-        self.output(output)
+                sink.add(r[5])
+
+            if self.args['pipeline']:
+                StagedPipeline(
+                    read_pair, match_pair_escalating, write_result,
+                    io_threads=self.args['io_threads'],
+                    ncpus=ncpus,
+                    max_in_flight=self.args['pipeline_max_in_flight'],
+                    writer_queue_size=self.args['writer_queue_size'],
+                    pool_kwargs=pool_kwargs
+                ).run(fargs)
+            elif self.args['tile_affinity']:
+                feature_rois = tile_feature_rois(fargs)
+                bargs = []
+                start = 0
+                for batch in batches:
+                    batch_fargs = fargs[start:start + len(batch)]
+                    bargs.append([
+                        batch_fargs, self.args['tile_cache_size'],
+                        {tileId: feature_rois[tileId]
+                         for f in batch_fargs for tileId in f[1]}])
+                    start += len(batch)
+                with renderapi.client.WithPool(
+                        ncpus, **pool_kwargs) as pool:
+                    for rs in pool.imap_unordered(find_matches_batch, bargs):
+                        for r in rs:
+                            write_result(r)
+            else:
+                with renderapi.client.WithPool(
+                        ncpus, **pool_kwargs) as pool:
+                    for r in pool.imap_unordered(
+                            find_matches_escalating, fargs):
+                        write_result(r)
+
+        if tier_log is not None:
+            tier_log.close()
+        if self.args['escalation_tiers']:
+            self.logger.info("pairs per escalation tier: %s" % (
+                pairs_per_tier))
+            return pairs_per_tier
 
 
 if __name__ == '__main__':
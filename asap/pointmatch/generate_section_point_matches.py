@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""
+match whole downsampled sections, such as the montage scapes of
+MakeMontageScapeSectionStack, for rough alignment.  Each pair is first
+matched at a coarse scale to estimate a transform between the sections,
+and that estimate restricts the search of finer scales to the predicted
+neighborhood of each keypoint.  Features of a section are extracted once
+per worker for all the pairs it is part of.
+"""
+import concurrent.futures
+import multiprocessing
+
+import cv2
+import numpy as np
+import renderapi
+
+from asap.pointmatch.feature_cache import FeatureCache, TileFeatures
+from asap.pointmatch.generate_point_matches_opencv import (
+    GeneratePointMatchesOpenCV, extract_features, find_matches_kwargs,
+    load_pairjson, load_resolvedtiles, locs_to_dict, match_features,
+    parse_tile_groupids, parse_tileids, read_downsample_equalize_mask_uri,
+    tile_features_key)
+from asap.pointmatch.match_sinks import make_match_sink
+from asap.pointmatch.robust_fit import MODEL_FITS
+from asap.pointmatch.scheduling import LRUCache
+from asap.pointmatch.schemas import SectionPointMatchParameters
+from asap.utilities.threads import worker_pool_kwargs
+
+if __name__ == "__main__" and __package__ is None:
+    __package__ = "asap.pointmatch.generate_section_point_matches"
+
+
+example = {
+    "downsample_scale": 1.0,
+    "coarse_scales": [0.125, 0.5],
+    "coarse_model": "SIMILARITY",
+    "refine_search_radius": 32.0,
+    "zNeighborDistance": 2,
+    "minZ": 0,
+    "maxZ": 801,
+    "ndiv": 4,
+    "matchMax": 1000,
+    "SIFT_nfeature": 50000,
+    "SIFT_noctave": 3,
+    "SIFT_sigma": 1.6,
+    "CLAHE_grid": 16,
+    "CLAHE_clip": 2.5,
+    "input_stack": "MN12_L2_1A_montscape_reord",
+    "match_collection": "MN12_L2_1A_rough_matches",
+    "render": {
+        "owner": "TEM",
+        "project": "MN12_L2_1A",
+        "host": "em-131db2",
+        "port": 8888,
+        "client_scripts": "/allen/aibs/pipeline/image_processing/volume_assembly/render-jars/production/scripts"
+    },
+    "ncpus": 8
+}
+
+
+def pyramid_scales(coarse_scales, downsample_scale):
+    """scales at which sections are matched, coarsest first, ending at
+    downsample_scale
+    """
+    return sorted(
+        s for s in set(coarse_scales) if s < downsample_scale) + [
+            downsample_scale]
+
+
+def section_pyramid_features(
+        impath, scales, CLAHE_grid=None, CLAHE_clip=None,
+        sift_kwargs=None, tileId=None, feature_cache=None):
+    """TileFeatures of a section image at each of scales (see
+    pyramid_scales), with the image read once at the finest scale.
+    Levels found in feature_cache (a FeatureCache) are reused, and the
+    image is only read if a level is missing.
+    """
+    keys = [None] * len(scales)
+    features = [None] * len(scales)
+    if feature_cache is not None:
+        keys = [tile_features_key(
+                    tileId, impath, s, CLAHE_grid=CLAHE_grid,
+                    CLAHE_clip=CLAHE_clip, sift_kwargs=sift_kwargs,
+                    pyramid_scale=scales[-1])
+                for s in scales]
+        features = [feature_cache.get(key) for key in keys]
+    if all(f is not None for f in features):
+        return features
+
+    im = read_downsample_equalize_mask_uri(
+        impath, scales[-1], CLAHE_grid=CLAHE_grid, CLAHE_clip=CLAHE_clip)
+    for i, s in enumerate(scales):
+        if features[i] is not None:
+            continue
+        level_im = im if s == scales[-1] else cv2.resize(
+            im, (0, 0), fx=s / scales[-1], fy=s / scales[-1],
+            interpolation=cv2.INTER_AREA)
+        loc, des = extract_features(level_im, sift_kwargs=sift_kwargs)
+        features[i] = TileFeatures(loc, des, level_im.shape, (0, 0))
+        if feature_cache is not None:
+            feature_cache.put(keys[i], features[i])
+    return features
+
+
+def coarse_to_fine_matches(
+        p_features, q_features, scales, match_kwargs=None,
+        ransac_kwargs=None, coarse_model="SIMILARITY",
+        refine_search_radius=32., min_match_count=10, **kwargs):
+    """match two sections from their section_pyramid_features.  Levels
+    before the last match the whole section against a single
+    coarse_model RANSAC fit and estimate the p to q transform.  Each
+    following level only compares keypoints within refine_search_radius
+    pixels (of that level) of their predicted location.  A level without
+    enough matches leaves the previous estimate in place.
+
+    Returns
+    -------
+    loc_p, loc_q : numpy.ndarray
+        Nx2 matches at the last (finest) level
+    pq_tform : numpy.ndarray or None
+        3x3 p to q transform at scale 1 estimated from the matches of the
+        last level that had any
+    """
+    match_kwargs = match_kwargs or {}
+    ransac_kwargs = ransac_kwargs or {}
+    coarse_ransac_kwargs = dict(ransac_kwargs, RANSAC_model=coarse_model)
+    fit = MODEL_FITS[coarse_model]
+
+    pq_tform = None
+    loc_p = loc_q = np.empty((0, 2))
+    for i, s in enumerate(scales):
+        finest = (i == len(scales) - 1)
+        level_kwargs = dict(match_kwargs, min_match_count=min_match_count)
+        if not finest:
+            level_kwargs["ndiv"] = 1
+        if pq_tform is not None:
+            S = np.diag([s, s, 1.])
+            level_kwargs["pq_tform"] = S.dot(pq_tform).dot(np.linalg.inv(S))
+            level_kwargs["guided_search_radius"] = refine_search_radius
+
+        p, q = p_features[i], q_features[i]
+        loc_p, loc_q = match_features(
+            p.loc, p.des, q.loc, q.des, p.shape,
+            ransac_kwargs=(ransac_kwargs if finest
+                           else coarse_ransac_kwargs),
+            match_kwargs=level_kwargs, **kwargs)
+        if loc_p.shape[0] > min_match_count:
+            pq_tform = fit(loc_p[None] / s, loc_q[None] / s)[0]
+    return loc_p, loc_q, pq_tform
+
+
+# per-process cache of section features for match_section_batch
+_section_lru = LRUCache()
+
+
+def section_features(tileId, impath, args):
+    """section_pyramid_features of a section, reused from the worker's
+    cache when the section was part of an earlier pair, or from
+    feature_cache_dir when it was matched before
+    """
+    key = (tileId, tuple(impath))
+    features = _section_lru.get(key)
+    if features is None:
+        kwargs = find_matches_kwargs(args, {})
+        features = section_pyramid_features(
+            impath,
+            pyramid_scales(args['coarse_scales'], args['downsample_scale']),
+            CLAHE_grid=kwargs['CLAHE_grid'],
+            CLAHE_clip=kwargs['CLAHE_clip'],
+            sift_kwargs=kwargs['sift_kwargs'],
+            tileId=tileId,
+            feature_cache=(
+                FeatureCache(kwargs['feature_cache_dir'])
+                if kwargs['feature_cache_dir'] else None))
+        _section_lru.put(key, features)
+    return features
+
+
+def match_section_pair(fargs):
+    """match a pair of sections, returning the same list as
+    find_matches
+    """
+    [impaths, ids, gids, args] = fargs
+    kwargs = find_matches_kwargs(args, {})
+    scales = pyramid_scales(args['coarse_scales'], args['downsample_scale'])
+    p_features, q_features = [
+        section_features(tileId, impath, args)
+        for tileId, impath in zip(ids, impaths)]
+
+    loc_p, loc_q, pq_tform = coarse_to_fine_matches(
+        p_features, q_features, scales,
+        match_kwargs=kwargs['match_kwargs'],
+        ransac_kwargs=kwargs['ransac_kwargs'],
+        coarse_model=args['coarse_model'],
+        refine_search_radius=args['refine_search_radius'])
+
+    pm_dict = locs_to_dict(
+        gids[0], ids[0], loc_p,
+        gids[1], ids[1], loc_q,
+        scale_factor=(1. / scales[-1]),
+        match_max=kwargs['matchMax'],
+        match_decimation=kwargs['match_decimation'],
+        decimation_grid=kwargs['decimation_grid'],
+        decimation_prefer_low_residual=kwargs[
+            'decimation_prefer_low_residual'])
+    return [impaths, len(p_features[-1].loc), len(q_features[-1].loc),
+            len(loc_p), len(loc_p), pm_dict]
+
+
+def match_section_batch(bargs):
+    """match_section_pair for a batch of pairs sharing sections, keeping
+    the features of cache_size sections in memory
+    """
+    fargs_list, cache_size = bargs
+    _section_lru.maxsize = cache_size
+    return [match_section_pair(fargs) for fargs in fargs_list]
+
+
+def section_pairs(tilespecs, zNeighborDistance=2):
+    """tilepair json neighborPairs between the tiles of sections at most
+    zNeighborDistance apart, the lower z tile being p, ordered by z
+    """
+    tilespecs = sorted(tilespecs, key=lambda ts: (ts.z, ts.tileId))
+    pairs = []
+    for i, ts_p in enumerate(tilespecs):
+        for ts_q in tilespecs[i + 1:]:
+            if ts_q.z - ts_p.z > zNeighborDistance:
+                break
+            if ts_q.z == ts_p.z:
+                continue
+            pairs.append({
+                "p": {"groupId": ts_p.layout.sectionId, "id": ts_p.tileId},
+                "q": {"groupId": ts_q.layout.sectionId, "id": ts_q.tileId}})
+    return pairs
+
+
+def pair_batches(npairs, batch_size):
+    """consecutive ranges of pair indices as lists of at most batch_size"""
+    return [list(range(i, min(i + batch_size, npairs)))
+            for i in range(0, npairs, batch_size)]
+
+
+class GenerateSectionPointMatches(GeneratePointMatchesOpenCV):
+    default_schema = SectionPointMatchParameters
+
+    def get_section_tilespecs(self, render):
+        zs = [z for z in renderapi.stack.get_z_values_for_stack(
+                  self.args['input_stack'], render=render)
+              if self.args['minZ'] <= z <= self.args['maxZ']]
+        with concurrent.futures.ThreadPoolExecutor(
+                self.args['tilespec_concurrency']) as e:
+            tspecs = e.map(
+                lambda z: renderapi.tilespec.get_tile_specs_from_z(
+                    self.args['input_stack'], z, render=render), zs)
+            return [ts for tss in tspecs for ts in tss]
+
+    def run(self):
+        render = renderapi.connect(**self.args['render'])
+        tilespecs = None
+        if self.args['pairJson']:
+            pairs = load_pairjson(
+                self.args['pairJson'], logger=self.logger)['neighborPairs']
+        else:
+            tilespecs = self.get_section_tilespecs(render)
+            pairs = section_pairs(
+                tilespecs, self.args['zNeighborDistance'])
+
+        npairs = len(pairs)
+        if self.args['resume']:
+            pairs = self.remove_completed(render, pairs)
+        pairs_skipped = npairs - len(pairs)
+        self.logger.info(
+            "skipping %d of %d completed section pairs" % (
+                pairs_skipped, npairs))
+        if not pairs:
+            self.output_pair_counts(npairs, 0, pairs_skipped)
+            return
+
+        tpjson = {"neighborPairs": pairs}
+        unique_ids, tile_index = parse_tileids(tpjson, logger=self.logger)
+        if tilespecs is None:
+            tilespecs, _ = load_resolvedtiles(
+                render, self.args['input_stack'], unique_ids,
+                parse_tile_groupids(tpjson),
+                concurrency=self.args['tilespec_concurrency'],
+                logger=self.logger)
+        else:
+            tId_to_ts = {ts.tileId: ts for ts in tilespecs}
+            tilespecs = np.array([tId_to_ts[tid] for tid in unique_ids])
+
+        self.match_section_pairs(tilespecs, tile_index)
+        self.output_pair_counts(npairs, tile_index.shape[0], pairs_skipped)
+
+    def match_section_pairs(self, tilespecs, tile_index):
+        ncpus = self.args['ncpus']
+        if self.args['ncpus'] == -1:
+            ncpus = multiprocessing.cpu_count()
+
+        fargs = []
+        for i in range(tile_index.shape[0]):
+            ts_pair = tilespecs[tile_index[i]]
+            fargs.append([
+                [[t.ip[0].imageUrl, t.ip[0].maskUrl] for t in ts_pair],
+                [t.tileId for t in ts_pair],
+                [t.layout.sectionId for t in ts_pair],
+                self.args])
+        bargs = [[[fargs[i] for i in batch], self.args['tile_cache_size']]
+                 for batch in pair_batches(
+                     len(fargs), self.args['section_batch_size'])]
+
+        with make_match_sink(self.args) as sink:
+            with renderapi.client.WithPool(ncpus, **worker_pool_kwargs(
+                    ncpus, self.args['threads_per_worker'])) as pool:
+                for rs in pool.imap_unordered(match_section_batch, bargs):
+                    for r in rs:
+                        self.logger.debug(
+                            "%s, %s: (%d, %d) features, %d matches" % (
+                                r[0][0][0], r[0][1][0], r[1], r[2], r[3]))
+                        sink.add(r[5])
+
+
+if __name__ == "__main__":
+    mod = GenerateSectionPointMatches()
+    mod.run()
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+"""
+generate tile pairs in process from resolved tiles, writing the same
+tilepair json as TilePairClientModule without starting a java client.
+
+All sections are laid side by side along x in a single STRtree so that
+same-layer and cross-layer neighbors are found with bulk queries.
+Montage pairs can instead be found from acquisition grid positions
+(useRowColPositions), from tilespecs or directly from a TEMCA metafile.
+"""
+import concurrent.futures
+import json
+import os
+
+import numpy as np
+import renderapi
+import shapely
+
+from asap.module.render_module import RenderModule
+from asap.pointmatch.schemas import (
+    TilePairParameters, TilePairClientOutputParameters)
+from asap.pointmatch.tile_overlap import tile_grid_pts, tile_world_pts
+
+if __name__ == "__main__" and __package__ is None:
+    __package__ = "asap.pointmatch.generate_tile_pairs"
+
+
+example = {
+    "render": {
+        "host": "http://em-131fs",
+        "port": 8080,
+        "owner": "gayathri",
+        "project": "MM2",
+        "client_scripts": ""
+    },
+    "minZ": 1015,
+    "maxZ": 1022,
+    "zNeighborDistance": 0,
+    "stack": "mm2_acquire_8bit_reimage",
+    "xyNeighborFactor": 0.9,
+    "excludeCornerNeighbors": "true",
+    "excludeSameLayerNeighbors": "false",
+    "excludeCompletelyObscuredTiles": "true",
+    "pool_size": 8,
+    "output_dir": "/allen/programs/celltypes/workgroups/em-connectomics/gayathrim/nc-em2/Janelia_Pipeline/scratch/montageTilepairs"
+}
+
+OPPOSITE_POSITION = {
+    "LEFT": "RIGHT",
+    "RIGHT": "LEFT",
+    "TOP": "BOTTOM",
+    "BOTTOM": "TOP"
+}
+
+
+def tile_bounds(tilespecs, ref_tforms=None, ngrid=9):
+    """Nx4 array of world [minX, minY, maxX, maxY] of tilespecs, from
+    their stored bounds or else from a grid of transformed points
+    """
+    bounds = np.empty((len(tilespecs), 4))
+    for i, ts in enumerate(tilespecs):
+        box = (ts.minX, ts.minY, ts.maxX, ts.maxY)
+        if None not in box:
+            bounds[i] = box
+            continue
+        world = tile_world_pts(
+            ts, tile_grid_pts(ts.width, ts.height, ngrid), ref_tforms)
+        bounds[i, :2] = world.min(axis=0)
+        bounds[i, 2:] = world.max(axis=0)
+    return bounds
+
+
+def _chunked_query(tree, geoms, pool_size=1, **kwargs):
+    """STRtree query of geoms split across a thread pool, returning
+    (geom index, tree index) arrays
+    """
+    chunks = np.array_split(
+        np.arange(len(geoms)), max(1, min(pool_size * 4, len(geoms))))
+
+    def query(idx):
+        chunk_kwargs = {
+            k: (v[idx] if isinstance(v, np.ndarray) else v)
+            for k, v in kwargs.items()}
+        i, j = tree.query(geoms[idx], **chunk_kwargs)
+        return idx[i], j
+
+    if pool_size > 1 and len(chunks) > 1:
+        with concurrent.futures.ThreadPoolExecutor(pool_size) as e:
+            results = list(e.map(query, chunks))
+    else:
+        results = [query(idx) for idx in chunks]
+    return (np.concatenate([r[0] for r in results]),
+            np.concatenate([r[1] for r in results]))
+
+
+def _layered_bounds(z, bounds, pad=0.):
+    """layer index of each tile and its bounds shifted along x so that
+    layers separated by pad do not intersect, with the layer stride
+    """
+    layer_z, layer = np.unique(z, return_inverse=True)
+    stride = bounds[:, 2].max() - bounds[:, 0].min() + 2 * pad + 1.
+    shifted = bounds.copy()
+    shifted[:, [0, 2]] += (layer * stride)[:, None]
+    return layer_z, layer, shifted, stride
+
+
+def completely_obscured(z, bounds, pool_size=1):
+    """mask of tiles covered by the union of the bounds of the tiles
+    after them in the same layer, taking the given tile order as the
+    acquisition order
+    """
+    _, _, shifted, _ = _layered_bounds(z, bounds)
+    boxes = shapely.box(*shifted.T)
+    i, j = _chunked_query(
+        shapely.STRtree(boxes), boxes, pool_size, predicate="intersects")
+    later = j > i
+    i, j = i[later], j[later]
+    obscured = np.zeros(len(boxes), dtype=bool)
+    if not i.size:
+        return obscured
+    order = np.lexsort((j, i))
+    i, j = i[order], j[order]
+    starts = np.flatnonzero(np.r_[True, np.diff(i) > 0])
+    src = i[starts]
+
+    # a covered tile has its center and corners inside later tiles
+    mid = (shifted[i, :2] + shifted[i, 2:]) / 2.
+    covered = np.ones(src.size, dtype=bool)
+    for x, y in ((mid[:, 0], mid[:, 1]),
+                 (shifted[i, 0], shifted[i, 1]),
+                 (shifted[i, 0], shifted[i, 3]),
+                 (shifted[i, 2], shifted[i, 1]),
+                 (shifted[i, 2], shifted[i, 3])):
+        inside = ((x >= shifted[j, 0]) & (x <= shifted[j, 2]) &
+                  (y >= shifted[j, 1]) & (y <= shifted[j, 3]))
+        covered &= np.logical_or.reduceat(inside, starts)
+
+    ends = np.r_[starts[1:], i.size]
+    for c in np.flatnonzero(covered):
+        obscured[src[c]] = shapely.union_all(
+            boxes[j[starts[c]:ends[c]]]).covers(boxes[src[c]])
+    return obscured
+
+
+def tile_pair_indices(z, bounds, xyNeighborFactor=0.9, zNeighborDistance=2,
+                      excludeCornerNeighbors=True,
+                      excludeSameLayerNeighbors=False, pool_size=1):
+    """index pairs of neighboring tiles
+
+    Parameters
+    ----------
+    z : numpy.ndarray
+        z value of each of N tiles
+    bounds : numpy.ndarray
+        Nx4 world [minX, minY, maxX, maxY] of each tile
+    xyNeighborFactor : float
+        neighbors intersect a circle about the tile center of radius
+        xyNeighborFactor * max(width, height) of the tile
+    zNeighborDistance : int
+        neighbors are searched in layers with z up to this distance
+        above the tile's z
+    excludeCornerNeighbors : bool
+        exclude neighbors whose center is outside both the x and y range
+        of the tile
+    excludeSameLayerNeighbors : bool
+        only pair tiles from different layers
+    pool_size : int
+        number of threads querying neighbors
+
+    Returns
+    -------
+    numpy.ndarray
+        Mx2 unique pairs of tile indices, the lower index first
+    """
+    radii = xyNeighborFactor * np.max(bounds[:, 2:] - bounds[:, :2], axis=1)
+    layer_z, layer, shifted, stride = _layered_bounds(
+        z, bounds, pad=radii.max())
+    tree = shapely.STRtree(shapely.box(*shifted.T))
+    shifted_centers = (shifted[:, :2] + shifted[:, 2:]) / 2.
+    centers = (bounds[:, :2] + bounds[:, 2:]) / 2.
+
+    # number of layers above each layer within zNeighborDistance
+    max_dlayer = int(np.max(
+        np.searchsorted(layer_z, layer_z + zNeighborDistance, side="right") -
+        1 - np.arange(layer_z.size)))
+
+    pairs = []
+    for dlayer in range(1 if excludeSameLayerNeighbors else 0,
+                        max_dlayer + 1):
+        # candidates from the envelope of the search circle, kept if the
+        # tile bounds are within radius of the center
+        query_centers = shifted_centers + [dlayer * stride, 0.]
+        i, j = _chunked_query(tree, shapely.box(
+            *np.hstack([query_centers - radii[:, None],
+                        query_centers + radii[:, None]]).T), pool_size)
+        d = np.maximum(np.maximum(
+            shifted[j, :2] - query_centers[i],
+            query_centers[i] - shifted[j, 2:]), 0.)
+        keep = ((np.sum(d ** 2, axis=1) <= radii[i] ** 2) &
+                (layer[j] - layer[i] == dlayer) &
+                (z[j] - z[i] <= zNeighborDistance) & (i != j))
+        if excludeCornerNeighbors:
+            c = centers[j]
+            keep &= (((c[:, 0] >= bounds[i, 0]) & (c[:, 0] <= bounds[i, 2])) |
+                     ((c[:, 1] >= bounds[i, 1]) & (c[:, 1] <= bounds[i, 3])))
+        i, j = i[keep], j[keep]
+        pairs.append(np.minimum(i, j).astype(np.int64) * len(z) +
+                     np.maximum(i, j))
+    if not pairs:
+        return np.empty((0, 2), dtype=int)
+    keys = np.unique(np.concatenate(pairs))
+    return np.column_stack([keys // len(z), keys % len(z)])
+
+
+def relative_positions(p_bounds, q_bounds):
+    """relativePosition of p with respect to q for each row of bounds,
+    by the larger offset of their minimum corners
+    """
+    delta = p_bounds[:, :2] - q_bounds[:, :2]
+    horizontal = np.abs(delta[:, 0]) > np.abs(delta[:, 1])
+    return np.where(
+        horizontal,
+        np.where(delta[:, 0] > 0, "RIGHT", "LEFT"),
+        np.where(delta[:, 1] > 0, "BOTTOM", "TOP"))
+
+
+def neighbor_pairs(tile_ids, pair_indices, positions=None):
+    """tilepair json neighborPairs entries
+
+    Parameters
+    ----------
+    tile_ids : list of tuple
+        (groupId, id) of each tile
+    pair_indices : numpy.ndarray
+        Mx2 indices into tile_ids of p and q
+    positions : sequence, optional
+        relativePosition of p for each pair, or None to omit it
+    """
+    if positions is None:
+        positions = [None] * len(pair_indices)
+    neighborPairs = []
+    for (pi, qi), pos in zip(pair_indices, positions):
+        pair = {
+            k: {"groupId": tile_ids[i][0], "id": tile_ids[i][1]}
+            for k, i in (("p", pi), ("q", qi))}
+        if pos is not None:
+            pair["p"]["relativePosition"] = str(pos)
+            pair["q"]["relativePosition"] = OPPOSITE_POSITION[str(pos)]
+        neighborPairs.append(pair)
+    return neighborPairs
+
+
+def rowcol_pair_indices(rows, cols, z=None, excludeCornerNeighbors=True):
+    """index pairs of tiles adjacent in an acquisition grid, found by
+    hashing grid positions rather than from tile geometry
+
+    Parameters
+    ----------
+    rows, cols : sequence of int
+        imageRow and imageCol of each tile
+    z : sequence of float, optional
+        z of each tile, pairs are only formed within a z
+    excludeCornerNeighbors : bool
+        do not pair diagonally adjacent tiles
+
+    Returns
+    -------
+    pair_indices : numpy.ndarray
+        Mx2 tile indices of p and q
+    positions : numpy.ndarray
+        relativePosition of p with respect to q for each pair
+    """
+    z = [None] * len(rows) if z is None else z
+    grid = {(zi, r, c): i for i, (zi, r, c) in enumerate(zip(z, rows, cols))}
+    steps = [(0, 1, "LEFT"), (1, 0, "TOP")]
+    if not excludeCornerNeighbors:
+        steps += [(1, 1, "TOP"), (1, -1, "TOP")]
+    pairs = []
+    positions = []
+    for (zi, r, c), i in grid.items():
+        for dr, dc, position in steps:
+            j = grid.get((zi, r + dr, c + dc))
+            if j is not None:
+                pairs.append((i, j))
+                positions.append(position)
+    return np.array(pairs, dtype=int).reshape(-1, 2), np.array(positions)
+
+
+def rowcol_tile_pairs(tilespecs, excludeCornerNeighbors=True, **kwargs):
+    """same-layer neighborPairs for tilespecs from their layout imageRow
+    and imageCol
+    """
+    pair_indices, positions = rowcol_pair_indices(
+        [ts.layout.imageRow for ts in tilespecs],
+        [ts.layout.imageCol for ts in tilespecs],
+        z=[ts.z for ts in tilespecs],
+        excludeCornerNeighbors=excludeCornerNeighbors)
+    return neighbor_pairs(
+        [(ts.layout.sectionId, ts.tileId) for ts in tilespecs],
+        pair_indices, positions)
+
+
+def metafile_tile_pairs(md, z, sectionId=None, excludeCornerNeighbors=True):
+    """neighborPairs for a TEMCA metadata file from the raster_pos of
+    its images, with the tileId and sectionId conventions of
+    GenerateEMTileSpecsModule
+    """
+    sectionId = str(float(z)) if sectionId is None else sectionId
+    imgdata = md[1]['data']
+    pair_indices, positions = rowcol_pair_indices(
+        [img['img_meta']['raster_pos'][1] for img in imgdata],
+        [img['img_meta']['raster_pos'][0] for img in imgdata],
+        excludeCornerNeighbors=excludeCornerNeighbors)
+    return neighbor_pairs(
+        [(sectionId, '{bname}.{z}'.format(
+            bname=os.path.splitext(os.path.basename(img['img_path']))[0],
+            z=str(float(z)))) for img in imgdata],
+        pair_indices, positions)
+
+
+def generate_tile_pairs(tilespecs, bounds=None, ref_tforms=None,
+                        xyNeighborFactor=0.9, zNeighborDistance=2,
+                        excludeCornerNeighbors=True,
+                        excludeSameLayerNeighbors=False,
+                        excludeCompletelyObscuredTiles=True,
+                        useRowColPositions=False,
+                        pool_size=1, bounds_ngrid=9, **kwargs):
+    """neighborPairs for tilespecs from any number of layers, following
+    the options of the render TilePairClient
+
+    Parameters
+    ----------
+    tilespecs : list of renderapi.tilespec.TileSpec
+        tilespecs of all layers
+    bounds : numpy.ndarray, optional
+        Nx4 world bounds of the tilespecs, by default from tile_bounds
+    ref_tforms : list of renderapi.transform.Transform, optional
+        transforms referenced by the tilespecs
+    useRowColPositions : bool
+        for montage pairs (zNeighborDistance == 0) of tilespecs that all
+        have imageRow and imageCol, pair grid neighbors instead of
+        searching tile bounds
+
+    Returns
+    -------
+    list of dict
+        tilepair json neighborPairs
+    """
+    if not len(tilespecs):
+        return []
+    if (useRowColPositions and zNeighborDistance == 0 and
+            not excludeSameLayerNeighbors and
+            all(ts.layout.imageRow is not None and
+                ts.layout.imageCol is not None for ts in tilespecs)):
+        return rowcol_tile_pairs(
+            tilespecs, excludeCornerNeighbors=excludeCornerNeighbors)
+
+    if bounds is None:
+        bounds = tile_bounds(tilespecs, ref_tforms, ngrid=bounds_ngrid)
+    z = np.array([ts.z for ts in tilespecs], dtype=float)
+
+    # tile order within a layer stands in for acquisition order
+    order = np.lexsort(([ts.tileId for ts in tilespecs], z))
+    tilespecs = [tilespecs[i] for i in order]
+    z = z[order]
+    bounds = bounds[order]
+
+    if excludeCompletelyObscuredTiles:
+        visible = ~completely_obscured(z, bounds, pool_size)
+        tilespecs = [ts for ts, v in zip(tilespecs, visible) if v]
+        z = z[visible]
+        bounds = bounds[visible]
+
+    pair_indices = tile_pair_indices(
+        z, bounds, xyNeighborFactor=xyNeighborFactor,
+        zNeighborDistance=zNeighborDistance,
+        excludeCornerNeighbors=excludeCornerNeighbors,
+        excludeSameLayerNeighbors=excludeSameLayerNeighbors,
+        pool_size=pool_size)
+    p, q = pair_indices[:, 0], pair_indices[:, 1]
+    positions = np.where(
+        z[p] == z[q], relative_positions(bounds[p], bounds[q]), None)
+    return neighbor_pairs(
+        [(ts.layout.sectionId, ts.tileId) for ts in tilespecs],
+        pair_indices, positions)
+
+
+def render_parameters_url_template(render, stack):
+    return (
+        "{baseDataUrl}/owner/%s/project/%s/stack/%s"
+        "/tile/{id}/render-parameters" % (
+            render.DEFAULT_OWNER, render.DEFAULT_PROJECT, stack))
+
+
+class TilePairModule(RenderModule):
+    default_schema = TilePairParameters
+    default_output_schema = TilePairClientOutputParameters
+
+    def get_resolved_tiles(self, zvalues):
+        """tilespecs and shared transforms of the stack for zvalues,
+        fetched concurrently
+        """
+        def get_z(z):
+            return renderapi.resolvedtiles.get_resolved_tiles_from_z(
+                self.args['stack'], z, render=self.render)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                self.args['pool_size']) as e:
+            resolved = list(e.map(get_z, zvalues))
+
+        tilespecs = [ts for rts in resolved for ts in rts.tilespecs]
+        ref_tforms = list({
+            tform.transformId: tform for rts in resolved
+            for tform in rts.transforms}.values())
+        return tilespecs, ref_tforms
+
+    def run(self):
+        zvalues = self.render.run(
+            renderapi.stack.get_z_values_for_stack, self.args['stack'])
+
+        if self.args['minZ'] is not None:
+            self.args['minZ'] = max(self.args['minZ'], min(zvalues))
+        else:
+            self.args['minZ'] = min(zvalues)
+
+        if self.args['maxZ'] is not None:
+            self.args['maxZ'] = min(self.args['maxZ'], max(zvalues))
+        else:
+            self.args['maxZ'] = max(zvalues)
+
+        tilepairJsonFile = os.path.join(
+            self.args['output_dir'],
+            "tile_pairs_%s_z_%d_to_%d_dist_%d.json" % (
+                self.args['stack'], self.args['minZ'], self.args['maxZ'],
+                self.args['zNeighborDistance']))
+
+        tilespecs, ref_tforms = self.get_resolved_tiles(
+            [z for z in zvalues
+             if self.args['minZ'] <= z <= self.args['maxZ']])
+        neighborPairs = generate_tile_pairs(
+            tilespecs, ref_tforms=ref_tforms, **self.args)
+        self.logger.info("found {} tile pairs among {} tiles".format(
+            len(neighborPairs), len(tilespecs)))
+
+        with open(tilepairJsonFile, 'w') as f:
+            json.dump({
+                "renderParametersUrlTemplate": render_parameters_url_template(
+                    self.render, self.args['baseStack']),
+                "neighborPairs": neighborPairs}, f, indent=2)
+
+        self.output({'tile_pair_file': tilepairJsonFile})
+
+
+if __name__ == "__main__":
+    module = TilePairModule()
+    module.run()
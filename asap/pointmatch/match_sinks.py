@@ -0,0 +1,228 @@
+"""
+buffered destinations for point matches produced pair by pair, flushing
+in batches through a persistent render session or to a local
+JSON lines file that can be bulk imported later
+"""
+import gzip
+import json
+import os
+
+import renderapi
+
+
+class MatchSink(object):
+    """buffer point match dictionaries and write them in batches of at
+    most batch_size matches or batch_bytes of serialized json
+    """
+    def __init__(self, batch_size=100, batch_bytes=None, journal=None):
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.journal = journal
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.count = 0
+
+    def add(self, pm):
+        if pm is None:
+            return
+        self.buffer.append(pm)
+        if self.batch_bytes is not None:
+            self.buffer_bytes += len(json.dumps(pm))
+        if ((self.batch_size is not None and
+                len(self.buffer) >= self.batch_size) or
+                (self.batch_bytes is not None and
+                 self.buffer_bytes >= self.batch_bytes)):
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.write(self.buffer)
+            self.count += len(self.buffer)
+            if self.journal is not None:
+                self.journal.record(self.buffer)
+        self.buffer = []
+        self.buffer_bytes = 0
+
+    def write(self, matches):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+        if self.journal is not None:
+            self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RenderMatchSink(MatchSink):
+    """import batches of matches to a render match collection, reusing
+    the keep-alive session of a renderapi.render.Render
+    """
+    def __init__(self, render, match_collection, **kwargs):
+        super(RenderMatchSink, self).__init__(**kwargs)
+        self.render = render
+        self.match_collection = match_collection
+
+    def write(self, matches):
+        renderapi.pointmatch.import_matches(
+            self.match_collection, matches, render=self.render)
+
+
+def _open_text(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+
+def iter_complete_lines(path):
+    """lines of a (optionally gzipped) text file, skipping a last line
+    or gzip stream left incomplete by an interrupted run
+    """
+    try:
+        with _open_text(path, 'r') as f:
+            for line in f:
+                if line.endswith('\n'):
+                    yield line
+    except EOFError:
+        return
+
+
+def _gzip_complete(path):
+    last = b''
+    try:
+        with gzip.open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                last = chunk
+    except EOFError:
+        return False
+    return last.endswith(b'\n') or not last
+
+
+def trim_incomplete_line(path):
+    """drop an incomplete last line from a (optionally gzipped) json
+    lines file, so that appended lines start on a line of their own
+    """
+    if not os.path.isfile(path):
+        return
+    if not path.endswith('.gz'):
+        with open(path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+    elif not _gzip_complete(path):
+        tmpfn = path + '.tmp'
+        with gzip.open(tmpfn, 'wt') as f:
+            f.writelines(iter_complete_lines(path))
+        os.replace(tmpfn, path)
+
+
+class JsonLinesMatchSink(MatchSink):
+    """append matches to a (optionally gzipped) file with one point
+    match json object per line
+    """
+    def __init__(self, path, **kwargs):
+        super(JsonLinesMatchSink, self).__init__(**kwargs)
+        self.path = path
+        trim_incomplete_line(path)
+        self.f = _open_text(path, 'a')
+
+    def write(self, matches):
+        self.f.write(''.join(json.dumps(pm) + '\n' for pm in matches))
+        self.f.flush()
+
+    def close(self):
+        super(JsonLinesMatchSink, self).close()
+        self.f.close()
+
+
+def pair_key(pGroupId, pId, qGroupId, qId):
+    """order-independent key for a tile pair"""
+    return tuple(sorted([(pGroupId, pId), (qGroupId, qId)]))
+
+
+def match_pair_key(pm):
+    return pair_key(pm['pGroupId'], pm['pId'], pm['qGroupId'], pm['qId'])
+
+
+class CompletionJournal(object):
+    """json lines record of the tile pairs whose matches have been
+    written, used to resume an interrupted run
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def completed(self):
+        if not os.path.isfile(self.path):
+            return set()
+        return {tuple(tuple(t) for t in json.loads(line))
+                for line in iter_complete_lines(self.path) if line.strip()}
+
+    def record(self, matches):
+        if self.f is None:
+            trim_incomplete_line(self.path)
+            self.f = _open_text(self.path, 'a')
+        self.f.write(''.join(
+            json.dumps(match_pair_key(pm)) + '\n' for pm in matches))
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class PairTierLog(object):
+    """json lines record of the escalation tier at which each tile pair
+    was matched
+    """
+    def __init__(self, path):
+        trim_incomplete_line(path)
+        self.f = _open_text(path, 'a')
+
+    def record(self, pm, tier, num_matches):
+        if pm is None:
+            return
+        self.f.write(json.dumps({
+            "pGroupId": pm['pGroupId'], "pId": pm['pId'],
+            "qGroupId": pm['qGroupId'], "qId": pm['qId'],
+            "tier": tier, "matches": num_matches}) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def iter_matches_jsonl(path):
+    for line in iter_complete_lines(path):
+        if line.strip():
+            yield json.loads(line)
+
+
+def import_matches_jsonl(path, match_collection, render, batch_size=1000,
+                         **kwargs):
+    """bulk import a JSON lines match file written by JsonLinesMatchSink"""
+    with RenderMatchSink(render, match_collection,
+                         batch_size=batch_size, **kwargs) as sink:
+        for pm in iter_matches_jsonl(path):
+            sink.add(pm)
+    return sink.count
+
+
+def make_match_sink(args, render=None):
+    """sink configured by the match_sink options of
+    OpenCVMatchingParameters
+    """
+    batch_kwargs = dict(
+        batch_size=args['match_batch_size'],
+        batch_bytes=args['match_batch_bytes'],
+        journal=(CompletionJournal(args['completion_journal'])
+                 if args['completion_journal'] else None))
+    if args['match_sink'] == 'jsonl':
+        return JsonLinesMatchSink(args['match_output_file'], **batch_kwargs)
+    render = render or renderapi.connect(**args['render'])
+    return RenderMatchSink(render, args['match_collection'], **batch_kwargs)
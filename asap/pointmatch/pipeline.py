@@ -0,0 +1,106 @@
+"""
+staged execution of tile pair work: an I/O thread pool reading and
+decoding images, a process pool computing features and matches, and a
+writer thread consuming results, connected by bounded queues so that
+I/O overlaps computation without unbounded prefetching
+"""
+import concurrent.futures
+import queue
+import threading
+
+
+class StagedPipeline(object):
+    """run read_func in io_threads threads, match_func on its results in
+    a pool of ncpus processes and write_func on those results in a
+    single writer thread.
+
+    Parameters
+    ----------
+    read_func : callable
+        I/O stage, called with each work item
+    match_func : callable
+        picklable compute stage, called with the output of read_func
+    write_func : callable
+        output stage, called with the output of match_func
+    io_threads : int
+        number of I/O threads
+    ncpus : int
+        number of compute processes
+    max_in_flight : int, optional
+        maximum number of items read or being matched at once, default
+        2 * ncpus + io_threads
+    writer_queue_size : int
+        maximum number of results waiting for write_func
+    pool_kwargs : dict, optional
+        keyword arguments for concurrent.futures.ProcessPoolExecutor
+    """
+    def __init__(self, read_func, match_func, write_func,
+                 io_threads=4, ncpus=1, max_in_flight=None,
+                 writer_queue_size=64, pool_kwargs=None):
+        self.read_func = read_func
+        self.match_func = match_func
+        self.write_func = write_func
+        self.io_threads = io_threads
+        self.ncpus = ncpus
+        self.max_in_flight = max_in_flight or (2 * ncpus + io_threads)
+        self.writer_queue_size = writer_queue_size
+        self.pool_kwargs = pool_kwargs or {}
+
+    def _write_loop(self, q, errors):
+        while True:
+            r = q.get()
+            if r is StopIteration:
+                return
+            if errors:
+                continue
+            try:
+                self.write_func(r)
+            except Exception as e:
+                errors.append(e)
+
+    def run(self, items):
+        items = iter(items)
+        write_queue = queue.Queue(maxsize=self.writer_queue_size)
+        write_errors = []
+        writer = threading.Thread(
+            target=self._write_loop, args=(write_queue, write_errors))
+        writer.start()
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    self.io_threads) as io_ex, \
+                    concurrent.futures.ProcessPoolExecutor(
+                        self.ncpus, **self.pool_kwargs) as cpu_ex:
+                reading = set()
+                matching = set()
+
+                def fill():
+                    while len(reading) + len(matching) < self.max_in_flight:
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            return
+                        reading.add(io_ex.submit(self.read_func, item))
+
+                fill()
+                while reading or matching:
+                    done, _ = concurrent.futures.wait(
+                        reading | matching,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for fut in done:
+                        if fut in reading:
+                            reading.remove(fut)
+                            matching.add(
+                                cpu_ex.submit(self.match_func, fut.result()))
+                        else:
+                            matching.remove(fut)
+                            # blocks while the writer is behind
+                            write_queue.put(fut.result())
+                    if write_errors:
+                        raise write_errors[0]
+                    fill()
+        finally:
+            write_queue.put(StopIteration)
+            writer.join()
+        if write_errors:
+            raise write_errors[0]
@@ -0,0 +1,241 @@
+"""
+robust fitting of 2D transforms to point matches.  Models are named as
+in RegisterSubvolumeModule.transform_classes, plus HOMOGRAPHY.
+Hypotheses from minimal samples are generated and scored in batches with
+numpy, and opencv RANSAC/USAC estimators are used for the models opencv
+provides.
+"""
+import cv2
+import numpy as np
+
+MIN_SAMPLES = {
+    "TRANSLATION": 1,
+    "RIGID": 2,
+    "SIMILARITY": 2,
+    "AFFINE": 3,
+    "HOMOGRAPHY": 4
+}
+TRANSFORM_MODELS = list(MIN_SAMPLES)
+ROBUST_METHODS = [
+    "RANSAC", "VECTORIZED", "USAC_DEFAULT", "USAC_FAST", "USAC_ACCURATE",
+    "USAC_PROSAC", "USAC_MAGSAC"]
+
+
+def _matrices(A, t):
+    """Bx3x3 matrices from Bx2x2 linear parts and Bx2 translations"""
+    M = np.zeros((A.shape[0], 3, 3))
+    M[:, :2, :2] = A
+    M[:, :2, 2] = t
+    M[:, 2, 2] = 1.
+    return M
+
+
+def fit_translation(src, dst):
+    """least squares translations for BxNx2 src and dst"""
+    return _matrices(
+        np.broadcast_to(np.eye(2), (src.shape[0], 2, 2)),
+        (dst - src).mean(axis=1))
+
+
+def fit_similarity(src, dst, rigid=False):
+    """least squares similarity (or rigid) transforms for BxNx2 src and
+    dst, solved as a complex scaled rotation
+    """
+    zs = src[..., 0] + 1j * src[..., 1]
+    zd = dst[..., 0] + 1j * dst[..., 1]
+    ms = zs.mean(axis=1, keepdims=True)
+    md = zd.mean(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a = ((np.conj(zs - ms) * (zd - md)).sum(axis=1) /
+             (np.abs(zs - ms) ** 2).sum(axis=1))
+        if rigid:
+            a = a / np.abs(a)
+    t = md[:, 0] - a * ms[:, 0]
+    A = np.stack([np.stack([a.real, -a.imag], axis=-1),
+                  np.stack([a.imag, a.real], axis=-1)], axis=1)
+    return _matrices(A, np.stack([t.real, t.imag], axis=-1))
+
+
+def fit_affine_batch(src, dst):
+    """least squares affine transforms for BxNx2 src and dst"""
+    X = np.concatenate([src, np.ones(src.shape[:2] + (1,))], axis=-1)
+    P = np.matmul(np.linalg.pinv(X), dst)
+    return _matrices(np.swapaxes(P[:, :2], 1, 2), P[:, 2])
+
+
+def fit_homography_batch(src, dst):
+    """homographies for BxNx2 src and dst by the direct linear
+    transform with h33 = 1
+    """
+    B, N = src.shape[:2]
+    x, y = src[..., 0], src[..., 1]
+    u, v = dst[..., 0], dst[..., 1]
+    zero = np.zeros_like(x)
+    one = np.ones_like(x)
+    rows_u = np.stack([x, y, one, zero, zero, zero, -u * x, -u * y], -1)
+    rows_v = np.stack([zero, zero, zero, x, y, one, -v * x, -v * y], -1)
+    A = np.concatenate([rows_u, rows_v], axis=1)
+    b = np.concatenate([u, v], axis=1)[..., None]
+    h = np.matmul(np.linalg.pinv(A), b)[..., 0]
+    return np.concatenate([h, np.ones((B, 1))], axis=1).reshape(B, 3, 3)
+
+
+MODEL_FITS = {
+    "TRANSLATION": fit_translation,
+    "RIGID": lambda src, dst: fit_similarity(src, dst, rigid=True),
+    "SIMILARITY": fit_similarity,
+    "AFFINE": fit_affine_batch,
+    "HOMOGRAPHY": fit_homography_batch
+}
+
+
+def transfer_errors(M, src, dst):
+    """BxN distances of dst from Nx2 src mapped by B 3x3 matrices M"""
+    x, y = src[:, 0], src[:, 1]
+    M = M[..., None]
+    u = M[:, 0, 0] * x + M[:, 0, 1] * y + M[:, 0, 2]
+    v = M[:, 1, 0] * x + M[:, 1, 1] * y + M[:, 1, 2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if np.any(M[:, 2, :2]) or np.any(M[:, 2, 2] != 1.):
+            w = M[:, 2, 0] * x + M[:, 2, 1] * y + M[:, 2, 2]
+            u /= w
+            v /= w
+        err = np.sqrt((u - dst[:, 0]) ** 2 + (v - dst[:, 1]) ** 2)
+    return np.where(np.isfinite(err), err, np.inf)
+
+
+def vectorized_ransac(src, dst, model="AFFINE", threshold=5.0,
+                      max_iter=2000, confidence=0.995, batch_size=64,
+                      seed=0):
+    """robust fit of model to matches, scoring batches of minimal sample
+    hypotheses at once by truncated squared error (MSAC), stopping once
+    enough hypotheses have been tried for the inlier ratio found, then
+    refitting to the inliers
+
+    Parameters
+    ----------
+    src, dst : numpy.ndarray
+        Nx2 matched points
+    model : str
+        one of TRANSFORM_MODELS
+    threshold : float
+        maximum transfer error of an inlier
+    max_iter : int
+        maximum number of hypotheses
+    confidence : float
+        probability of having drawn an all-inlier sample when stopping
+    batch_size : int
+        number of hypotheses scored together
+    seed : int
+        seed of the sampling random generator
+
+    Returns
+    -------
+    M : numpy.ndarray or None
+        3x3 transform matrix mapping src to dst
+    inliers : numpy.ndarray
+        boolean mask of inlier matches
+    """
+    src = np.asarray(src, dtype=float)
+    dst = np.asarray(dst, dtype=float)
+    n = src.shape[0]
+    m = MIN_SAMPLES[model]
+    fit = MODEL_FITS[model]
+    if n < m:
+        return None, np.zeros(n, dtype=bool)
+
+    rng = np.random.default_rng(seed)
+    best_M = None
+    best_cost = np.inf
+    best_count = 0
+    needed = max_iter
+    it = 0
+    while it < min(needed, max_iter):
+        b = min(batch_size, max_iter - it)
+        samples = rng.integers(0, n, size=(b, m))
+        M = fit(src[samples], dst[samples])
+        err = transfer_errors(M, src, dst)
+        cost = (np.minimum(err, threshold) ** 2).sum(axis=1)
+        i = int(np.argmin(cost))
+        if cost[i] < best_cost:
+            best_cost = cost[i]
+            best_M = M[i]
+            best_count = int((err[i] < threshold).sum())
+        it += b
+
+        w = best_count / float(n)
+        if w >= 1.:
+            break
+        if w > 0:
+            needed = np.log(1. - confidence) / np.log(1. - w ** m)
+
+    if best_M is None:
+        return None, np.zeros(n, dtype=bool)
+    inliers = transfer_errors(best_M[None], src, dst)[0] < threshold
+
+    # local optimization: refit on all inliers while that helps
+    if inliers.sum() > m:
+        refit = fit(src[None, inliers], dst[None, inliers])
+        refit_inliers = transfer_errors(refit, src, dst)[0] < threshold
+        if refit_inliers.sum() >= inliers.sum():
+            best_M, inliers = refit[0], refit_inliers
+    return best_M, inliers
+
+
+def _cv2_method(method):
+    return getattr(cv2, method, None)
+
+
+def cv2_robust_fit(src, dst, model="HOMOGRAPHY", method="RANSAC",
+                   threshold=5.0, max_iter=2000, confidence=0.995):
+    """robust fit with an opencv estimator, returning (M, inliers) as
+    vectorized_ransac, or None if opencv has no estimator for the model
+    and method
+    """
+    flag = _cv2_method(method)
+    if flag is None or model not in ("HOMOGRAPHY", "AFFINE", "SIMILARITY"):
+        return None
+    # estimateAffinePartial2D only implements RANSAC and LMEDS
+    if model == "SIMILARITY" and method not in ("RANSAC", "LMEDS"):
+        return None
+    src = np.asarray(src, dtype=np.float32).reshape(-1, 1, 2)
+    dst = np.asarray(dst, dtype=np.float32).reshape(-1, 1, 2)
+    if model == "HOMOGRAPHY":
+        M, mask = cv2.findHomography(
+            src, dst, flag, threshold,
+            maxIters=max_iter, confidence=confidence)
+    else:
+        estimate = (cv2.estimateAffine2D if model == "AFFINE"
+                    else cv2.estimateAffinePartial2D)
+        M, mask = estimate(
+            src, dst, method=flag, ransacReprojThreshold=threshold,
+            maxIters=max_iter, confidence=confidence)
+        if M is not None:
+            M = np.vstack([M, [0., 0., 1.]])
+    if mask is None:
+        return None, np.zeros(src.shape[0], dtype=bool)
+    return M, mask.ravel().astype(bool)
+
+
+def robust_fit(src, dst, model="HOMOGRAPHY", method="RANSAC",
+               threshold=5.0, max_iter=2000, confidence=0.995, **kwargs):
+    """robust fit of model to Nx2 matches src, dst with method, one of
+    ROBUST_METHODS.  "VECTORIZED", and any model or method opencv does
+    not provide, uses vectorized_ransac.
+
+    Returns
+    -------
+    M : numpy.ndarray or None
+        3x3 transform matrix mapping src to dst
+    inliers : numpy.ndarray
+        boolean mask of inlier matches
+    """
+    if method != "VECTORIZED":
+        result = cv2_robust_fit(
+            src, dst, model=model, method=method, threshold=threshold,
+            max_iter=max_iter, confidence=confidence)
+        if result is not None:
+            return result
+    return vectorized_ransac(
+        src, dst, model=model, threshold=threshold, max_iter=max_iter,
+        confidence=confidence, **kwargs)
@@ -0,0 +1,94 @@
+"""
+tile-affinity scheduling of tile pairs: order pairs in spatially compact
+strips and split them into batches, so that a worker processing a batch
+sees each tile several times and can reuse it from a bounded cache
+"""
+import collections
+
+import numpy as np
+import renderapi
+
+
+class LRUCache(object):
+    """bounded mapping discarding the least recently used entries"""
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.store = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            self.store.move_to_end(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.store[key]
+
+    def put(self, key, value):
+        self.store[key] = value
+        self.store.move_to_end(key)
+        while len(self.store) > self.maxsize:
+            self.store.popitem(last=False)
+
+
+def tile_centers(tilespecs, ref_tforms=None):
+    """world (x, y) centers of tilespecs from their transforms, falling
+    back to layout stage positions, and nan if neither is available
+    """
+    centers = np.full((len(tilespecs), 2), np.nan)
+    for i, ts in enumerate(tilespecs):
+        try:
+            centers[i] = renderapi.transform.estimate_dstpts(
+                ts.tforms,
+                src=np.array([[ts.width / 2., ts.height / 2.]]),
+                reference_tforms=ref_tforms)[0]
+        except (renderapi.errors.RenderError, NotImplementedError,
+                TypeError):
+            stage = (ts.layout.stageX, ts.layout.stageY)
+            if None not in stage:
+                centers[i] = stage
+    return centers
+
+
+def strip_order(pair_centers, strip_height):
+    """order of pairs walking strips of strip_height along y, serpentine
+    in x so consecutive strips meet at the same end
+    """
+    strip = np.floor(
+        (pair_centers[:, 1] - np.nanmin(pair_centers[:, 1])) / strip_height)
+    x = np.where(strip % 2, -pair_centers[:, 0], pair_centers[:, 0])
+    return np.lexsort((x, strip))
+
+
+def partition_pairs(tile_index, centers, batch_size=64, strip_height=None):
+    """split pair indices into batches of spatially adjacent pairs
+
+    Parameters
+    ----------
+    tile_index : numpy.ndarray
+        Nx2 array of indices into centers for the tiles of each pair
+    centers : numpy.ndarray
+        Mx2 array of tile centers, possibly nan if unknown
+    batch_size : int
+        number of pairs per batch
+    strip_height : float, optional
+        height of the strips pairs are ordered in, by default the median
+        distance between the tiles of a pair
+
+    Returns
+    -------
+    list of numpy.ndarray
+        indices into tile_index for each batch
+    """
+    npairs = tile_index.shape[0]
+    pair_centers = centers[tile_index].mean(axis=1)
+    if np.isnan(pair_centers).any():
+        order = np.arange(npairs)
+    else:
+        if strip_height is None:
+            strip_height = np.median(np.linalg.norm(
+                np.diff(centers[tile_index], axis=1)[:, 0], axis=1)) or 1.
+        order = strip_order(pair_centers, strip_height)
+    return [order[i:i + batch_size] for i in range(0, npairs, batch_size)]
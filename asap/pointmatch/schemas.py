@@ -5,8 +5,9 @@ import marshmallow as mm
 import argschema
 from marshmallow import post_load
 from asap.module.schemas import (
-    RenderParameters, FeatureExtractionParameters, FeatureRenderParameters,
-    FeatureStorageParameters, MatchDerivationParameters,
+    RenderParameters, ProcessPoolParameters, FeatureExtractionParameters,
+    FeatureRenderParameters, FeatureStorageParameters,
+    MatchDerivationParameters,
     RenderParametersMatchWebServiceParameters, SparkOptions, SparkParameters,
     FeatureRenderClipParameters)
 
@@ -86,6 +87,21 @@ class TilePairClientParameters(RenderParameters):
             data['baseStack'] = data['stack']
 
 
+class TilePairParameters(TilePairClientParameters):
+    pool_size = Int(
+        required=False,
+        default=8,
+        missing=8,
+        description="number of threads used to fetch resolved tiles "
+        "and to query tile neighbors across z")
+    bounds_ngrid = Int(
+        required=False,
+        default=9,
+        missing=9,
+        description="grid points per tile edge used to estimate the "
+        "world bounds of tilespecs without minX/minY/maxX/maxY")
+
+
 class SIFTPointMatchParameters(
         argschema.ArgSchema,
         FeatureExtractionParameters, FeatureRenderParameters,
@@ -117,6 +133,17 @@ class PointMatchClientOutputSchema(mm.Schema):
     pairCount = Int(
         required=True,
         description="number of tile pairs in collection")
+    pairsComputed = Int(
+        required=False,
+        description="number of tile pairs matched by this run")
+    pairsSkipped = Int(
+        required=False,
+        description="number of tile pairs skipped as already matched")
+    pairsPerTier = List(
+        Int,
+        required=False,
+        description="number of tile pairs matched at each escalation "
+        "tier, the last being the module settings")
 
 
 class PointMatchClientParametersQsub(
@@ -152,7 +179,38 @@ class PointMatchClientParametersQsub(
     )
 
 
-class PointMatchOpenCVParameters(RenderParameters):
+class EscalationTier(DefaultSchema):
+    downsample_scale = Float(
+        required=False,
+        default=None,
+        missing=None,
+        description="downsample_scale at this tier")
+    SIFT_nfeature = Int(
+        required=False,
+        default=None,
+        missing=None,
+        description="SIFT_nfeature at this tier")
+    ORB_nfeature = Int(
+        required=False,
+        default=None,
+        missing=None,
+        description="ORB_nfeature at this tier")
+    ndiv = Int(
+        required=False,
+        default=None,
+        missing=None,
+        description="ndiv at this tier")
+    FLANN_ncheck = Int(
+        required=False,
+        default=None,
+        missing=None,
+        description="FLANN_ncheck at this tier")
+
+
+class OpenCVMatchingParameters(RenderParameters):
+    """feature extraction, matching and match output options shared by
+    the opencv point match modules
+    """
     ndiv = Int(
         required=False,
         default=8,
@@ -165,6 +223,27 @@ class PointMatchOpenCVParameters(RenderParameters):
         missing=1000,
         description="per tile pair limit, randomly "
         "chosen after SIFT and RANSAC")
+    match_decimation = Str(
+        required=False,
+        default="random",
+        missing="random",
+        validator=mm.validate.OneOf(["random", "stratified"]),
+        description="how matches beyond matchMax are dropped: uniformly "
+        "at random ('random') or evenly across a grid of bins over the "
+        "matched region ('stratified')")
+    decimation_grid = Int(
+        required=False,
+        default=16,
+        missing=16,
+        description="number of bins along each axis for stratified "
+        "decimation")
+    decimation_prefer_low_residual = Bool(
+        required=False,
+        default=False,
+        missing=False,
+        description="within each stratified decimation bin keep the "
+        "matches with the lowest residual from an affine fit to all "
+        "matches rather than a random selection")
     downsample_scale = Float(
         required=False,
         default=0.3,
@@ -185,12 +264,81 @@ class PointMatchOpenCVParameters(RenderParameters):
         default=1.5,
         missing=1.5,
         description="passed to cv2.xfeatures2d.SIFT_create(sigma=)")
+    detector = Str(
+        required=False,
+        default="SIFT",
+        missing="SIFT",
+        validator=mm.validate.OneOf(["SIFT", "ORB", "AKAZE"]),
+        description="feature detector and descriptor. ORB and AKAZE "
+        "produce binary descriptors matched by Hamming distance")
+    ORB_nfeature = Int(
+        required=False,
+        default=20000,
+        missing=20000,
+        description="passed to cv2.ORB_create(nfeatures=)")
+    AKAZE_threshold = Float(
+        required=False,
+        default=0.001,
+        missing=0.001,
+        description="passed to cv2.AKAZE_create(threshold=)")
+    binary_matcher = Str(
+        required=False,
+        default="LSH",
+        missing="LSH",
+        validator=mm.validate.OneOf(["LSH", "BF"]),
+        description="approximate FLANN LSH index ('LSH') or exact brute "
+        "force ('BF') Hamming matching of binary descriptors")
+    LSH_table_number = Int(
+        required=False,
+        default=6,
+        missing=6,
+        description="number of hash tables of the FLANN LSH index")
+    LSH_key_size = Int(
+        required=False,
+        default=12,
+        missing=12,
+        description="hash key bits of the FLANN LSH index")
+    LSH_multi_probe_level = Int(
+        required=False,
+        default=1,
+        missing=1,
+        description="neighboring buckets probed by the FLANN LSH index")
     RANSAC_outlier = Float(
         required=False,
         default=5.0,
         missing=5.0,
         description="passed to cv2."
         "findHomography(src, dst, cv2.RANSAC, outlier)")
+    RANSAC_model = Str(
+        required=False,
+        default="HOMOGRAPHY",
+        missing="HOMOGRAPHY",
+        validator=mm.validate.OneOf(
+            ["TRANSLATION", "RIGID", "SIMILARITY", "AFFINE", "HOMOGRAPHY"]),
+        description="transform model fit robustly to the matches of "
+        "each chunk.  Lower degree of freedom models need fewer "
+        "hypotheses")
+    RANSAC_method = Str(
+        required=False,
+        default="RANSAC",
+        missing="RANSAC",
+        validator=mm.validate.OneOf([
+            "RANSAC", "VECTORIZED", "USAC_DEFAULT", "USAC_FAST",
+            "USAC_ACCURATE", "USAC_PROSAC", "USAC_MAGSAC"]),
+        description="robust estimator: opencv RANSAC for HOMOGRAPHY, "
+        "AFFINE and SIMILARITY, opencv USAC variants for HOMOGRAPHY and "
+        "AFFINE, or numpy hypothesis batches ('VECTORIZED'), which are "
+        "also used for the models and methods opencv does not provide")
+    RANSAC_max_iter = Int(
+        required=False,
+        default=2000,
+        missing=2000,
+        description="maximum number of robust estimator hypotheses")
+    RANSAC_confidence = Float(
+        required=False,
+        default=0.995,
+        missing=0.995,
+        description="robust estimator confidence")
     FLANN_ntree = Int(
         required=False,
         default=5,
@@ -230,9 +378,500 @@ class PointMatchOpenCVParameters(RenderParameters):
         default=-1,
         missing=-1,
         description="number of CPUs to use")
+    threads_per_worker = Int(
+        required=False,
+        default=None,
+        missing=None,
+        description="threads opencv, OpenMP and BLAS may use in each "
+        "worker process.  By default the cpus are shared equally "
+        "between the ncpus workers, and 0 leaves the libraries' own "
+        "defaults")
+    feature_cache_dir = Str(
+        required=False,
+        default=None,
+        missing=None,
+        description="directory in which to store per-tile keypoints and "
+        "descriptors so they are computed once per tile (or section) "
+        "rather than once per pair and reused by later runs")
+    guided_max_candidates = Int(
+        required=False,
+        default=32,
+        missing=32,
+        description="maximum number of spatially nearest q keypoints "
+        "compared by descriptor in guided matching")
+    tilespec_concurrency = Int(
+        required=False,
+        default=8,
+        missing=8,
+        description="number of concurrent requests used to fetch the "
+        "resolved tiles of the sections in pairJson")
+    tile_cache_size = Int(
+        required=False,
+        default=32,
+        missing=32,
+        description="number of tiles' (or sections') features each "
+        "worker keeps in memory between the pairs of its batches, with "
+        "tile_affinity for tile pairs")
+    resume = Bool(
+        required=False,
+        default=False,
+        missing=False,
+        description="skip tile pairs that already have matches in "
+        "match_collection or are recorded in completion_journal")
+    completion_journal = Str(
+        required=False,
+        default=None,
+        missing=None,
+        description="json lines file recording each tile pair once its "
+        "matches are written, read back when resuming")
+    match_sink = Str(
+        required=False,
+        default="render",
+        missing="render",
+        validator=mm.validate.OneOf(["render", "jsonl"]),
+        description="write matches to match_collection through render "
+        "('render') or to match_output_file as json lines ('jsonl') "
+        "for a later bulk import")
+    match_output_file = Str(
+        required=False,
+        default=None,
+        missing=None,
+        description="json lines file (optionally .gz) to which matches "
+        "are appended when match_sink is 'jsonl'")
+    match_batch_size = Int(
+        required=False,
+        default=100,
+        missing=100,
+        description="number of tile pairs buffered before matches are "
+        "written")
+    match_batch_bytes = Int(
+        required=False,
+        default=None,
+        missing=None,
+        description="approximate size in bytes of serialized matches "
+        "buffered before they are written")
+
+    @post_load
+    def validate_match_sink(self, data):
+        if (data['match_sink'] == 'jsonl' and
+                data['match_output_file'] is None):
+            raise mm.ValidationError(
+                "match_output_file is required for match_sink 'jsonl'")
+
+
+class PointMatchOpenCVParameters(OpenCVMatchingParameters):
+    restrict_to_overlap = Bool(
+        required=False,
+        default=False,
+        missing=False,
+        description="only extract and match features in the region of "
+        "each tile predicted to overlap its pair, using tilespec "
+        "transforms or, failing that, the tilepair relativePosition")
+    overlap_margin = Float(
+        required=False,
+        default=100.0,
+        missing=100.0,
+        description="full resolution pixels added around the predicted "
+        "overlap region when restrict_to_overlap is set")
+    overlap_fraction = Float(
+        required=False,
+        default=0.15,
+        missing=0.15,
+        description="fraction of the tile width or height taken as the "
+        "overlap when it is predicted from relativePosition")
+    guided_matching = Bool(
+        required=False,
+        default=False,
+        missing=False,
+        description="match each p keypoint only against q keypoints "
+        "near its location predicted by the tilespec transforms")
+    guided_search_radius = Float(
+        required=False,
+        default=200.0,
+        missing=200.0,
+        description="full resolution search radius around the predicted "
+        "location of a p keypoint in guided matching")
+    use_mipmap_levels = Bool(
+        required=False,
+        default=False,
+        missing=False,
+        description="read the coarsest mipmap level of each tile with "
+        "resolution at or above downsample_scale and only resize by the "
+        "remaining factor, rather than reading level 0")
+    pipeline = Bool(
+        required=False,
+        default=False,
+        missing=False,
+        description="overlap image reads, feature extraction/matching and "
+        "match writing in separate stages connected by bounded queues")
+    io_threads = Int(
+        required=False,
+        default=4,
+        missing=4,
+        description="number of threads reading and preprocessing images "
+        "when pipeline is set")
+    pipeline_max_in_flight = Int(
+        required=False,
+        default=None,
+        missing=None,
+        description="maximum number of tile pairs read or being matched "
+        "at once when pipeline is set (default 2 * ncpus + io_threads)")
+    writer_queue_size = Int(
+        required=False,
+        default=64,
+        missing=64,
+        description="maximum number of matched pairs waiting to be "
+        "written when pipeline is set")
+    tile_affinity = Bool(
+        required=False,
+        default=False,
+        missing=False,
+        description="order tile pairs in spatially compact strips and "
+        "give each worker batches of adjacent pairs, reusing the features "
+        "of tiles shared within a batch. With restrict_to_overlap, "
+        "features of a tile are extracted from the bounding box of its "
+        "overlap regions with all its pairs")
+    affinity_batch_size = Int(
+        required=False,
+        default=64,
+        missing=64,
+        description="number of tile pairs per batch with tile_affinity")
+    escalation_tiers = List(
+        Nested(EscalationTier),
+        required=False,
+        default=[],
+        missing=[],
+        cli_as_single_argument=True,
+        description="cheaper settings, cheapest first, overriding the "
+        "module settings.  Each pair is matched at the first tier and "
+        "only rematched at the next, ending with the module settings, "
+        "while it has too few matches or too large a residual")
+    escalation_min_matches = Int(
+        required=False,
+        default=50,
+        missing=50,
+        description="minimum number of RANSAC inliers accepted at an "
+        "escalation tier before the last")
+    escalation_max_residual = Float(
+        required=False,
+        default=None,
+        missing=None,
+        description="maximum median distance, in full resolution "
+        "pixels, of matches from an affine fit to all the matches of a "
+        "pair accepted at an escalation tier before the last")
+    escalation_log = Str(
+        required=False,
+        default=None,
+        missing=None,
+        description="json lines file recording the escalation tier and "
+        "number of matches of each pair")
+
+
+class PointMatchBenchmarkParameters(PointMatchOpenCVParameters):
+    benchmark_detectors = List(
+        Str(validate=mm.validate.OneOf(["SIFT", "ORB", "AKAZE"])),
+        required=False,
+        default=["SIFT", "ORB", "AKAZE"],
+        missing=["SIFT", "ORB", "AKAZE"],
+        cli_as_single_argument=True,
+        description="detectors to compare, the first being the "
+        "reference the others are reported relative to")
+    benchmark_pairs = Int(
+        required=False,
+        default=20,
+        missing=20,
+        description="number of tile pairs sampled from pairJson")
+    benchmark_seed = Int(
+        required=False,
+        default=0,
+        missing=0,
+        description="random seed for sampling tile pairs")
+
+
+class DetectorBenchmark(DefaultSchema):
+    detector = Str(required=True)
+    pairs = Int(
+        required=True,
+        description="number of tile pairs matched")
+    seconds_per_pair = Float(
+        required=True,
+        description="mean feature extraction and matching time per pair, "
+        "excluding image reads")
+    features_per_tile = Float(
+        required=True,
+        description="mean number of features per tile")
+    matches_per_pair = Float(
+        required=True,
+        description="mean number of RANSAC inliers per pair")
+    median_residual = Float(
+        required=True, allow_none=True,
+        description="median distance of matches from the affine fit to "
+        "the pair's matches, in full resolution pixels")
+    median_reference_residual = Float(
+        required=True, allow_none=True,
+        description="median distance of matches from the affine fit to "
+        "the reference detector's matches of the same pair")
+    relative_speed = Float(
+        required=True,
+        description="reference seconds_per_pair / seconds_per_pair")
+    relative_yield = Float(
+        required=True, allow_none=True,
+        description="matches_per_pair / reference matches_per_pair")
+
+
+class PointMatchBenchmarkOutputSchema(DefaultSchema):
+    reference_detector = Str(required=True)
+    detectors = List(
+        Nested(DetectorBenchmark),
+        required=True,
+        description="benchmark results per detector")
+
+
+class SyntheticBenchmarkParameters(argschema.ArgSchema):
+    npairs = Int(
+        required=False,
+        default=4,
+        missing=4,
+        description="number of synthetic tile pairs per distortion")
+    tile_shape = List(
+        Int,
+        required=False,
+        default=[600, 600],
+        missing=[600, 600],
+        cli_as_single_argument=True,
+        description="(rows, cols) of the synthetic tiles")
+    overlap = Float(
+        required=False,
+        default=0.15,
+        missing=0.15,
+        description="fraction of the tile width shared by a pair")
+    distortions = List(
+        Str(validate=mm.validate.OneOf(["affine", "tps"])),
+        required=False,
+        default=["affine", "tps"],
+        missing=["affine", "tps"],
+        cli_as_single_argument=True,
+        description="distortions of the q tile benchmarked in turn")
+    distortion_magnitude = Float(
+        required=False,
+        default=None,
+        missing=None,
+        description="maximum deviation of the affine matrix from the "
+        "identity, or standard deviation in pixels of the thin plate "
+        "spline control point displacements (default 0.02 and 3.0)")
+    noise_sigma = Float(
+        required=False,
+        default=5.0,
+        missing=5.0,
+        description="standard deviation of gaussian noise added to each "
+        "tile, in gray levels")
+    gain_range = Float(
+        required=False,
+        default=0.2,
+        missing=0.2,
+        description="maximum relative change of q tile contrast")
+    bias_range = Float(
+        required=False,
+        default=20.0,
+        missing=20.0,
+        description="maximum change of q tile brightness in gray levels")
+    seed = Int(
+        required=False,
+        default=0,
+        missing=0,
+        description="random seed of the synthetic tile pairs")
+    parameter_grid = argschema.fields.Dict(
+        required=False,
+        default={"downsample_scale": [0.3, 0.6]},
+        missing={"downsample_scale": [0.3, 0.6]},
+        description="lists of values of PointMatchOpenCVParameters "
+        "matching parameters, benchmarked in every combination")
+    inlier_tolerance = Float(
+        required=False,
+        default=3.0,
+        missing=3.0,
+        description="ground truth error in pixels below which a match "
+        "is counted as correct")
+
+    @post_load
+    def validate_parameter_grid(self, data):
+        unknown = set(data['parameter_grid']) - set(
+            PointMatchOpenCVParameters().fields)
+        if unknown:
+            raise mm.ValidationError(
+                "unknown matching parameters {}".format(sorted(unknown)))
+
+
+class SyntheticBenchmarkCase(DefaultSchema):
+    distortion = Str(required=True)
+    parameters = argschema.fields.Dict(
+        required=True,
+        description="matching parameters differing from the defaults")
+    pairs = Int(required=True)
+    seconds = Float(
+        required=True,
+        description="time matching the pairs, including image reads")
+    pairs_per_second = Float(required=True)
+    features_per_second = Float(required=True)
+    peak_rss_mb = Float(
+        required=True,
+        description="peak resident memory in MB of the process that ran "
+        "only this case, including the interpreter and its libraries")
+    matches_per_pair = Float(required=True)
+    correct_fraction = Float(
+        required=True, allow_none=True,
+        description="fraction of matches within inlier_tolerance of the "
+        "ground truth")
+    median_residual = Float(
+        required=True, allow_none=True,
+        description="median ground truth error of the matches in pixels")
+    p95_residual = Float(
+        required=True, allow_none=True,
+        description="95th percentile ground truth error in pixels")
+
+
+class SyntheticBenchmarkOutputSchema(DefaultSchema):
+    cases = List(
+        Nested(SyntheticBenchmarkCase),
+        required=True,
+        description="results per distortion and parameter combination")
+
+
+class ThreadCalibrationParameters(argschema.ArgSchema):
+    cpus = Int(
+        required=False,
+        default=None,
+        missing=None,
+        description="cpus to divide between workers (default all)")
+    worker_counts = List(
+        Int,
+        required=False,
+        default=None,
+        missing=None,
+        cli_as_single_argument=True,
+        description="numbers of worker processes to time, by default "
+        "powers of two up to cpus and cpus")
+    pairs_per_cpu = Int(
+        required=False,
+        default=2,
+        missing=2,
+        description="tile pairs matched per cpu in each timing")
+    distinct_pairs = Int(
+        required=False,
+        default=4,
+        missing=4,
+        description="number of different synthetic tile pairs matched")
+    tile_shape = List(
+        Int,
+        required=False,
+        default=[1000, 1000],
+        missing=[1000, 1000],
+        cli_as_single_argument=True,
+        description="(rows, cols) of the synthetic tiles")
+    matching_parameters = argschema.fields.Dict(
+        required=False,
+        default={},
+        missing={},
+        description="PointMatchOpenCVParameters matching parameters "
+        "differing from the defaults")
+    seed = Int(
+        required=False,
+        default=0,
+        missing=0,
+        description="random seed of the synthetic tile pairs")
+
+
+class ThreadCalibrationTrial(DefaultSchema):
+    workers = Int(required=True)
+    threads_per_worker = Int(required=True)
+    seconds = Float(required=True)
+    pairs_per_second = Float(required=True)
+
+
+class ThreadCalibrationOutputSchema(DefaultSchema):
+    cpus = Int(required=True)
+    trials = List(
+        Nested(ThreadCalibrationTrial),
+        required=True,
+        description="timing of each workers x threads split")
+    recommended_workers = Int(
+        required=True,
+        description="ncpus (or pool_size) of the fastest split")
+    recommended_threads_per_worker = Int(
+        required=True,
+        description="threads_per_worker of the fastest split")
+
+
+class SectionPointMatchParameters(OpenCVMatchingParameters):
+    pairJson = Str(
+        required=False,
+        default=None,
+        missing=None,
+        description="full path of tilepair json of the section pairs. "
+        "By default sections from minZ to maxZ of input_stack are "
+        "paired up to zNeighborDistance apart")
+    minZ = Float(
+        required=False,
+        default=None,
+        missing=None,
+        description="minimum z of the sections to pair")
+    maxZ = Float(
+        required=False,
+        default=None,
+        missing=None,
+        description="maximum z of the sections to pair")
+    zNeighborDistance = Int(
+        required=False,
+        default=2,
+        missing=2,
+        description="pair each section with the sections above it up "
+        "to this z distance")
+    downsample_scale = Float(
+        required=False,
+        default=1.0,
+        missing=1.0,
+        description="scale of the finest matching level relative to the "
+        "section images")
+    coarse_scales = List(
+        Float,
+        required=False,
+        default=[0.125, 0.5],
+        missing=[0.125, 0.5],
+        cli_as_single_argument=True,
+        description="scales relative to the section images at which "
+        "sections are matched before downsample_scale, coarsest first. "
+        "The coarsest level searches the whole section")
+    coarse_model = Str(
+        required=False,
+        default="SIMILARITY",
+        missing="SIMILARITY",
+        validator=mm.validate.OneOf(
+            ["TRANSLATION", "RIGID", "SIMILARITY", "AFFINE", "HOMOGRAPHY"]),
+        description="transform fit to all the matches of a coarse level "
+        "to predict keypoint locations at the next level")
+    refine_search_radius = Float(
+        required=False,
+        default=32.0,
+        missing=32.0,
+        description="search radius, in pixels of each refinement level, "
+        "around the location of a p keypoint predicted by the previous "
+        "level")
+    section_batch_size = Int(
+        required=False,
+        default=16,
+        missing=16,
+        description="number of consecutive section pairs per worker "
+        "batch, sharing section features through tile_cache_size")
+
+    @post_load
+    def validate_section_range(self, data):
+        if data['pairJson'] is None and (
+                data['minZ'] is None or data['maxZ'] is None):
+            raise mm.ValidationError(
+                "minZ and maxZ are required without a pairJson")
 
 
-class SwapPointMatches(RenderParameters):
+class SwapPointMatches(RenderParameters, ProcessPoolParameters):
     match_owner = Str(
         required=True,
         description="Match collection owner name")
@@ -9,6 +9,7 @@ from asap.module.render_module import (
     RenderModule, RenderModuleException)
 from asap.pointmatch.schemas import (
     SwapPointMatches, SwapPointMatchesOutput)
+from asap.utilities.threads import worker_pool_kwargs
 
 example = {
     "render": {
@@ -159,7 +160,10 @@ class SwapPointMatchesModule(RenderModule):
                             self.args['target_collection'],
                             match_owner=self.args['match_owner'])
 
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
+        with renderapi.client.WithPool(
+                self.args['pool_size'], **worker_pool_kwargs(
+                    self.args['pool_size'],
+                    self.args['threads_per_worker'])) as pool:
             output_bool = pool.map(mypartial, ids)
 
         zvalues = [z for z, n in zip(ids, output_bool) if n]
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+"""
+benchmark point matching throughput and accuracy without a render
+server.  Overlapping tile pairs are cut from a synthetic EM-like texture
+with a known affine or thin plate spline distortion, noise and intensity
+change, matched by process_matches for each combination of a grid of
+matcher parameters, and the matches compared to the ground truth.
+Each case runs in a new process so that its peak memory is its own.
+"""
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+import pathlib
+import resource
+import shutil
+import tempfile
+import time
+
+from argschema import ArgSchemaParser
+import cv2
+import marshmallow as mm
+import numpy as np
+from scipy.interpolate import RBFInterpolator
+from scipy.spatial import cKDTree
+
+from asap.pointmatch.generate_point_matches_opencv import (
+    find_matches_kwargs, process_matches)
+from asap.pointmatch.schemas import (
+    PointMatchOpenCVParameters, SyntheticBenchmarkOutputSchema,
+    SyntheticBenchmarkParameters)
+
+if __name__ == "__main__" and __package__ is None:
+    __package__ = "asap.pointmatch.synthetic_benchmark"
+
+
+example = {
+    "npairs": 8,
+    "tile_shape": [1000, 1000],
+    "overlap": 0.15,
+    "distortions": ["affine", "tps"],
+    "noise_sigma": 8.0,
+    "parameter_grid": {
+        "downsample_scale": [0.3, 0.6],
+        "SIFT_nfeature": [5000, 20000]
+    },
+    "output_json": "synthetic_benchmark.json"
+}
+
+
+def em_texture(shape, cell_size=40., seed=0):
+    """uint8 image resembling an EM section: cells of varying brightness
+    with dark membranes between them, dark organelles and fine grain
+    """
+    rng = np.random.RandomState(seed)
+    rows, cols = shape
+    ncells = max(int(rows * cols / cell_size ** 2), 1)
+    seeds = rng.rand(ncells, 2) * [cols, rows]
+    yx = np.indices(shape).reshape(2, -1)[::-1].T
+    d, cell = cKDTree(seeds).query(yx, k=2)
+    # membranes where the two nearest cell centers are equidistant
+    membrane = np.exp(-((d[:, 1] - d[:, 0]) / 2.) ** 2).reshape(shape)
+    cytoplasm = rng.uniform(0.5, 1., ncells)[cell[:, 0]].reshape(shape)
+
+    organelles = np.zeros(shape, dtype=np.float32)
+    for y, x in (rng.rand(ncells // 2, 2) * [rows, cols]).astype(int):
+        cv2.circle(organelles, (int(x), int(y)),
+                   int(rng.randint(2, max(int(cell_size / 6), 3))),
+                   1., -1)
+
+    grain = cv2.GaussianBlur(
+        rng.randn(*shape).astype(np.float32), (0, 0), 1.5)
+    im = cytoplasm - 0.6 * membrane - 0.4 * organelles + 0.05 * grain
+    im = cv2.GaussianBlur(im.astype(np.float32), (0, 0), 1.)
+    im = (im - im.min()) / (im.max() - im.min()) * 255
+    return im.astype(np.uint8)
+
+
+class AffineDistortion(object):
+    """affine map about the center of a tile of shape with a small
+    random rotation, scale and shear
+    """
+    def __init__(self, shape, magnitude=0.02, rng=np.random):
+        self.center = np.array(shape[::-1], dtype=float) / 2.
+        self.A = np.eye(2) + rng.uniform(-magnitude, magnitude, (2, 2))
+
+    def __call__(self, xy):
+        return (xy - self.center).dot(self.A.T) + self.center
+
+
+class TPSDistortion(object):
+    """thin plate spline displacement interpolating random displacements
+    of a grid of control points
+    """
+    def __init__(self, shape, magnitude=3.0, ngrid=4, rng=np.random):
+        rows, cols = shape
+        src = np.stack(np.meshgrid(
+            np.linspace(0, cols, ngrid), np.linspace(0, rows, ngrid)),
+            axis=-1).reshape(-1, 2)
+        self.interpolator = RBFInterpolator(
+            src, rng.randn(*src.shape) * magnitude,
+            kernel='thin_plate_spline')
+
+    def __call__(self, xy):
+        return xy + self.interpolator(xy)
+
+
+DISTORTIONS = {"affine": AffineDistortion, "tps": TPSDistortion}
+
+
+class SyntheticPair(object):
+    """a tile pair cut from a texture.  p tile pixel x lies at texture
+    pixel x + p_origin, and q tile pixel x at
+    warp(x) + q_origin.
+    """
+    def __init__(self, pim, qim, p_origin, q_origin, warp):
+        self.pim = pim
+        self.qim = qim
+        self.p_origin = np.asarray(p_origin, dtype=float)
+        self.q_origin = np.asarray(q_origin, dtype=float)
+        self.warp = warp
+
+    def residuals(self, p, q):
+        """ground truth error of Nx2 tile pixel matches p, q in texture
+        pixels
+        """
+        p = np.asarray(p, dtype=float).reshape(-1, 2)
+        q = np.asarray(q, dtype=float).reshape(-1, 2)
+        if not p.shape[0]:
+            return np.empty(0)
+        return np.linalg.norm(
+            self.warp(q) + self.q_origin - p - self.p_origin, axis=1)
+
+
+def synthetic_tile_pair(
+        texture, tile_shape, overlap=0.15, distortion="affine",
+        distortion_magnitude=None, noise_sigma=5., gain=1., bias=0.,
+        rng=np.random):
+    """cut horizontally overlapping p and q tiles from texture, the q
+    tile distorted, with gaussian noise of noise_sigma and its intensity
+    changed by gain and bias
+
+    Returns
+    -------
+    SyntheticPair
+    """
+    rows, cols = tile_shape
+    margin = (np.array(texture.shape[::-1]) - [2 * cols, rows]) / 2.
+    p_origin = margin + rng.uniform(-1, 1, 2) * margin / 4.
+    q_origin = p_origin + [(1. - overlap) * cols, 0.] + rng.uniform(
+        -1, 1, 2) * margin / 4.
+
+    kwargs = {} if distortion_magnitude is None else {
+        "magnitude": distortion_magnitude}
+    warp = DISTORTIONS[distortion](tile_shape, rng=rng, **kwargs)
+
+    def cut(origin, warp=None):
+        xy = np.indices(tile_shape)[::-1].reshape(2, -1).T.astype(float)
+        if warp is not None:
+            xy = warp(xy)
+        xy = (xy + origin).astype(np.float32).reshape(rows, cols, 2)
+        return cv2.remap(texture, xy[..., 0], xy[..., 1],
+                         interpolation=cv2.INTER_LINEAR,
+                         borderMode=cv2.BORDER_REFLECT).astype(np.float32)
+
+    def degrade(im, gain=1., bias=0.):
+        im = im * gain + bias + rng.randn(*im.shape) * noise_sigma
+        return np.clip(im, 0, 255).astype(np.uint8)
+
+    return SyntheticPair(
+        degrade(cut(p_origin)),
+        degrade(cut(q_origin, warp), gain=gain, bias=bias),
+        p_origin, q_origin, warp)
+
+
+def synthetic_tile_pairs(npairs, tile_shape, distortion="affine",
+                         overlap=0.15, noise_sigma=5., gain_range=0.2,
+                         bias_range=20., seed=0, **kwargs):
+    """npairs SyntheticPairs, each cut from its own texture"""
+    rng = np.random.RandomState(seed)
+    rows, cols = tile_shape
+    texture_shape = (int(rows * 1.4), int(cols * 2.4))
+    return [synthetic_tile_pair(
+                em_texture(texture_shape, seed=rng.randint(2 ** 31)),
+                tile_shape, overlap=overlap, distortion=distortion,
+                noise_sigma=noise_sigma,
+                gain=1. + rng.uniform(-gain_range, gain_range),
+                bias=rng.uniform(-bias_range, bias_range), rng=rng,
+                **kwargs)
+            for i in range(npairs)]
+
+
+def write_pair_images(pairs, directory):
+    """write the tiles of pairs to png files, returning the
+    process_matches image uris of each pair
+    """
+    uris = []
+    for i, pair in enumerate(pairs):
+        pair_uris = []
+        for k, im in (('p', pair.pim), ('q', pair.qim)):
+            fn = os.path.join(directory, '{}_{}.png'.format(i, k))
+            cv2.imwrite(fn, im)
+            pair_uris.append([pathlib.Path(fn).as_uri(), None])
+        uris.append(pair_uris)
+    return uris
+
+
+def matcher_defaults():
+    """default module args of the opencv point match client"""
+    return {k: f.missing
+            for k, f in PointMatchOpenCVParameters().fields.items()
+            if f.missing is not mm.missing}
+
+
+def parameter_cases(parameter_grid):
+    """every combination of the values of a dict of parameter lists"""
+    keys = sorted(parameter_grid)
+    return [dict(zip(keys, values)) for values in itertools.product(
+        *[parameter_grid[k] for k in keys])]
+
+
+def peak_rss_mb():
+    """peak resident set size of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def benchmark_case(pairs, uris, args, inlier_tolerance=3.):
+    """match each of the SyntheticPairs pairs, read from their uris, with
+    module args and summarize speed and ground truth accuracy
+    """
+    kwargs = find_matches_kwargs(args, {})
+    nfeatures = 0
+    nmatches = []
+    residuals = []
+    start = time.perf_counter()
+    for pair, (puri, quri) in zip(pairs, uris):
+        pm, nmatch, nfeat_p, nfeat_q = process_matches(
+            'p', 'p', puri, 'q', 'q', quri, **kwargs)
+        nfeatures += nfeat_p + nfeat_q
+        nmatches.append(nmatch)
+        residuals.append(pair.residuals(
+            np.array(pm['matches']['p']).T, np.array(pm['matches']['q']).T))
+    seconds = time.perf_counter() - start
+
+    residuals = np.concatenate(residuals)
+    return {
+        "pairs": len(pairs),
+        "seconds": seconds,
+        "pairs_per_second": len(pairs) / seconds,
+        "features_per_second": nfeatures / seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "matches_per_pair": float(np.mean(nmatches)),
+        "correct_fraction": (
+            float(np.mean(residuals < inlier_tolerance))
+            if residuals.size else None),
+        "median_residual": (
+            float(np.median(residuals)) if residuals.size else None),
+        "p95_residual": (
+            float(np.percentile(residuals, 95)) if residuals.size else None)
+    }
+
+
+def isolated_benchmark_case(*args, **kwargs):
+    """benchmark_case in a new process forked from a small forkserver,
+    so that its peak_rss_mb is the peak of that case alone rather than
+    the high-water mark of every case run before it
+    """
+    with concurrent.futures.ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context("forkserver")) as e:
+        return e.submit(benchmark_case, *args, **kwargs).result()
+
+
+class SyntheticPointMatchBenchmark(ArgSchemaParser):
+    default_schema = SyntheticBenchmarkParameters
+    default_output_schema = SyntheticBenchmarkOutputSchema
+
+    def run(self):
+        cases = parameter_cases(self.args['parameter_grid'])
+        results = []
+        workdir = tempfile.mkdtemp()
+        try:
+            for distortion in self.args['distortions']:
+                pairs = synthetic_tile_pairs(
+                    self.args['npairs'], tuple(self.args['tile_shape']),
+                    distortion=distortion,
+                    overlap=self.args['overlap'],
+                    noise_sigma=self.args['noise_sigma'],
+                    gain_range=self.args['gain_range'],
+                    bias_range=self.args['bias_range'],
+                    distortion_magnitude=self.args[
+                        'distortion_magnitude'],
+                    seed=self.args['seed'])
+                d = os.path.join(workdir, distortion)
+                os.makedirs(d)
+                uris = write_pair_images(pairs, d)
+
+                for case in cases:
+                    args = dict(matcher_defaults(), **case)
+                    result = isolated_benchmark_case(
+                        pairs, uris, args,
+                        inlier_tolerance=self.args['inlier_tolerance'])
+                    result.update(distortion=distortion, parameters=case)
+                    self.logger.info(
+                        "%s %s: %.2f pairs/s, %.0f matches/pair, "
+                        "median residual %s" % (
+                            distortion, case, result['pairs_per_second'],
+                            result['matches_per_pair'],
+                            result['median_residual']))
+                    results.append(result)
+        finally:
+            shutil.rmtree(workdir)
+
+        self.output({"cases": results})
+
+
+if __name__ == "__main__":
+    mod = SyntheticPointMatchBenchmark()
+    mod.run()
@@ -0,0 +1,129 @@
+"""
+predict the overlapping region of a tile pair from tilespec layout so
+that feature extraction and matching can be restricted to it
+"""
+import numpy as np
+import renderapi
+import shapely
+
+
+def tile_grid_pts(width, height, ngrid=33):
+    xs = np.linspace(0, width - 1, ngrid)
+    ys = np.linspace(0, height - 1, ngrid)
+    xx, yy = np.meshgrid(xs, ys)
+    return np.column_stack([xx.ravel(), yy.ravel()])
+
+
+def tile_world_pts(ts, pts, ref_tforms=None):
+    return renderapi.transform.estimate_dstpts(
+        ts.tforms, src=pts, reference_tforms=ref_tforms)
+
+
+def _roi_in_other(ts, other_poly, ngrid, ref_tforms=None):
+    local = tile_grid_pts(ts.width, ts.height, ngrid)
+    world = tile_world_pts(ts, local, ref_tforms)
+    inside = shapely.contains_xy(other_poly, world[:, 0], world[:, 1])
+    if not inside.any():
+        return None
+    # other_poly already includes the margin, so only pad by one grid
+    #   cell for the overlap boundary falling between grid points
+    pad = max(ts.width, ts.height) / float(ngrid - 1)
+    minX, minY = local[inside].min(axis=0) - pad
+    maxX, maxY = local[inside].max(axis=0) + pad
+    return [max(minX, 0.), max(minY, 0.),
+            min(maxX, ts.width), min(maxY, ts.height)]
+
+
+def overlap_rois_from_tilespecs(
+        ts_p, ts_q, margin=0., ngrid=33, ref_tforms=None):
+    """local (level 0 pixel) bounding boxes [minX, minY, maxX, maxY] of
+    the region of each tile predicted to overlap the other tile
+
+    Parameters
+    ----------
+    ts_p, ts_q : renderapi.tilespec.TileSpec
+        tilespecs of the pair
+    margin : float
+        pixels added around the predicted overlap
+    ngrid : int
+        number of grid points per tile edge used to sample the tiles
+    ref_tforms : list of renderapi.transform.Transform, optional
+        transforms referenced by the tilespecs
+
+    Returns
+    -------
+    p_roi, q_roi : list of float or None
+        None if the tiles are not predicted to overlap
+    """
+    polys = []
+    for ts in (ts_p, ts_q):
+        border = tile_world_pts(
+            ts, tile_grid_pts(ts.width, ts.height, 2)[[0, 1, 3, 2]],
+            ref_tforms)
+        polys.append(shapely.Polygon(border).buffer(margin))
+    p_roi = _roi_in_other(ts_p, polys[1], ngrid, ref_tforms)
+    q_roi = _roi_in_other(ts_q, polys[0], ngrid, ref_tforms)
+    if p_roi is None or q_roi is None:
+        return None, None
+    return p_roi, q_roi
+
+
+def overlap_roi_from_relative_position(
+        width, height, relativePosition, overlap_fraction=0.15, margin=0.):
+    """local bounding box of the strip of a tile facing its neighbor
+    given the tilepair relativePosition of that tile ("LEFT" meaning the
+    tile is left of its neighbor)
+    """
+    xw = width * overlap_fraction + margin
+    yw = height * overlap_fraction + margin
+    try:
+        return {
+            "LEFT": [max(width - xw, 0.), 0., width, height],
+            "RIGHT": [0., 0., min(xw, width), height],
+            "TOP": [0., max(height - yw, 0.), width, height],
+            "BOTTOM": [0., 0., width, min(yw, height)]
+        }[relativePosition]
+    except KeyError:
+        return None
+
+
+def overlap_rois(ts_p, ts_q, pair=None, margin=0., overlap_fraction=0.15,
+                 ref_tforms=None, **kwargs):
+    """predicted overlap rois for a tile pair, from the tilespec
+    transforms if they can be evaluated, otherwise from the tilepair
+    relativePosition entries
+    """
+    try:
+        return overlap_rois_from_tilespecs(
+            ts_p, ts_q, margin=margin, ref_tforms=ref_tforms, **kwargs)
+    except (renderapi.errors.RenderError, NotImplementedError):
+        pass
+    if pair is None:
+        return None, None
+    return tuple(
+        overlap_roi_from_relative_position(
+            ts.width, ts.height, pair[k].get("relativePosition"),
+            overlap_fraction=overlap_fraction, margin=margin)
+        for ts, k in ((ts_p, "p"), (ts_q, "q")))
+
+
+def fit_affine(src, dst):
+    """least squares 3x3 affine matrix mapping Nx2 src to Nx2 dst"""
+    A = np.hstack([src, np.ones((src.shape[0], 1))])
+    x, _, _, _ = np.linalg.lstsq(A, dst, rcond=None)
+    return np.vstack([x.T, [0., 0., 1.]])
+
+
+def predicted_pq_affine(ts_p, ts_q, ngrid=9, ref_tforms=None):
+    """affine approximation of the mapping from p local (level 0)
+    coordinates to q local coordinates implied by the tilespec
+    transforms of a tile pair
+    """
+    q_local = tile_grid_pts(ts_q.width, ts_q.height, ngrid)
+    world_to_q = fit_affine(
+        tile_world_pts(ts_q, q_local, ref_tforms), q_local)
+
+    p_local = tile_grid_pts(ts_p.width, ts_p.height, ngrid)
+    p_world = tile_world_pts(ts_p, p_local, ref_tforms)
+    p_in_q = p_world.dot(world_to_q[:2, :2].T) + world_to_q[:2, 2]
+    return fit_affine(p_local, p_in_q)
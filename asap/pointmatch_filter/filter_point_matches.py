@@ -1,12 +1,16 @@
 #!/usr/bin/env python
+import json
 import logging
 
 import numpy as np
 import renderapi
 
 from asap.module.render_module import RenderModule
+from asap.pointmatch.match_sinks import (
+    RenderMatchSink, trim_incomplete_line)
 from asap.pointmatch_filter.schemas import (
     FilterSchema, FilterOutputSchema)
+from asap.utilities.threads import worker_pool_kwargs
 
 example = {
     "render": {
@@ -29,6 +33,9 @@ example = {
 
 logger = logging.getLogger()
 
+# per-process render clients, keeping one keep-alive session per worker
+_renders = {}
+
 
 def filter_plot(fig, result_json, fs=14):
 
@@ -74,11 +81,146 @@ def filter_plot(fig, result_json, fs=14):
     ax.plot([ax.get_xlim()[0], tmax], [rmax, rmax], '--b', alpha=0.5)
 
 
-def proc_job(fargs):
+def pack_matches(matches):
+    """concatenated Nx2 p and q points of all matches, with offsets
+    (of length len(matches) + 1) delimiting the points of each match
+    """
+    counts = np.array([len(m['matches']['p'][0]) for m in matches])
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    p = np.empty((offsets[-1], 2))
+    q = np.empty((offsets[-1], 2))
+    for m, i0, i1 in zip(matches, offsets[:-1], offsets[1:]):
+        p[i0:i1] = np.transpose(m['matches']['p'])
+        q[i0:i1] = np.transpose(m['matches']['q'])
+    return p, q, offsets
+
+
+def _segment_sum(offsets):
+    """function summing per-point values over each pair of offsets"""
+    npairs = len(offsets) - 1
+    pair = np.repeat(np.arange(npairs), np.diff(offsets))
+
+    def pair_sum(v):
+        return np.bincount(pair, weights=v, minlength=npairs)
+    return pair, pair_sum
+
+
+def point_residuals(p, q, offsets, params):
+    """distance of each q point from its p point mapped by the
+    fit_affine_pairs params of its pair
+    """
+    pair, _ = _segment_sum(offsets)
+    pred = np.stack([
+        np.einsum('ni,ni->n', p, params[pair, 0:2]) + params[pair, 4],
+        np.einsum('ni,ni->n', p, params[pair, 2:4]) + params[pair, 5]],
+        axis=1)
+    return np.sqrt(((q - pred) ** 2).sum(axis=1))
+
+
+def fit_affine_pairs(p, q, offsets, weights=None):
+    """(weighted) least squares affine transform from p to q of each pair
+    of pack_matches points, solved for all pairs at once from their
+    centered normal equations
+
+    Returns
+    -------
+    params : numpy.ndarray
+        Mx6 parameters ordered M00, M01, M10, M11, B0, B1 as
+        renderapi.transform.AffineModel.fit
+    residuals : numpy.ndarray
+        sum of squared (unweighted) residuals of each pair
+    """
+    pair, pair_sum = _segment_sum(offsets)
+    w = np.ones(p.shape[0]) if weights is None else weights
+
+    W = pair_sum(w)
+    Wn = np.where(W > 0, W, 1.)[:, None]
+    pm = np.stack([pair_sum(w * p[:, 0]), pair_sum(w * p[:, 1])], axis=1) / Wn
+    qm = np.stack([pair_sum(w * q[:, 0]), pair_sum(w * q[:, 1])], axis=1) / Wn
+    pc = p - pm[pair]
+    qc = q - qm[pair]
+
+    # centering decouples the linear part from the translation, leaving
+    # a 2x2 system per pair
+    S = np.empty((len(W), 2, 2))
+    S[:, 0, 0] = pair_sum(w * pc[:, 0] * pc[:, 0])
+    S[:, 0, 1] = S[:, 1, 0] = pair_sum(w * pc[:, 0] * pc[:, 1])
+    S[:, 1, 1] = pair_sum(w * pc[:, 1] * pc[:, 1])
+    R = np.empty((len(W), 2, 2))
+    for i in range(2):
+        for j in range(2):
+            R[:, i, j] = pair_sum(w * pc[:, i] * qc[:, j])
+
+    det = S[:, 0, 0] * S[:, 1, 1] - S[:, 0, 1] ** 2
+    singular = ((pair_sum(w > 0) < 3) |
+                (det <= 1e-12 * S[:, 0, 0] * S[:, 1, 1]))
+    det[singular] = 1.0
+    inv = np.empty_like(S)
+    inv[:, 0, 0] = S[:, 1, 1] / det
+    inv[:, 1, 1] = S[:, 0, 0] / det
+    inv[:, 0, 1] = inv[:, 1, 0] = -S[:, 0, 1] / det
+    L = np.swapaxes(np.matmul(inv, R), 1, 2)
+    B = qm - np.einsum('nij,nj->ni', L, pm)
+    params = np.concatenate([L.reshape(-1, 4), B], axis=1)
+
+    # degenerate pairs take the minimum norm solution of the full system
+    for i in np.flatnonzero(singular):
+        sl = slice(offsets[i], offsets[i + 1])
+        if weights is None:
+            params[i] = renderapi.transform.AffineModel.fit(
+                p[sl], q[sl]).squeeze()
+        else:
+            sw = np.sqrt(w[sl])[:, None]
+            X = np.hstack([p[sl], np.ones((p[sl].shape[0], 1))]) * sw
+            P = np.linalg.lstsq(X, q[sl] * sw, rcond=None)[0]
+            params[i] = np.concatenate([P[:2, 0], P[:2, 1], P[2]])
+
+    residuals = pair_sum(point_residuals(p, q, offsets, params) ** 2)
+    return params, residuals
+
+
+def robust_fit_affine_pairs(p, q, offsets, threshold, iterations=5):
+    """affine fits of all pack_matches pairs by iteratively reweighted
+    least squares with Cauchy weights of scale threshold, starting from
+    the least squares fit
+
+    Returns
+    -------
+    params : numpy.ndarray
+        Mx6 parameters as fit_affine_pairs
+    inliers : numpy.ndarray
+        boolean mask of the points within threshold of their pair's fit
+    """
+    params, _ = fit_affine_pairs(p, q, offsets)
+    for i in range(iterations):
+        r = point_residuals(p, q, offsets, params)
+        params, _ = fit_affine_pairs(
+            p, q, offsets, weights=1. / (1. + (r / threshold) ** 2))
+    inliers = point_residuals(p, q, offsets, params) <= threshold
+    return params, inliers
+
+
+def worker_render(rpar):
+    """render client for the render parameters rpar, created once per
+    process
+    """
+    key = json.dumps(rpar, sort_keys=True)
+    if key not in _renders:
+        _renders[key] = renderapi.connect(**rpar)
+    return _renders[key]
+
+
+def filter_section(fargs):
+    """filter the matches of a section, returning the result dict of
+    proc_job, or a status record for a z without matches ("empty") or
+    that could not be read ("error"), and the updated matches for
+    output_match_collection
+    """
     [input_match_collection, output_match_collection,
-        input_stack, z, resmax, transmax, rpar, inverse] = fargs
+        input_stack, z, resmax, transmax, rpar, inverse,
+        point_resmax, point_filter_mode, point_filter_iterations] = fargs
 
-    render = renderapi.connect(**rpar)
+    render = worker_render(rpar)
     try:
         tspecs = renderapi.tilespec.get_tile_specs_from_z(
                 input_stack,
@@ -90,54 +232,62 @@ def proc_job(fargs):
                 render=render)
     except renderapi.errors.RenderError as e:
         logger.warning(str(e))
-        return None
+        return {'z': z, 'status': 'error'}, []
 
     if len(matches) == 0:
-        return None
+        return {'z': z, 'status': 'empty'}, []
 
-    tids = np.array([t.tileId for t in tspecs])
+    tile_xy = {t.tileId: (t.tforms[-1].B0, t.tforms[-1].B1)
+               for t in tspecs}
 
-    residuals = []
-    translations = []
-    counts = []
     pids = [m['pId'] for m in matches]
     qids = [m['qId'] for m in matches]
-    tf = renderapi.transform.AffineModel()
-
-    for m in matches:
-        A = np.transpose(np.array(m['matches']['p']))
-        B = np.transpose(np.array(m['matches']['q']))
-        tvec, res, _, _ = tf.fit(A, B, return_all=True)
-
-        pi = np.argwhere(tids == m['pId'])[0][0]
-        qi = np.argwhere(tids == m['qId'])[0][0]
-        dx = tspecs[pi].tforms[-1].B0 - tspecs[qi].tforms[-1].B0
-        dy = tspecs[pi].tforms[-1].B1 - tspecs[qi].tforms[-1].B1
-
-        residuals.append(res)
-        counts.append(len(m['matches']['w']))
-        translations.append(
-                np.sqrt(
-                    np.power(dx - tvec[4][0], 2.0) +
-                    np.power(dy - tvec[5][0], 2.0)))
-
-    residuals = np.array(residuals).squeeze()
-    counts = np.array(counts)
-    nres = np.round(np.sqrt(residuals/counts), 3)
+    counts = np.array([len(m['matches']['w']) for m in matches])
+
+    p, q, offsets = pack_matches(matches)
+    inliers = None
+    if point_resmax is None:
+        params, residuals = fit_affine_pairs(p, q, offsets)
+    else:
+        # pair statistics of the points kept by a robust refit
+        params, inliers = robust_fit_affine_pairs(
+            p, q, offsets, point_resmax,
+            iterations=point_filter_iterations)
+        _, pair_sum = _segment_sum(offsets)
+        r = point_residuals(p, q, offsets, params)
+        residuals = pair_sum(inliers * r ** 2)
+        rejected = counts - pair_sum(inliers).astype(int)
+        counts = counts - rejected
+    dxy = (np.array([tile_xy[i] for i in pids]) -
+           np.array([tile_xy[i] for i in qids]))
+    translations = np.sqrt(
+            np.power(dxy[:, 0] - params[:, 4], 2.0) +
+            np.power(dxy[:, 1] - params[:, 5], 2.0))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nres = np.round(np.where(
+            counts > 0, np.sqrt(residuals/counts), np.inf), 3)
     translations = np.round(np.array(translations), 3)
 
     w = []
     cmax = float(counts.max())
     updated_matches = []
 
-    def new_match(match, new_w, copy=False):
-        changed = not np.all(np.isclose(
-            np.array(new_w),
-            np.array(match['matches']['w'])))
+    def new_match(match, new_w, copy=False, keep=None):
+        old_w = np.array(match['matches']['w'])
+        if keep is not None:
+            old_w = old_w[keep]
+        changed = ((keep is not None) and (not np.all(keep))) or (
+            not np.all(np.isclose(np.array(new_w), old_w)))
         if (not copy) & (not changed):
             return None
 
         nmatch = dict(match)
+        nmatch['matches'] = dict(match['matches'])
+        if keep is not None:
+            for k in ['p', 'q']:
+                nmatch['matches'][k] = np.array(
+                    match['matches'][k])[:, keep].tolist()
         nmatch['matches']['w'] = new_w
         return nmatch
 
@@ -147,15 +297,22 @@ def proc_job(fargs):
             # solver will ignore
             w[-1] = 0.0
         if inverse:
-            w.append(cmax/counts[i])
+            w.append(cmax/max(counts[i], 1))
         if output_match_collection is not None:
             new_w = [w[-1]] * counts[i]
+            keep = None
+            if inliers is not None:
+                keep = inliers[offsets[i]:offsets[i + 1]]
+                if point_filter_mode == "weight":
+                    new_w = (w[-1] * keep).tolist()
+                    keep = None
             if(output_match_collection != input_match_collection):
                 # copy over everything, modified or not
-                updated_matches.append(new_match(matches[i], new_w, copy=True))
+                updated_matches.append(new_match(
+                    matches[i], new_w, copy=True, keep=keep))
             else:
                 # only copy over modified
-                nmatch = new_match(matches[i], new_w, copy=False)
+                nmatch = new_match(matches[i], new_w, copy=False, keep=keep)
                 if nmatch is not None:
                     updated_matches.append(nmatch)
 
@@ -166,10 +323,6 @@ def proc_job(fargs):
                     len(matches),
                     int(z),
                     output_match_collection))
-        renderapi.pointmatch.import_matches(
-                output_match_collection,
-                updated_matches,
-                render=render)
 
     result = {}
     result['z'] = z
@@ -185,16 +338,66 @@ def proc_job(fargs):
                     'translation': translations[i],
                     'count': counts[i],
                     'weight': w[i]})
+        if inliers is not None:
+            result['filter'][-1]['rejected'] = rejected[i]
+    return result, updated_matches
+
+
+def proc_job(fargs):
+    result, updated_matches = filter_section(fargs)
+    if 'status' in result:
+        return None
+    output_match_collection = fargs[1]
+    if output_match_collection is not None:
+        renderapi.pointmatch.import_matches(
+                output_match_collection,
+                updated_matches,
+                render=worker_render(fargs[6]))
     return result
 
 
+def filtered_z_values(filter_output_file):
+    """z values of the results in a json lines filter_output_file,
+    ignoring a line left incomplete by an interrupted run and z values
+    that could not be read, so that they are retried
+    """
+    zs = set()
+    try:
+        with open(filter_output_file, 'r') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if result.get('status') != 'error':
+                    zs.add(float(result['z']))
+    except (IOError, OSError):
+        pass
+    return zs
+
+
+def write_result_lines(f, results):
+    f.write(''.join(
+        renderapi.utils.renderdumps(r) + '\n' for r in results))
+    f.flush()
+
+
 class FilterMatches(RenderModule):
     default_schema = FilterSchema
     default_output_schema = FilterOutputSchema
 
     def run(self):
+        output_file = self.args['filter_output_file']
+        jsonl = (self.args['filter_output_format'] == 'jsonl')
+        done = filtered_z_values(output_file) if self.args['resume'] else set()
+        zValues = [z for z in self.args['zValues'] if float(z) not in done]
+        if done:
+            logger.info("skipping %d of %d filtered z values" % (
+                len(self.args['zValues']) - len(zValues),
+                len(self.args['zValues'])))
+
         fargs = []
-        for z in self.args['zValues']:
+        for z in zValues:
             fargs.append([
                 self.args['input_match_collection'],
                 self.args['output_match_collection'],
@@ -203,16 +406,56 @@ class FilterMatches(RenderModule):
                 self.args['resmax'],
                 self.args['transmax'],
                 self.args['render'],
-                self.args['inverse_weighting']])
-
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
-            results = pool.map(proc_job, fargs)
-
-        with open(self.args['filter_output_file'], 'w') as f:
-            renderapi.utils.renderdump(
-                    [x for x in results if x is not None],
-                    f,
-                    indent=2)
+                self.args['inverse_weighting'],
+                self.args['point_resmax'],
+                self.args['point_filter_mode'],
+                self.args['point_filter_iterations']])
+
+        sink = None
+        if self.args['output_match_collection'] is not None:
+            sink = RenderMatchSink(
+                self.render, self.args['output_match_collection'],
+                batch_size=self.args['match_batch_size'])
+
+        # json lines results are appended as soon as the weight updates
+        # of their z are written, so that an interrupted run can resume.
+        # pending holds the results of z values whose updates are still
+        # buffered, with the sink count at which they are all written.
+        results = []
+        pending = []
+        if jsonl:
+            trim_incomplete_line(output_file)
+        with open(output_file, 'a' if jsonl else 'w') as f:
+            with renderapi.client.WithPool(
+                    self.args['pool_size'], **worker_pool_kwargs(
+                        self.args['pool_size'],
+                        self.args['threads_per_worker'])) as pool:
+                imap = pool.imap_unordered if jsonl else pool.imap
+                for result, updated_matches in imap(filter_section, fargs):
+                    if ('status' in result) and not jsonl:
+                        continue
+                    written = 0
+                    if sink is not None:
+                        for m in updated_matches:
+                            sink.add(m)
+                        written = sink.count + len(sink.buffer)
+                    if not jsonl:
+                        results.append(result)
+                        continue
+                    pending.append((written, result))
+                    done = [r for n, r in pending
+                            if (sink is None) or (n <= sink.count)]
+                    if done:
+                        write_result_lines(f, done)
+                        pending = [(n, r) for n, r in pending
+                                   if (sink is not None) and (n > sink.count)]
+            if sink is not None:
+                sink.close()
+
+            if jsonl:
+                write_result_lines(f, [r for _, r in pending])
+            else:
+                renderapi.utils.renderdump(results, f, indent=2)
 
         with open(self.args['output_json'], 'w') as f:
             outj = {'filter_output_file': self.args['filter_output_file']}
@@ -1,5 +1,7 @@
 import argschema
-from argschema.fields import Bool, Str, Float, OutputFile
+from argschema.fields import Bool, Str, Float, Int, OutputFile
+import marshmallow as mm
+from marshmallow import post_load
 from asap.module.schemas import (RenderParameters, ZValueParameters,
                                           ProcessPoolParameters)
 
@@ -32,6 +34,58 @@ class FilterSchema(RenderParameters, ZValueParameters, ProcessPoolParameters):
         default=False,
         missing=False,
         description='new weights weighted inverse to counts per tile-pair')
+    point_resmax = Float(
+        required=False,
+        default=None,
+        missing=None,
+        allow_none=True,
+        description=("reject individual point matches with a residual "
+                     "above this many pixels from a robust affine refit "
+                     "of their tile pair.  None only filters whole "
+                     "tile pairs"))
+    point_filter_mode = Str(
+        required=False,
+        default="weight",
+        missing="weight",
+        validator=mm.validate.OneOf(["weight", "drop"]),
+        description=("zero the weight of rejected point matches "
+                     "(weight) or remove them from the match (drop)"))
+    point_filter_iterations = Int(
+        required=False,
+        default=5,
+        missing=5,
+        description=("reweighted least squares iterations of the "
+                     "robust refit"))
+    filter_output_format = Str(
+        required=False,
+        default="json",
+        missing="json",
+        validator=mm.validate.OneOf(["json", "jsonl"]),
+        description=("write filter_output_file as one json list once all "
+                     "z values are filtered (json) or append the result "
+                     "of each z as a json line as it finishes (jsonl). "
+                     "jsonl gives a z without matches, or that could not "
+                     "be read, a line with status 'empty' or 'error'"))
+    resume = Bool(
+        required=False,
+        default=False,
+        missing=False,
+        description=("skip z values already in a jsonl "
+                     "filter_output_file, retrying those with status "
+                     "'error'"))
+    match_batch_size = Int(
+        required=False,
+        default=1000,
+        missing=1000,
+        description=("number of updated tile pair matches, across z "
+                     "values, written to output_match_collection at "
+                     "once"))
+
+    @post_load
+    def validate_resume(self, data):
+        if data['resume'] and data['filter_output_format'] != 'jsonl':
+            raise mm.ValidationError(
+                "resume requires filter_output_format 'jsonl'")
 
 
 class FilterOutputSchema(argschema.schemas.DefaultSchema):
@@ -1,58 +1,122 @@
+from collections.abc import Mapping
+
 import numpy as np
 import requests
 import renderapi
 
 
+class TileArrays(Mapping):
+    """read-only dict view, keyed by tileId, of per-tile arrays stored
+    concatenated in one flat array with offsets (CSR-like), so that the
+    array of the i-th tile is flat[offsets[i]:offsets[i + 1]]
+    """
+    def __init__(self, tileIds, offsets, flat):
+        self.tileIds = list(tileIds)
+        self.offsets = np.asarray(offsets)
+        self.flat = flat
+        self.index = {tileId: i for i, tileId in enumerate(self.tileIds)}
+
+    def __getitem__(self, tileId):
+        i = self.index[tileId]
+        return self.flat[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        return iter(self.tileIds)
+
+    def __len__(self):
+        return len(self.tileIds)
+
+    def __getstate__(self):
+        return (self.tileIds, self.offsets, self.flat)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+def match_point_residuals(tilespecs, matches, min_points=1):
+    """residuals of the points of all matches between tilespecs with at
+    least min_points points, with the points of each tile transformed at
+    once
+
+    Returns
+    -------
+    p_tile, q_tile : numpy.ndarray
+        index in tilespecs of the p and q tile of each point
+    counts : numpy.ndarray
+        number of points of each match used
+    res : numpy.ndarray
+        distance between the transformed p and q point of each point match
+    positions : numpy.ndarray
+        Nx2 midpoint of the transformed p and q points
+    """
+    tId_to_index = {ts.tileId: i for i, ts in enumerate(tilespecs)}
+
+    used = [
+        m for m in matches
+        if (len(m['matches']['p'][0]) >= min_points and
+            m['pId'] in tId_to_index and m['qId'] in tId_to_index)]
+    counts = np.array([len(m['matches']['p'][0]) for m in used], dtype=int)
+    npts = int(counts.sum())
+
+    # p and q points of all matches, and the tile index of each
+    pts = np.empty((2 * npts, 2))
+    tile = np.empty(2 * npts, dtype=int)
+    start = 0
+    for m, n in zip(used, counts):
+        pts[start:start + n] = np.transpose(m['matches']['p'])
+        pts[npts + start:npts + start + n] = np.transpose(m['matches']['q'])
+        tile[start:start + n] = tId_to_index[m['pId']]
+        tile[npts + start:npts + start + n] = tId_to_index[m['qId']]
+        start += n
+
+    # transform the points of each tile at once
+    order = np.argsort(tile, kind='stable')
+    bounds = np.searchsorted(tile[order], np.arange(len(tilespecs) + 1))
+    tpts = np.empty_like(pts)
+    for i in np.flatnonzero(np.diff(bounds)):
+        idx = order[bounds[i]:bounds[i + 1]]
+        tpts[idx] = tilespecs[i].tforms[-1].tform(pts[idx])
+    t_p, t_q = tpts[:npts], tpts[npts:]
+
+    res = np.linalg.norm(t_p - t_q, axis=1)
+    positions = (t_p + t_q) / 2.
+    return tile[:npts], tile[npts:], counts, res, positions
+
+
 def compute_residuals(tilespecs, matches, min_points=1, extra_statistics=None):
-    """from compute_residuals_in_group for in-memory"""
+    """from compute_residuals_in_group for in-memory.  The statistics of
+    each point (see match_point_residuals) are attributed to the p tile
+    of its match.
+
+    Returns
+    -------
+    statistics : dict
+        extra_statistics with TileArrays 'tile_residuals', 'tile_rmse' and
+        'pt_match_positions' of the tiles with matches, in tilespec order
+    matches : list
+        the input matches
+    """
     extra_statistics = extra_statistics or {}
 
-    tId_to_tforms = {ts.tileId: ts.tforms for ts in tilespecs}
+    p_tile, _, counts, res, positions = match_point_residuals(
+        tilespecs, matches, min_points=min_points)
+    rmse = np.true_divide(res, np.repeat(counts, counts))
 
-    tile_residuals = {key: np.empty((0, 1)) for key in tId_to_tforms.keys()}
-    tile_rmse = {key: np.empty((0, 1)) for key in tId_to_tforms.keys()}
-    pt_match_positions = {key: np.empty((0, 2)) for key in tId_to_tforms.keys()}
+    # group by p tile, keeping match order within a tile
+    order = np.argsort(p_tile, kind='stable')
+    tile_counts = np.bincount(p_tile, minlength=len(tilespecs))
+    nonempty = np.flatnonzero(tile_counts)
+    offsets = np.concatenate([[0], np.cumsum(tile_counts[nonempty])])
+    tileIds = [tilespecs[i].tileId for i in nonempty]
 
     statistics = {}
-
-    for match in matches:
-        pts_p = np.array(match['matches']['p'])
-        pts_q = np.array(match['matches']['q'])
-    
-        if pts_p.shape[1] < min_points:
-            continue
-
-        try:
-            t_p = tId_to_tforms[match['pId']][-1].tform(pts_p.T)
-            t_q = tId_to_tforms[match['qId']][-1].tform(pts_q.T)
-        except KeyError:
-            continue
-
-        positions = (t_p + t_q) / 2.
-    
-        res = np.linalg.norm(t_p - t_q, axis=1)
-        rmse = np.true_divide(res, res.shape[0])
-
-        tile_residuals[match['pId']] = np.append(
-            tile_residuals[match['pId']], res)
-        tile_rmse[match['pId']] = np.append(
-            tile_rmse[match['pId']], rmse)
-        pt_match_positions[match['pId']] = np.append(
-            pt_match_positions[match['pId']], positions, axis=0)
-
-    empty_keys = [k for k in tile_residuals if tile_residuals[k].size == 0]
-
-    for k in empty_keys:
-        tile_residuals.pop(k)
-        tile_rmse.pop(k)
-        pt_match_positions.pop(k)
-
-    statistics['tile_rmse'] = tile_rmse
-    statistics['tile_residuals'] = tile_residuals
-    statistics['pt_match_positions'] = pt_match_positions
+    statistics['tile_rmse'] = TileArrays(tileIds, offsets, rmse[order])
+    statistics['tile_residuals'] = TileArrays(tileIds, offsets, res[order])
+    statistics['pt_match_positions'] = TileArrays(
+        tileIds, offsets, positions[order])
 
     statistics = {**extra_statistics, **statistics}
-    
+
     return statistics, matches
 
 
@@ -92,7 +156,7 @@ def compute_mean_tile_residuals(residuals):
         tileId: (np.nanmean(tile_residuals) if tile_residuals.size else np.nan)
         for tileId, tile_residuals in residuals.items()
     }
-    tile_residual_max = np.nanmax(tile_mean.values())
+    tile_residual_max = np.nanmax(list(tile_mean.values()))
 
     return {
         tileId: (
@@ -0,0 +1,125 @@
+"""
+mergeable quantile sketches of many keyed streams of non-negative values,
+such as the point match residuals of each tile of a stack.  As in
+DDSketch, values are counted in logarithmically spaced bins, so that
+quantiles are answered within a relative accuracy using memory bounded by
+the range of the values rather than their number.
+"""
+import numpy as np
+
+
+class KeyedQuantileSketch(object):
+    """log-binned histograms of non-negative values for integer keys,
+    stored sparsely as (key, bin, count, sum) rows sorted by key and bin
+
+    Parameters
+    ----------
+    alpha : float
+        relative accuracy of quantiles
+    min_value : float
+        values at or below min_value are counted as 0
+    """
+    def __init__(self, alpha=0.01, min_value=1e-3):
+        self.alpha = alpha
+        self.min_value = min_value
+        self.gamma = (1. + alpha) / (1. - alpha)
+        self.keys = np.empty(0, dtype=np.int64)
+        self.bins = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.sums = np.empty(0)
+
+    def bin_index(self, values):
+        """bin of each value: 0 up to min_value, then i for values in
+        (min_value * gamma**(i - 1), min_value * gamma**i]
+        """
+        values = np.asarray(values, dtype=float)
+        bins = np.zeros(values.shape, dtype=np.int64)
+        pos = values > self.min_value
+        bins[pos] = np.ceil(
+            np.log(values[pos] / self.min_value) / np.log(self.gamma))
+        return bins
+
+    def bin_value(self, bins):
+        """value within alpha of every value of each bin"""
+        return np.where(
+            bins > 0,
+            2. * self.min_value * self.gamma ** bins / (self.gamma + 1.),
+            0.)
+
+    def _combine(self, keys, bins, counts, sums):
+        keys = np.concatenate([self.keys, keys])
+        bins = np.concatenate([self.bins, bins])
+        counts = np.concatenate([self.counts, counts])
+        sums = np.concatenate([self.sums, sums])
+        order = np.lexsort((bins, keys))
+        keys, bins = keys[order], bins[order]
+        start = np.flatnonzero(np.concatenate([
+            [True], (keys[1:] != keys[:-1]) | (bins[1:] != bins[:-1])]))
+        if keys.size:
+            self.counts = np.add.reduceat(counts[order], start)
+            self.sums = np.add.reduceat(sums[order], start)
+        else:
+            self.counts, self.sums = counts, sums
+        self.keys, self.bins = keys[start], bins[start]
+
+    def add(self, keys, values):
+        """count each of values for its key in keys"""
+        values = np.asarray(values, dtype=float)
+        self._combine(
+            np.asarray(keys, dtype=np.int64), self.bin_index(values),
+            np.ones(values.shape, dtype=np.int64), values)
+
+    def merge(self, other):
+        """add the counts of another sketch with the same binning"""
+        if (other.alpha, other.min_value) != (self.alpha, self.min_value):
+            raise ValueError("cannot merge sketches with different bins")
+        self._combine(other.keys, other.bins, other.counts, other.sums)
+
+    def relabel(self, mapping):
+        """replace each key k by mapping[k]"""
+        keys, self.keys = np.asarray(mapping)[self.keys], self.keys[:0]
+        bins, self.bins = self.bins, self.bins[:0]
+        counts, self.counts = self.counts, self.counts[:0]
+        sums, self.sums = self.sums, self.sums[:0]
+        self._combine(keys, bins, counts, sums)
+
+    def pop(self, keys):
+        """remove the rows of keys into a new sketch"""
+        selected = np.isin(self.keys, keys)
+        popped = KeyedQuantileSketch(self.alpha, self.min_value)
+        popped.keys, self.keys = self.keys[selected], self.keys[~selected]
+        popped.bins, self.bins = self.bins[selected], self.bins[~selected]
+        popped.counts, self.counts = (
+            self.counts[selected], self.counts[~selected])
+        popped.sums, self.sums = self.sums[selected], self.sums[~selected]
+        return popped
+
+    def summary(self, quantiles=(0.5, 0.9, 0.99)):
+        """count, mean and quantiles (the lower order statistic of each,
+        within alpha) of the values of each key
+
+        Returns
+        -------
+        keys : numpy.ndarray
+            keys with values, ascending
+        count : numpy.ndarray
+            number of values of each key
+        mean : numpy.ndarray
+            mean value of each key
+        quantile_values : numpy.ndarray
+            len(keys) x len(quantiles) quantiles of each key
+        """
+        start = np.flatnonzero(np.concatenate([
+            [True], self.keys[1:] != self.keys[:-1]]))[:self.keys.size]
+        if not self.keys.size:
+            return (self.keys, self.counts, self.sums,
+                    np.empty((0, len(quantiles))))
+        count = np.add.reduceat(self.counts, start)
+        mean = np.add.reduceat(self.sums, start) / count
+
+        cum = np.cumsum(self.counts)
+        before = cum[start] - self.counts[start]
+        rank = np.floor(
+            np.outer(count - 1, quantiles)).astype(np.int64)
+        row = np.searchsorted(cum, before[:, None] + rank, side='right')
+        return self.keys[start], count, mean, self.bin_value(self.bins[row])
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+"""
+stack-wide survey of point match residuals.  Point counts, mean residual
+and the p50, p90 and p99 residuals are summarized for each section, each
+tile and the whole stack, separately for matches within sections and
+between sections.  Residuals are only kept in KeyedQuantileSketch, so
+memory does not grow with the number of points, and the summaries are
+written as columns of npz files.
+"""
+import logging
+import os
+
+import numpy as np
+import renderapi
+import requests
+
+from asap.module.render_module import StackInputModule
+from asap.residuals.compute_residuals import match_point_residuals
+from asap.residuals.quantile_sketch import KeyedQuantileSketch
+from asap.residuals.schemas import (
+    ResidualSurveyOutputSchema, ResidualSurveyParameters)
+from asap.utilities.threads import worker_pool_kwargs
+
+if __name__ == "__main__" and __package__ is None:
+    __package__ = "asap.residuals.residual_survey"
+
+
+example = {
+    "render": {
+        "host": "em-131db2",
+        "port": 8080,
+        "owner": "TEM",
+        "project": "17797_1R",
+        "client_scripts": "/allen/aibs/pipeline/image_processing/volume_assembly/render-jars/production/scripts"},
+    "input_stack": "em_2d_montage_solved",
+    "match_collection": "default_point_matches",
+    "minZ": 1015,
+    "maxZ": 1120,
+    "zNeighborDistance": 0,
+    "output_dir": "./residual_survey",
+    "pool_size": 8
+}
+
+logger = logging.getLogger()
+
+SUMMARY_QUANTILES = (0.5, 0.9, 0.99)
+SUMMARY_COLUMNS = ["count", "mean", "p50", "p90", "p99"]
+
+
+def survey_blocks(zValues, sections_per_job=16, zNeighborDistance=0):
+    """consecutive blocks of sections_per_job of the sorted zValues, each
+    with the following z values within zNeighborDistance of its last,
+    whose sections are needed for the matches between sections
+    """
+    zs = sorted(zValues)
+    blocks = []
+    for i in range(0, len(zs), sections_per_job):
+        block = zs[i:i + sections_per_job]
+        halo = [z for z in zs[i + sections_per_job:]
+                if z - block[-1] <= zNeighborDistance]
+        blocks.append((block, halo))
+    return blocks
+
+
+def summary_columns(sketch):
+    """keys and SUMMARY_COLUMNS of the summary of a sketch"""
+    keys, count, mean, q = sketch.summary(SUMMARY_QUANTILES)
+    return keys, dict(zip(SUMMARY_COLUMNS, [count, mean] + list(q.T)))
+
+
+def survey_block(fargs):
+    """residual sketches of the matches within each section of a block,
+    and between them and the sections up to zNeighborDistance above
+
+    Returns
+    -------
+    tileIds : list
+        tileIds of the sections of the block and its halo
+    tile_z : numpy.ndarray
+        z of each of tileIds
+    tiles : KeyedQuantileSketch
+        residuals of the matches of each tile, keyed by 2 * its index in
+        tileIds, plus 1 for matches between sections
+    sections : KeyedQuantileSketch
+        residuals of the matches of each section, keyed by 2 * its index
+        in block, plus 1 for matches to sections above
+    """
+    [block, halo, input_stack, match_collection, match_owner,
+        within_section, zNeighborDistance, min_points, alpha, rpar] = fargs
+
+    render = renderapi.connect(**rpar)
+    session = requests.session()
+
+    tspecs = {}
+    for z in block + halo:
+        try:
+            tspecs[z] = render.run(
+                renderapi.tilespec.get_tile_specs_from_z,
+                input_stack, z, session=session)
+        except renderapi.errors.RenderError as e:
+            logger.warning(str(e))
+            tspecs[z] = []
+    base = dict(zip(block + halo, np.cumsum(
+        [0] + [len(tspecs[z]) for z in block + halo])))
+
+    tiles = KeyedQuantileSketch(alpha)
+    sections = KeyedQuantileSketch(alpha)
+    for zi, z in enumerate(block):
+        if not tspecs[z]:
+            continue
+        groups = []
+        if within_section:
+            groups.append((z, 0))
+        groups += [(z2, 1) for z2 in block + halo
+                   if 0 < z2 - z <= zNeighborDistance and tspecs[z2]]
+        for z2, cross in groups:
+            pgroup = tspecs[z][0].layout.sectionId
+            qgroup = tspecs[z2][0].layout.sectionId
+            if cross:
+                matches = render.run(
+                    renderapi.pointmatch.get_matches_from_group_to_group,
+                    match_collection, pgroup, qgroup,
+                    owner=match_owner, session=session)
+                pair_tspecs = tspecs[z] + tspecs[z2]
+            else:
+                matches = render.run(
+                    renderapi.pointmatch.get_matches_within_group,
+                    match_collection, pgroup,
+                    owner=match_owner, session=session)
+                pair_tspecs = tspecs[z]
+            p_tile, q_tile, _, res, _ = match_point_residuals(
+                pair_tspecs, matches, min_points=min_points)
+
+            # indices of the pair's tiles among the block's tileIds
+            n = len(tspecs[z])
+            tile_index = np.concatenate([
+                base[z] + np.arange(n),
+                base[z2] + np.arange(len(pair_tspecs) - n)])
+            tiles.add(
+                2 * tile_index[np.concatenate([p_tile, q_tile])] + cross,
+                np.concatenate([res, res]))
+            sections.add(np.full(res.shape, 2 * zi + cross), res)
+    session.close()
+
+    tileIds = [ts.tileId for z in block + halo for ts in tspecs[z]]
+    tile_z = np.array([ts.z for z in block + halo for ts in tspecs[z]])
+    return tileIds, tile_z, tiles, sections
+
+
+class ColumnWriter(object):
+    """write rows of named columns to numbered npz files of at most
+    rows_per_file rows
+    """
+    def __init__(self, path_format, rows_per_file=1000000):
+        self.path_format = path_format
+        self.rows_per_file = rows_per_file
+        self.buffer = []
+        self.nrows = 0
+        self.paths = []
+
+    def add(self, columns):
+        nrows = len(next(iter(columns.values())))
+        if nrows == 0:
+            return
+        self.buffer.append(columns)
+        self.nrows += nrows
+        if self.nrows >= self.rows_per_file:
+            self.flush()
+
+    def flush(self, final=False):
+        """write the buffered rows in files of rows_per_file rows, and
+        the remaining rows too if final
+        """
+        if not self.buffer:
+            return
+        columns = {k: np.concatenate([b[k] for b in self.buffer])
+                   for k in self.buffer[0]}
+        nfull = self.nrows - self.nrows % self.rows_per_file
+        end = self.nrows if final else nfull
+        for i in range(0, end, self.rows_per_file):
+            path = self.path_format % len(self.paths)
+            np.savez(path, **{
+                k: v[i:i + self.rows_per_file] for k, v in columns.items()})
+            self.paths.append(path)
+        rest = {k: v[end:] for k, v in columns.items()}
+        self.nrows -= end
+        self.buffer = [rest] if self.nrows else []
+
+    def close(self):
+        self.flush(final=True)
+        return self.paths
+
+
+def read_columns(paths):
+    """columns of npz files written by ColumnWriter, concatenated"""
+    columns = {}
+    for path in paths:
+        with np.load(path) as npz:
+            for k in npz.files:
+                columns.setdefault(k, []).append(npz[k])
+    return {k: np.concatenate(v) for k, v in columns.items()}
+
+
+class ResidualSurvey(StackInputModule):
+    default_schema = ResidualSurveyParameters
+    default_output_schema = ResidualSurveyOutputSchema
+
+    def run(self):
+        zValues = self.get_overlapping_inputstack_zvalues()
+        blocks = survey_blocks(
+            zValues, self.args['sections_per_job'],
+            self.args['zNeighborDistance'])
+        alpha = self.args['quantile_accuracy']
+        fargs = [[
+            block, halo,
+            self.args['input_stack'],
+            self.args['match_collection'],
+            self.args['match_collection_owner'],
+            self.args['within_section'],
+            self.args['zNeighborDistance'],
+            self.args['min_points'],
+            alpha,
+            self.args['render']] for block, halo in blocks]
+
+        if not os.path.isdir(self.args['output_dir']):
+            os.makedirs(self.args['output_dir'])
+        tile_writer = ColumnWriter(
+            os.path.join(self.args['output_dir'], 'tiles_%05d.npz'),
+            self.args['tile_rows_per_file'])
+
+        # tiles stay in active until no later block can match them
+        active = KeyedQuantileSketch(alpha)
+        active_index = {}
+        active_tiles = {}
+        ntiles = 0
+        stack = KeyedQuantileSketch(alpha)
+        section_columns = []
+        with renderapi.client.WithPool(
+                self.args['pool_size'], **worker_pool_kwargs(
+                    self.args['pool_size'],
+                    self.args['threads_per_worker'])) as pool:
+            for (block, _), (tileIds, tile_z, tiles, sections) in zip(
+                    blocks, pool.imap(survey_block, fargs)):
+                index = np.empty(len(tileIds), dtype=np.int64)
+                for i, (tileId, z) in enumerate(zip(tileIds, tile_z)):
+                    if tileId not in active_index:
+                        active_index[tileId] = ntiles
+                        active_tiles[ntiles] = (tileId, z)
+                        ntiles += 1
+                    index[i] = active_index[tileId]
+                tiles.relabel(
+                    np.stack([2 * index, 2 * index + 1], 1).ravel())
+                active.merge(tiles)
+
+                keys, columns = summary_columns(sections)
+                columns['z'] = np.array(block)[keys // 2]
+                columns['cross_section'] = (keys % 2).astype(bool)
+                section_columns.append(columns)
+                sections.relabel(np.arange(2 * len(block)) % 2)
+                stack.merge(sections)
+
+                final = np.array([k for k, (_, z) in active_tiles.items()
+                                  if z <= block[-1]], dtype=np.int64)
+                keys, columns = summary_columns(
+                    active.pop(np.concatenate([2 * final, 2 * final + 1])))
+                columns['tileId'] = np.array(
+                    [active_tiles[k // 2][0] for k in keys], dtype=str)
+                columns['z'] = np.array(
+                    [active_tiles[k // 2][1] for k in keys], dtype=float)
+                columns['cross_section'] = (keys % 2).astype(bool)
+                tile_writer.add(columns)
+                for k in final:
+                    del active_index[active_tiles.pop(k)[0]]
+                self.logger.info(
+                    "surveyed z %s to %s" % (block[0], block[-1]))
+
+        sections_file = os.path.join(self.args['output_dir'], 'sections.npz')
+        np.savez(sections_file, **{
+            k: np.concatenate([c[k] for c in section_columns])
+            for k in section_columns[0]} if section_columns else {})
+        tile_files = tile_writer.close()
+
+        keys, columns = summary_columns(stack)
+        stack_summary = [
+            dict({k: v[i].item() for k, v in columns.items()},
+                 cross_section=bool(keys[i]))
+            for i in range(len(keys))]
+        self.output({
+            "sections_file": sections_file,
+            "tile_files": tile_files,
+            "stack_summary": stack_summary})
+
+
+if __name__ == "__main__":
+    mod = ResidualSurvey()
+    mod.run()
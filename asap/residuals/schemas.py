@@ -0,0 +1,75 @@
+import argschema
+from argschema.fields import Bool, Float, Int, List, Nested, Str
+from asap.module.schemas import InputStackParameters, ProcessPoolParameters
+
+
+class ResidualSurveyParameters(InputStackParameters, ProcessPoolParameters):
+    match_collection = Str(
+        required=True,
+        description="point match collection of the tiles of input_stack")
+    match_collection_owner = Str(
+        required=False,
+        default=None,
+        missing=None,
+        description="owner of match_collection, by default the render owner")
+    within_section = Bool(
+        required=False,
+        default=True,
+        missing=True,
+        description="survey the matches within each section")
+    zNeighborDistance = Int(
+        required=False,
+        default=0,
+        missing=0,
+        description=("also survey the matches between each section and "
+                     "the sections up to this far above it, as for an "
+                     "aligned stack"))
+    min_points = Int(
+        required=False,
+        default=1,
+        missing=1,
+        description="ignore tile pairs with fewer point matches")
+    sections_per_job = Int(
+        required=False,
+        default=16,
+        missing=16,
+        description=("number of consecutive sections whose tilespecs and "
+                     "matches each pool job fetches over one session"))
+    quantile_accuracy = Float(
+        required=False,
+        default=0.01,
+        missing=0.01,
+        description="relative accuracy of the residual quantiles")
+    output_dir = Str(
+        required=True,
+        description="directory to which the summary npz files are written")
+    tile_rows_per_file = Int(
+        required=False,
+        default=1000000,
+        missing=1000000,
+        description="number of tile summaries per tile npz file")
+
+
+class ResidualSummary(argschema.schemas.DefaultSchema):
+    cross_section = Bool(
+        required=True,
+        description="summary of matches between sections")
+    count = Int(required=True, description="number of point matches")
+    mean = Float(required=True, description="mean residual in pixels")
+    p50 = Float(required=True, description="median residual in pixels")
+    p90 = Float(required=True, description="90th percentile residual")
+    p99 = Float(required=True, description="99th percentile residual")
+
+
+class ResidualSurveyOutputSchema(argschema.schemas.DefaultSchema):
+    sections_file = Str(
+        required=True,
+        description="npz file of the residual summary of each section")
+    tile_files = List(
+        Str,
+        required=True,
+        description="npz files of the residual summaries of each tile")
+    stack_summary = List(
+        Nested(ResidualSummary),
+        required=True,
+        description="residual summaries of the whole stack")
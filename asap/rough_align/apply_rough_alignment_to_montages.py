@@ -19,6 +19,7 @@ from asap.rough_align.schemas import (
 from asap.stack.consolidate_transforms import consolidate_transforms
 from asap.rough_align.downsample_mask_handler \
         import polygon_list_from_mask
+from asap.utilities.threads import worker_pool_kwargs
 
 if __name__ == "__main__" and __package__ is None:
     __package__ = "asap.rough_align.apply_rough_alignment_to_montages"
@@ -334,7 +335,10 @@ class ApplyRoughAlignmentTransform(RenderModule):
                 renderapi.stack.get_full_stack_metadata,
                 self.args['lowres_stack'])['state']
 
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
+        with renderapi.client.WithPool(
+                self.args['pool_size'], **worker_pool_kwargs(
+                    self.args['pool_size'],
+                    self.args['threads_per_worker'])) as pool:
             results = pool.map(mypartial, Z)
 
         # raise an exception if all the z values to apply alignment were not
@@ -11,6 +11,7 @@ from asap.module.render_module import (
 from asap.rough_align.schemas import (
         PairwiseRigidSchema,
         PairwiseRigidOutputSchema)
+from asap.utilities.threads import worker_pool_kwargs
 
 
 example = {
@@ -221,7 +222,10 @@ class PairwiseRigidRoughAlignment(StackTransitionModule):
                     tilespecs[i],
                     ] for i in range(1, len(tilespecs))]
 
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
+        with renderapi.client.WithPool(
+                self.args['pool_size'], **worker_pool_kwargs(
+                    self.args['pool_size'],
+                    self.args['threads_per_worker'])) as pool:
             result = {}
             result['residuals'] = []
             for r in pool.map(check_func, fargs):
@@ -262,7 +266,10 @@ class PairwiseRigidRoughAlignment(StackTransitionModule):
         new_tilespecs = [{
             'spec': anchor_spec,
             'dist': 0}]
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
+        with renderapi.client.WithPool(
+                self.args['pool_size'], **worker_pool_kwargs(
+                    self.args['pool_size'],
+                    self.args['threads_per_worker'])) as pool:
             for result in pool.map(estimate_func, fargs):
                 M = M.dot(result['transform'].M)
                 newtf = renderapi.transform.RigidModel()
@@ -10,6 +10,7 @@ from argschema.schemas import DefaultSchema, ArgSchema
 
 from asap.module.schemas import (
     RenderParameters,
+    ProcessPoolParameters,
     StackTransitionParameters)
 
 
@@ -92,7 +93,8 @@ class PairwiseRigidOutputSchema(DefaultSchema):
         description="pairwise residuals in output stack")
 
 
-class ApplyRoughAlignmentTransformParameters(RenderParameters):
+class ApplyRoughAlignmentTransformParameters(
+        RenderParameters, ProcessPoolParameters):
     montage_stack = mm.fields.Str(
         required=True,
         description='stack to make a downsample version of')
@@ -11,6 +11,7 @@ from asap.stack.schemas import (
     ConsolidateTransformsOutputParameters, ConsolidateTransformsParameters)
 from asap.module.render_module import (
     RenderModule, RenderModuleException)
+from asap.utilities.threads import worker_pool_kwargs
 
 example_json = {
     "render": {
@@ -142,7 +143,10 @@ class ConsolidateTransforms(RenderModule):
                 except renderapi.errors.RenderError as e:
                     self.logger.error(e)
 
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
+        with renderapi.client.WithPool(
+                self.args['pool_size'], **worker_pool_kwargs(
+                    self.args['pool_size'],
+                    self.args['threads_per_worker'])) as pool:
             mypartial = partial(
                 process_z,
                 self.render,
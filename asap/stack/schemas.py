@@ -3,10 +3,12 @@ from argschema.fields import (Str, Int, Slice, Float, Boolean,
 from argschema.schemas import DefaultSchema
 
 from asap.module.schemas import (RenderParameters,
-                                          StackTransitionParameters)
+                                 ProcessPoolParameters,
+                                 StackTransitionParameters)
 
 
-class ConsolidateTransformsParameters(RenderParameters):
+class ConsolidateTransformsParameters(RenderParameters,
+                                      ProcessPoolParameters):
     stack = Str(required=True,
                 description='stack to consolidate')
     postfix = Str(required=False, default="_CONS",
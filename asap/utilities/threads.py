@@ -0,0 +1,57 @@
+"""
+per-worker thread budgets for process pools, so that opencv, OpenMP and
+BLAS in each of many worker processes do not each start a thread per core
+"""
+import multiprocessing
+import os
+
+import cv2
+
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+def resolve_workers(workers):
+    """number of worker processes, with -1 meaning one per cpu"""
+    return multiprocessing.cpu_count() if workers == -1 else workers
+
+
+def threads_for_workers(workers, threads_per_worker=None):
+    """threads each of workers processes may use: threads_per_worker, or
+    by default an equal share of the cpus
+    """
+    if threads_per_worker is not None:
+        return threads_per_worker
+    return max(multiprocessing.cpu_count() // resolve_workers(workers), 1)
+
+
+def set_thread_budget(threads):
+    """limit the threads of opencv, OpenMP and BLAS in this process.
+    Environment variables cover libraries loaded later, and already
+    loaded BLAS and OpenMP runtimes are limited with threadpoolctl if it
+    is installed.  A budget of 0 leaves the libraries' defaults.
+    """
+    if not threads:
+        return
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+    cv2.setNumThreads(threads)
+    if threadpoolctl is not None:
+        threadpoolctl.threadpool_limits(threads)
+
+
+def worker_pool_kwargs(workers, threads_per_worker=None):
+    """initializer keyword arguments applying the thread budget of
+    threads_for_workers in each worker of a multiprocessing Pool
+    (including renderapi.client.WithPool) or a
+    concurrent.futures.ProcessPoolExecutor
+    """
+    return {
+        "initializer": set_thread_budget,
+        "initargs": (threads_for_workers(workers, threads_per_worker),)}
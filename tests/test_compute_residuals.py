@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+test point match residuals of tilespecs
+"""
+import pickle
+import time
+
+import numpy as np
+import renderapi
+
+from asap.residuals.compute_residuals import (
+    compute_mean_tile_residuals, compute_residuals)
+from tests_test_data import timing_test
+
+
+def synthetic_montage(ntiles, npts=10, seed=0):
+    """tilespecs of a row of tiles with slightly wrong affines, and
+    matches between neighbors
+    """
+    rng = np.random.default_rng(seed)
+    tspecs = [
+        renderapi.tilespec.TileSpec(
+            tileId="t%d" % i, z=1, width=100, height=100,
+            tforms=[renderapi.transform.AffineModel(
+                M00=1 + rng.normal(0, 0.01), M11=1 + rng.normal(0, 0.01),
+                B0=90. * i + rng.normal(0, 2), B1=rng.normal(0, 2))])
+        for i in range(ntiles)]
+    matches = []
+    for i in range(ntiles - 1):
+        n = npts + i % 3
+        p = np.stack([rng.uniform(90, 100, n), rng.uniform(0, 100, n)])
+        q = p - np.array([[90.], [0.]])
+        matches.append({
+            "pId": "t%d" % i, "qId": "t%d" % (i + 1),
+            "matches": {"p": p.tolist(), "q": q.tolist(), "w": [1.] * n}})
+    return tspecs, matches
+
+
+def reference_residuals(tilespecs, matches, min_points=1):
+    """per-match residuals attributed to the p tile, as lists per tile"""
+    tforms = {ts.tileId: ts.tforms[-1] for ts in tilespecs}
+    stats = {k: {} for k in
+             ['tile_residuals', 'tile_rmse', 'pt_match_positions']}
+    for m in matches:
+        p = np.array(m['matches']['p'])
+        if (p.shape[1] < min_points or m['pId'] not in tforms or
+                m['qId'] not in tforms):
+            continue
+        t_p = tforms[m['pId']].tform(p.T)
+        t_q = tforms[m['qId']].tform(np.array(m['matches']['q']).T)
+        res = np.linalg.norm(t_p - t_q, axis=1)
+        for k, v in [('tile_residuals', res),
+                     ('tile_rmse', res / res.shape[0]),
+                     ('pt_match_positions', (t_p + t_q) / 2.)]:
+            stats[k].setdefault(m['pId'], []).append(v)
+    return {k: {t: np.concatenate(v) for t, v in s.items()}
+            for k, s in stats.items()}
+
+
+def test_compute_residuals():
+    tspecs, matches = synthetic_montage(30)
+    # a match to a tile without a tilespec, and one reversed
+    matches.append(dict(matches[0], qId="missing"))
+    matches.append(dict(matches[5], pId=matches[5]["qId"],
+                        qId=matches[5]["pId"]))
+
+    for min_points in [1, 11]:
+        stats, out = compute_residuals(
+            tspecs, matches, min_points=min_points,
+            extra_statistics={"z": 1})
+        expected = reference_residuals(tspecs, matches, min_points)
+        assert out is matches
+        assert stats["z"] == 1
+        for k, v in expected.items():
+            assert list(stats[k]) == [
+                ts.tileId for ts in tspecs if ts.tileId in v]
+            for tileId in v:
+                assert np.allclose(stats[k][tileId], v[tileId])
+            assert np.allclose(stats[k].flat, np.concatenate(
+                [v[ts.tileId] for ts in tspecs if ts.tileId in v]))
+
+    copied = pickle.loads(pickle.dumps(stats["tile_residuals"]))
+    assert dict(copied).keys() == dict(stats["tile_residuals"]).keys()
+    mean = compute_mean_tile_residuals(stats["tile_residuals"])
+    assert mean["t2"] == np.mean(stats["tile_residuals"]["t2"])
+
+
+def test_compute_residuals_large_section():
+    tspecs, matches = synthetic_montage(5000)
+    stats, _ = compute_residuals(tspecs, matches)
+    assert len(stats["tile_residuals"]) == 4999
+    assert stats["tile_residuals"].flat.size == sum(
+        len(m["matches"]["w"]) for m in matches)
+
+
+@timing_test
+def test_compute_residuals_large_section_timing():
+    tspecs, matches = synthetic_montage(5000)
+    start = time.perf_counter()
+    compute_residuals(tspecs, matches)
+    assert time.perf_counter() - start < 1.0
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+test point match filtering against per-pair affine fits
+"""
+import json
+import time
+
+import numpy as np
+import pytest
+import renderapi
+
+from asap.pointmatch_filter.filter_point_matches import (
+    FilterMatches, fit_affine_pairs, pack_matches, proc_job)
+from tests_test_data import timing_test
+
+
+def synthetic_section(npairs, npts=20, seed=0):
+    """tilespecs and noisy affine matches of a section of npairs pairs"""
+    rng = np.random.default_rng(seed)
+    ntiles = npairs + 1
+    tspecs = [
+        renderapi.tilespec.TileSpec(
+            tileId="t%d" % i, z=1, width=100, height=100,
+            layout=renderapi.tilespec.Layout(sectionId="1.0"),
+            tforms=[renderapi.transform.AffineModel(
+                B0=90. * i, B1=rng.uniform(-5, 5))])
+        for i in range(ntiles)]
+    matches = []
+    for i in range(npairs):
+        n = npts + i % 5
+        p = rng.uniform(0, 100, (n, 2))
+        L = np.eye(2) + rng.normal(0, 0.01, (2, 2))
+        q = p.dot(L.T) + rng.normal(0, 50, 2) + rng.normal(0, 2, (n, 2))
+        matches.append({
+            "pId": "t%d" % i, "pGroupId": "1.0",
+            "qId": "t%d" % (i + 1), "qGroupId": "1.0",
+            "matches": {
+                "p": p.T.tolist(), "q": q.T.tolist(), "w": [1.0] * n}})
+    # a degenerate pair of collinear points
+    matches[0]["matches"]["p"][1] = [3.0] * len(matches[0]["matches"]["w"])
+    return tspecs, matches
+
+
+@pytest.fixture
+def fake_render(monkeypatch):
+    section = {}
+    monkeypatch.setattr(renderapi, "connect", lambda **kwargs: None)
+    monkeypatch.setattr(renderapi.render, "connect", lambda **kwargs: None)
+    monkeypatch.setattr(
+        renderapi.tilespec, "get_tile_specs_from_z",
+        lambda stack, z, render=None: section["tspecs"])
+    monkeypatch.setattr(
+        renderapi.pointmatch, "get_matches_within_group",
+        lambda collection, group, render=None: section["matches"])
+    monkeypatch.setattr(
+        renderapi.pointmatch, "import_matches",
+        lambda collection, matches, render=None: section.setdefault(
+            "imported", []).extend(matches))
+    return section
+
+
+def test_fit_affine_pairs():
+    tspecs, matches = synthetic_section(50)
+    params, residuals = fit_affine_pairs(*pack_matches(matches))
+    for m, tvec, res in zip(matches, params, residuals):
+        A = np.transpose(m["matches"]["p"])
+        B = np.transpose(m["matches"]["q"])
+        e_tvec, e_res, rank, _ = renderapi.transform.AffineModel.fit(
+            A, B, return_all=True)
+        assert np.allclose(tvec, e_tvec.squeeze(), atol=1e-8)
+        if rank == 6:
+            assert np.isclose(res, e_res[0])
+        else:
+            e_fit = np.stack([
+                A.dot(e_tvec[0:2, 0]) + e_tvec[4, 0],
+                A.dot(e_tvec[2:4, 0]) + e_tvec[5, 0]], axis=1)
+            assert np.isclose(res, np.sum((B - e_fit) ** 2))
+
+
+def test_proc_job(fake_render):
+    tspecs, matches = synthetic_section(200)
+    fake_render.update(tspecs=tspecs, matches=matches[1:])
+    resmax = 2.0
+    result = proc_job([
+        "collection", None, "stack", 1, resmax, 500.0, {}, False,
+        None, "weight", 5])
+
+    xy = {t.tileId: (t.tforms[-1].B0, t.tforms[-1].B1) for t in tspecs}
+    assert len(result["filter"]) == len(matches) - 1
+    for m, f in zip(matches[1:], result["filter"]):
+        A = np.transpose(m["matches"]["p"])
+        B = np.transpose(m["matches"]["q"])
+        tvec, res, _, _ = renderapi.transform.AffineModel.fit(
+            A, B, return_all=True)
+        dx = xy[m["pId"]][0] - xy[m["qId"]][0]
+        dy = xy[m["pId"]][1] - xy[m["qId"]][1]
+        nres = np.sqrt(res[0] / len(m["matches"]["w"]))
+        trans = np.sqrt((dx - tvec[4, 0]) ** 2 + (dy - tvec[5, 0]) ** 2)
+        assert (f["pId"], f["qId"]) == (m["pId"], m["qId"])
+        assert f["nres"] == pytest.approx(nres, abs=1e-3)
+        assert f["translation"] == pytest.approx(trans, abs=1e-3)
+        assert f["count"] == len(m["matches"]["w"])
+        assert f["weight"] == (0.0 if f["nres"] > resmax else 1.0)
+    assert {f["weight"] for f in result["filter"]} == {0.0, 1.0}
+
+
+def large_section_job(fake_render):
+    tspecs, matches = synthetic_section(10000)
+    fake_render.update(tspecs=tspecs, matches=matches)
+    return [
+        "collection", None, "stack", 1, 5.0, 500.0, {}, False,
+        None, "weight", 5]
+
+
+def test_proc_job_large_section(fake_render):
+    result = proc_job(large_section_job(fake_render))
+    assert len(result["filter"]) == 10000
+    assert {f["weight"] for f in result["filter"]} == {0.0, 1.0}
+
+
+@timing_test
+def test_proc_job_large_section_timing(fake_render):
+    job = large_section_job(fake_render)
+    start = time.perf_counter()
+    proc_job(job)
+    assert time.perf_counter() - start < 1.0
+
+
+def with_outliers(matches, fraction=0.2, seed=1):
+    """matches with a fraction of their q points moved far off, and the
+    masks of the moved points
+    """
+    rng = np.random.default_rng(seed)
+    masks = []
+    for m in matches:
+        q = np.array(m["matches"]["q"])
+        out = rng.random(q.shape[1]) < fraction
+        q[:, out] += rng.uniform(30, 60, (2, out.sum())) * rng.choice(
+            [-1, 1], (2, out.sum()))
+        m["matches"]["q"] = q.tolist()
+        masks.append(out)
+    return matches, masks
+
+
+@pytest.mark.parametrize("mode", ["weight", "drop"])
+def test_point_filter(fake_render, mode):
+    tspecs, matches = synthetic_section(100, npts=40)
+    matches, outliers = with_outliers(matches[1:])
+    fake_render.update(tspecs=tspecs, matches=matches)
+    result = proc_job([
+        "collection", "filtered", "stack", 1, 5.0, 500.0, {}, False,
+        10.0, mode, 5])
+
+    imported = fake_render["imported"]
+    assert len(imported) == len(matches)
+    for m, out, f, im in zip(matches, outliers, result["filter"], imported):
+        assert f["rejected"] == out.sum()
+        assert f["count"] == (~out).sum()
+        assert f["nres"] < 4.0
+        assert f["weight"] == 1.0
+        if mode == "weight":
+            assert np.array_equal(im["matches"]["w"], ~out)
+            assert im["matches"]["p"] == m["matches"]["p"]
+        else:
+            assert im["matches"]["w"] == [1.0] * (~out).sum()
+            assert np.array_equal(
+                im["matches"]["q"], np.array(m["matches"]["q"])[:, ~out])
+            assert len(m["matches"]["w"]) == len(out)
+
+
+def test_filter_matches_resume(fake_render, tmpdir):
+    tspecs, matches = synthetic_section(20)
+    fake_render.update(tspecs=tspecs, matches=matches[1:])
+    output_file = str(tmpdir.join("filter.jsonl"))
+    input_data = {
+        "render": {"host": "localhost", "port": 8080, "owner": "o",
+                   "project": "p", "client_scripts": str(tmpdir)},
+        "input_stack": "stack",
+        "input_match_collection": "collection",
+        "output_match_collection": "filtered",
+        "resmax": 2.0,
+        "transmax": 500.0,
+        "zValues": [1, 2, 3],
+        "pool_size": 1,
+        "filter_output_file": output_file,
+        "filter_output_format": "jsonl",
+        "resume": True,
+        "match_batch_size": 7,
+        "output_json": str(tmpdir.join("output.json"))}
+
+    # an interrupted run leaving z=2 and part of a line
+    mod = FilterMatches(
+        input_data=dict(input_data, zValues=[2]), args=[])
+    mod.run()
+    with open(output_file, "a") as f:
+        f.write('{"z": 1, "filt')
+    assert len(fake_render["imported"]) == len(matches) - 1
+
+    mod = FilterMatches(input_data=input_data, args=[])
+    mod.run()
+    with open(output_file) as f:
+        results = [json.loads(line) for line in f]
+    assert sorted(r["z"] for r in results) == [1, 2, 3]
+    assert all(len(r["filter"]) == len(matches) - 1 for r in results)
+    assert len(fake_render["imported"]) == 3 * (len(matches) - 1)
+
+
+def test_filter_matches_status_records(fake_render, monkeypatch, tmpdir):
+    tspecs, matches = synthetic_section(5)
+    fake_render.update(matches=matches[1:])
+    empty_tspecs = [renderapi.tilespec.TileSpec(
+        tileId="e", layout=renderapi.tilespec.Layout(sectionId="3.0"))]
+    failing = {2.0}
+
+    def get_tile_specs_from_z(stack, z, render=None):
+        if z in failing:
+            raise renderapi.errors.RenderError("z=%d unavailable" % z)
+        return empty_tspecs if z == 3.0 else tspecs
+
+    def get_matches_within_group(collection, group, render=None):
+        return [] if group == "3.0" else fake_render["matches"]
+    monkeypatch.setattr(
+        renderapi.tilespec, "get_tile_specs_from_z", get_tile_specs_from_z)
+    monkeypatch.setattr(
+        renderapi.pointmatch, "get_matches_within_group",
+        get_matches_within_group)
+
+    output_file = str(tmpdir.join("filter.jsonl"))
+    input_data = {
+        "render": {"host": "localhost", "port": 8080, "owner": "o",
+                   "project": "p", "client_scripts": str(tmpdir)},
+        "input_stack": "stack",
+        "input_match_collection": "collection",
+        "resmax": 2.0,
+        "transmax": 500.0,
+        "zValues": [1, 2, 3],
+        "pool_size": 1,
+        "filter_output_file": output_file,
+        "filter_output_format": "jsonl",
+        "resume": True,
+        "output_json": str(tmpdir.join("output.json"))}
+
+    def output_lines():
+        with open(output_file) as f:
+            return sorted((r["z"], r.get("status", "")) for r in map(
+                json.loads, f))
+
+    FilterMatches(input_data=input_data, args=[]).run()
+    assert output_lines() == [(1, ""), (2, "error"), (3, "empty")]
+
+    # resuming skips the empty z and retries the one that failed
+    failing.clear()
+    FilterMatches(input_data=input_data, args=[]).run()
+    assert output_lines() == [
+        (1, ""), (2, ""), (2, "error"), (3, "empty")]
+
+    # the json list output holds only filter results
+    json_file = str(tmpdir.join("filter.json"))
+    FilterMatches(input_data=dict(
+        input_data, filter_output_file=json_file,
+        filter_output_format="json", resume=False), args=[]).run()
+    with open(json_file) as f:
+        assert [r["z"] for r in json.load(f)] == [1, 2]
+
+
+def test_filter_matches_streams_lines(fake_render, monkeypatch, tmpdir):
+    tspecs, matches = synthetic_section(20)
+    fake_render.update(tspecs=tspecs, matches=matches[1:])
+    output_file = str(tmpdir.join("filter.jsonl"))
+
+    # number of result lines already written at each batch import
+    lines_at_import = []
+
+    def import_matches(collection, matches, render=None):
+        with open(output_file) as f:
+            lines_at_import.append(len(f.readlines()))
+    monkeypatch.setattr(
+        renderapi.pointmatch, "import_matches", import_matches)
+
+    mod = FilterMatches(input_data={
+        "render": {"host": "localhost", "port": 8080, "owner": "o",
+                   "project": "p", "client_scripts": str(tmpdir)},
+        "input_stack": "stack",
+        "input_match_collection": "collection",
+        "output_match_collection": "filtered",
+        "resmax": 2.0,
+        "transmax": 500.0,
+        "zValues": list(range(10)),
+        "pool_size": 1,
+        "filter_output_file": output_file,
+        "filter_output_format": "jsonl",
+        "match_batch_size": 50,
+        "output_json": str(tmpdir.join("output.json"))}, args=[])
+    mod.run()
+
+    # 10 z of 19 pairs in batches of 50: each line follows the batch that
+    # completed its z's updates
+    assert lines_at_import == [0, 2, 5, 7]
+    with open(output_file) as f:
+        assert len(f.readlines()) == 10
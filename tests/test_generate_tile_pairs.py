@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+test in-process tile pair generation on synthetic tile grids
+"""
+import numpy
+import renderapi
+
+from asap.pointmatch.generate_tile_pairs import (
+    completely_obscured, generate_tile_pairs, metafile_tile_pairs,
+    tile_bounds)
+
+TILE_SIZE = 100
+TILE_STEP = 90
+
+
+def make_grid_tilespecs(z, nrows=3, ncols=3):
+    tilespecs = []
+    for r in range(nrows):
+        for c in range(ncols):
+            x, y = c * TILE_STEP, r * TILE_STEP
+            ts = renderapi.tilespec.TileSpec(
+                tileId="z{}_r{}_c{}".format(z, r, c), z=z,
+                width=TILE_SIZE, height=TILE_SIZE,
+                sectionId=str(float(z)), imageRow=r, imageCol=c,
+                tforms=[renderapi.transform.AffineModel(B0=x, B1=y)])
+            ts.minX, ts.minY = x, y
+            ts.maxX, ts.maxY = x + TILE_SIZE, y + TILE_SIZE
+            tilespecs.append(ts)
+    return tilespecs
+
+
+def pair_ids(neighborPairs):
+    return {frozenset((p["p"]["id"], p["q"]["id"])) for p in neighborPairs}
+
+
+def test_tile_bounds_from_transforms():
+    tilespecs = make_grid_tilespecs(0, 1, 2)
+    expected = tile_bounds(tilespecs)
+    for ts in tilespecs:
+        ts.minX = ts.minY = ts.maxX = ts.maxY = None
+    numpy.testing.assert_allclose(
+        tile_bounds(tilespecs), expected - [0, 0, 1, 1])
+
+
+def test_montage_pairs():
+    tilespecs = make_grid_tilespecs(0)
+    pairs = generate_tile_pairs(tilespecs, zNeighborDistance=0)
+    # horizontal and vertical neighbors, corners excluded
+    assert len(pairs) == 12
+    ids = pair_ids(pairs)
+    assert frozenset(("z0_r0_c0", "z0_r0_c1")) in ids
+    assert frozenset(("z0_r0_c0", "z0_r1_c1")) not in ids
+
+    positions = {(p["p"]["id"], p["q"]["id"]): (
+        p["p"]["relativePosition"], p["q"]["relativePosition"])
+        for p in pairs}
+    assert positions[("z0_r0_c0", "z0_r0_c1")] == ("LEFT", "RIGHT")
+    assert positions[("z0_r0_c0", "z0_r1_c0")] == ("TOP", "BOTTOM")
+
+    with_corners = generate_tile_pairs(
+        tilespecs, zNeighborDistance=0, excludeCornerNeighbors=False)
+    assert len(with_corners) == 20
+
+
+def test_cross_layer_pairs():
+    tilespecs = (make_grid_tilespecs(0) + make_grid_tilespecs(1) +
+                 make_grid_tilespecs(3))
+    pairs = generate_tile_pairs(tilespecs, zNeighborDistance=1)
+    same = [p for p in pairs if "relativePosition" in p["p"]]
+    cross = [p for p in pairs if "relativePosition" not in p["p"]]
+    assert len(same) == 3 * 12
+    # each tile with the tile above it and that tile's edge neighbors
+    assert len(cross) == 9 + 2 * 12
+    assert all({p["p"]["groupId"], p["q"]["groupId"]} == {"0.0", "1.0"}
+               for p in cross)
+
+    cross_only = generate_tile_pairs(
+        tilespecs, zNeighborDistance=2, excludeSameLayerNeighbors=True)
+    assert len(cross_only) == 2 * (9 + 2 * 12)
+
+
+def test_obscured_tiles_excluded():
+    tilespecs = make_grid_tilespecs(0)
+    reacquired = make_grid_tilespecs(0)[4]
+    reacquired.tileId = "z0_r1_c1_reacquired"
+    tilespecs.append(reacquired)
+
+    bounds = tile_bounds(tilespecs)
+    z = numpy.zeros(len(tilespecs))
+    obscured = completely_obscured(z, bounds)
+    assert obscured.sum() == 1 and obscured[4]
+
+    pairs = generate_tile_pairs(tilespecs, zNeighborDistance=0)
+    ids = set().union(*pair_ids(pairs))
+    assert "z0_r1_c1" not in ids
+    assert "z0_r1_c1_reacquired" in ids
+    assert len(pairs) == 12
+
+    pairs = generate_tile_pairs(
+        tilespecs, zNeighborDistance=0,
+        excludeCompletelyObscuredTiles=False)
+    assert frozenset(("z0_r1_c1", "z0_r1_c1_reacquired")) in pair_ids(pairs)
+
+
+def test_rowcol_pairs_match_bounds_pairs():
+    tilespecs = make_grid_tilespecs(0) + make_grid_tilespecs(1)
+
+    def pair_positions(pairs):
+        return {(p["p"]["id"], p["q"]["id"]): p["p"]["relativePosition"]
+                for p in pairs}
+
+    for exclude in (True, False):
+        kwargs = dict(zNeighborDistance=0, excludeCornerNeighbors=exclude)
+        rowcol = generate_tile_pairs(
+            tilespecs, useRowColPositions=True, **kwargs)
+        # the grid path does not need tile bounds
+        for ts in tilespecs:
+            ts.minX = ts.minY = ts.maxX = ts.maxY = None
+        assert len(generate_tile_pairs(
+            tilespecs, useRowColPositions=True, **kwargs)) == len(rowcol)
+        geometric = generate_tile_pairs(
+            make_grid_tilespecs(0) + make_grid_tilespecs(1), **kwargs)
+        assert len(rowcol) == len(geometric)
+        if exclude:
+            assert pair_positions(rowcol) == pair_positions(geometric)
+        else:
+            assert pair_ids(rowcol) == pair_ids(geometric)
+
+
+def test_metafile_tile_pairs():
+    md = [{"metadata": {}}, {"data": [
+        {"img_path": "tile_{}_{}.tif".format(r, c),
+         "img_meta": {"raster_pos": [c, r]}}
+        for r in range(2) for c in range(3)]}]
+    pairs = metafile_tile_pairs(md, 5)
+    assert len(pairs) == 7
+    assert {p["p"]["groupId"] for p in pairs} == {"5.0"}
+    positions = {(p["p"]["id"], p["q"]["id"]): p["p"]["relativePosition"]
+                 for p in pairs}
+    assert positions[("tile_0_0.5.0", "tile_0_1.5.0")] == "LEFT"
+    assert positions[("tile_0_2.5.0", "tile_1_2.5.0")] == "TOP"
+    assert len(metafile_tile_pairs(
+        md, 5, excludeCornerNeighbors=False)) == 7 + 4
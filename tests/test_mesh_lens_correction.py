@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+test tile matching of the metadata based lens correction module
+on synthetic overlapping tiles
+"""
+import os
+import pathlib
+
+import cv2
+import numpy
+import pytest
+import renderapi
+
+# the module depends on em_stitch and the montage qc requirements
+run_mesh_lens_correction = pytest.importorskip(
+    "asap.mesh_lens_correction.run_mesh_lens_correction")
+CalculateLensCorrectionModule = (
+    run_mesh_lens_correction.CalculateLensCorrectionModule)
+match_tiles_rts = run_mesh_lens_correction.match_tiles_rts
+
+TILE_SIZE = 1000
+TILE_OFFSET = 600
+
+
+@pytest.fixture(scope='module')
+def tile_rts(tmpdir_factory):
+    d = str(tmpdir_factory.mktemp('lc_tiles'))
+    rng = numpy.random.RandomState(0)
+    texture = rng.rand(TILE_SIZE, TILE_SIZE + TILE_OFFSET).astype('float32')
+    texture = cv2.GaussianBlur(texture, (0, 0), 6.0)
+    texture = ((texture - texture.min()) /
+               (texture.max() - texture.min()) * 255).astype('uint8')
+    tilespecs = []
+    for tileId, x in [('p', 0), ('q', TILE_OFFSET)]:
+        fp = os.path.join(d, tileId + '.png')
+        cv2.imwrite(fp, texture[:, x:x + TILE_SIZE])
+        ip = renderapi.image_pyramid.ImagePyramid()
+        ip[0] = renderapi.image_pyramid.MipMap(
+            imageUrl=pathlib.Path(fp).as_uri())
+        tilespecs.append(renderapi.tilespec.TileSpec(
+            tileId=tileId, width=TILE_SIZE, height=TILE_SIZE,
+            sectionId='s', imagePyramid=ip,
+            tforms=[renderapi.transform.AffineModel(B0=x, B1=0)]))
+    return renderapi.resolvedtiles.ResolvedTiles(
+        tilespecs=tilespecs, transformList=[])
+
+
+def tile_pairs():
+    return [{"p": {"groupId": "s", "id": "p"},
+             "q": {"groupId": "s", "id": "q"}}]
+
+
+def match_offset(pm):
+    return numpy.median(
+        numpy.array(pm['matches']['p']) - numpy.array(pm['matches']['q']),
+        axis=1)
+
+
+def test_match_tiles_rts_guided(tile_rts):
+    matches = match_tiles_rts(tile_rts, tile_pairs(), concurrency=1)
+    guided = match_tiles_rts(
+        tile_rts, tile_pairs(), concurrency=1,
+        guided=True, guided_search_radius=50.)
+    for pm in matches + guided:
+        assert len(pm['matches']['w']) > 10
+        numpy.testing.assert_allclose(
+            match_offset(pm), [TILE_OFFSET, 0], atol=2.0)
+
+    # a search radius well short of a misplaced tile finds no matches
+    q = tile_rts.tilespecs[1]
+    q.tforms = [renderapi.transform.AffineModel(B0=TILE_OFFSET + 300, B1=0)]
+    try:
+        misplaced = match_tiles_rts(
+            tile_rts, tile_pairs(), concurrency=1,
+            guided=True, guided_search_radius=50.)
+    finally:
+        q.tforms = [renderapi.transform.AffineModel(B0=TILE_OFFSET, B1=0)]
+    assert len(misplaced[0]['matches']['w']) < 10
+
+
+def test_lens_correction_guided_args(tile_rts, monkeypatch, tmpdir):
+    calls = []
+
+    def fake_match_tiles_rts(rts, tpairs, **kwargs):
+        calls.append(kwargs)
+        return []
+    monkeypatch.setattr(
+        run_mesh_lens_correction.uri_handler.uri_functions,
+        "uri_readbytes", lambda uri: b"{}")
+    monkeypatch.setattr(
+        run_mesh_lens_correction, "resolvedtiles_from_temca_md",
+        lambda *args, **kwargs: tile_rts)
+    monkeypatch.setattr(
+        run_mesh_lens_correction, "apply_resolvedtiles_bboxes",
+        lambda rts: None)
+    monkeypatch.setattr(
+        run_mesh_lens_correction, "pair_tiles_rts",
+        lambda rts: tile_pairs())
+    monkeypatch.setattr(
+        run_mesh_lens_correction, "match_tiles_rts", fake_match_tiles_rts)
+    monkeypatch.setattr(
+        run_mesh_lens_correction, "solve_lc",
+        lambda rts, matches, transformId=None:
+            renderapi.transform.AffineModel(transformId=transformId))
+
+    mod = CalculateLensCorrectionModule(input_data={
+        "metafile_uri": "file:///metadata.json",
+        "image_prefix": "file:///",
+        "transformId": "lc",
+        "concurrency": 1,
+        "guided_matching": True,
+        "guided_search_radius": 75.,
+        "output_json": str(tmpdir.join('output.json'))}, args=[])
+    mod.run()
+    assert calls[0]["guided"] is True
+    assert calls[0]["guided_search_radius"] == 75.
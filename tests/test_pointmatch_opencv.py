@@ -0,0 +1,574 @@
+#!/usr/bin/env python
+"""
+test render-independent parts of the opencv point match client
+on synthetic overlapping tiles
+"""
+import gzip
+import json
+import os
+import pathlib
+import types
+
+import cv2
+import numpy
+import pytest
+import renderapi
+
+from asap.pointmatch import generate_point_matches_opencv
+from asap.pointmatch.benchmark_point_matches import benchmark_detectors
+from asap.pointmatch.feature_cache import FeatureCache
+from asap.pointmatch.generate_point_matches_opencv import (
+    GeneratePointMatchesOpenCV, GuidedIndex, crop_features, find_matches,
+    find_matches_batch, find_matches_escalating, load_resolvedtiles, make_pm,
+    match_pair, mipmap_level_for_scale, parse_tile_groupids, parse_tileids,
+    process_matches, ratio_test, read_pair, remove_completed_pairs,
+    sift_match_images, stratified_subsample, tier_args, tile_feature_rois)
+from asap.pointmatch.match_sinks import (
+    CompletionJournal, JsonLinesMatchSink, RenderMatchSink,
+    iter_matches_jsonl)
+from asap.pointmatch.pipeline import StagedPipeline
+from asap.pointmatch.scheduling import LRUCache, partition_pairs
+from asap.pointmatch.tile_overlap import (
+    overlap_roi_from_relative_position, overlap_rois, predicted_pq_affine)
+
+TILE_SHAPE = (400, 400)
+TILE_OFFSET = (0, 300)
+
+
+def make_texture(shape, seed=0):
+    rng = numpy.random.RandomState(seed)
+    im = rng.rand(*shape).astype('float32')
+    im = cv2.GaussianBlur(im, (0, 0), 2.0)
+    im = (im - im.min()) / (im.max() - im.min()) * 255
+    return im.astype('uint8')
+
+
+@pytest.fixture(scope='module')
+def tile_pair():
+    rows, cols = TILE_SHAPE
+    dr, dc = TILE_OFFSET
+    texture = make_texture((rows + dr, cols + dc))
+    pim = texture[:rows, :cols].copy()
+    qim = texture[dr:dr + rows, dc:dc + cols].copy()
+    return pim, qim
+
+
+@pytest.fixture(scope='module')
+def tile_pair_uris(tile_pair, tmpdir_factory):
+    d = str(tmpdir_factory.mktemp('pm_tiles'))
+    uris = []
+    for fn, im in zip(['p.png', 'q.png'], tile_pair):
+        fp = os.path.join(d, fn)
+        cv2.imwrite(fp, im)
+        uris.append((pathlib.Path(fp).as_uri(), None))
+    return uris
+
+
+match_kwargs = {
+    "ndiv": 2,
+    "FLANN_ntree": 5,
+    "ratio_of_dist": 0.7,
+    "FLANN_ncheck": 50}
+
+ransac_kwargs = {"RANSAC_outlier": 5.0}
+
+
+def check_offset(loc_p, loc_q, scale=1.0):
+    dr, dc = TILE_OFFSET
+    expected = numpy.array([dc, dr]) * scale
+    numpy.testing.assert_allclose(
+        numpy.median(numpy.asarray(loc_p) - numpy.asarray(loc_q), axis=0),
+        expected, atol=1.0)
+
+
+def test_sift_match_images(tile_pair):
+    pim, qim = tile_pair
+    (loc_p, loc_q), (nfeat_p, nfeat_q) = sift_match_images(
+        pim, qim, match_kwargs=match_kwargs, ransac_kwargs=ransac_kwargs,
+        return_num_features=True)
+    assert nfeat_p > 0 and nfeat_q > 0
+    assert len(loc_p) == len(loc_q) > 10
+    check_offset(loc_p, loc_q)
+
+
+@pytest.mark.parametrize("detector,binary_matcher", [
+    ("ORB", "LSH"), ("ORB", "BF"), ("AKAZE", "BF")])
+def test_binary_match_images(tile_pair, detector, binary_matcher):
+    pim, qim = tile_pair
+    (loc_p, loc_q), (nfeat_p, nfeat_q) = sift_match_images(
+        pim, qim, sift_kwargs=(
+            {"nfeatures": 5000} if detector == "ORB" else {}),
+        detector=detector,
+        match_kwargs=dict(match_kwargs, binary_matcher=binary_matcher),
+        ransac_kwargs=ransac_kwargs, return_num_features=True)
+    assert nfeat_p > 0 and nfeat_q > 0
+    assert len(loc_p) == len(loc_q) > 10
+    check_offset(loc_p, loc_q)
+
+
+def test_process_matches_feature_cache(tile_pair_uris, tmpdir, monkeypatch):
+    cache_dir = str(tmpdir.join('features'))
+    kwargs = dict(
+        downsample_scale=0.5, matchMax=100,
+        match_kwargs=match_kwargs, ransac_kwargs=ransac_kwargs,
+        feature_cache_dir=cache_dir)
+    (puri, quri) = tile_pair_uris
+
+    pm, nmatch, nfeat_p, nfeat_q = process_matches(
+        'p', 'g', puri, 'q', 'g', quri, **kwargs)
+    assert len(os.listdir(cache_dir)) == 2
+    assert len(pm['matches']['w']) == min(nmatch, 100)
+    check_offset(numpy.array(pm['matches']['p']).T,
+                 numpy.array(pm['matches']['q']).T)
+
+    # cached features are reused without reading the images
+    def fail_read(*args, **kwargs):
+        raise AssertionError("image read with cached features")
+    monkeypatch.setattr(
+        generate_point_matches_opencv,
+        "read_downsample_equalize_mask_uri", fail_read)
+    pm2, nmatch2, nfeat_p2, nfeat_q2 = process_matches(
+        'p', 'g', puri, 'q', 'g', quri, **kwargs)
+    assert (nfeat_p2, nfeat_q2) == (nfeat_p, nfeat_q)
+
+    fc = FeatureCache(cache_dir)
+    assert fc.get(FeatureCache.make_key('p', puri, 0.5)) is not None
+    assert fc.get(FeatureCache.make_key('p', puri, 0.25)) is None
+
+
+def test_ratio_test():
+    idx = numpy.array([[3, 1], [0, 2], [4, 0]])
+    dist = numpy.array([[1.0, 2.0], [1.0, 1.1], [0.0, 0.0]])
+    p_ind, q_ind = ratio_test(idx, dist, 0.7)
+    numpy.testing.assert_array_equal(p_ind, [0])
+    numpy.testing.assert_array_equal(q_ind, [3])
+
+
+def make_tilespec(tileId, x, y, width, height):
+    return renderapi.tilespec.TileSpec(
+        tileId=tileId, width=width, height=height,
+        tforms=[renderapi.transform.AffineModel(B0=x, B1=y)])
+
+
+def test_overlap_rois(tile_pair_uris):
+    rows, cols = TILE_SHAPE
+    dr, dc = TILE_OFFSET
+    ts_p = make_tilespec('p', 0, 0, cols, rows)
+    ts_q = make_tilespec('q', dc, dr, cols, rows)
+    p_roi, q_roi = overlap_rois(ts_p, ts_q, margin=10.)
+    # the margin, and at most one grid cell of the default 33 x 33 grid
+    pad = 10. + cols / 32.
+    assert dc - pad <= p_roi[0] < dc - 10.
+    assert p_roi[2] == cols
+    assert q_roi[0] == 0
+    assert cols - dc + 10. < q_roi[2] <= cols - dc + pad
+
+    strip = overlap_roi_from_relative_position(
+        cols, rows, "LEFT", overlap_fraction=0.25)
+    assert strip == [cols * 0.75, 0., cols, rows]
+
+    puri, quri = tile_pair_uris
+    pm, nmatch, nfeat_p, nfeat_q = process_matches(
+        'p', 'g', puri, 'q', 'g', quri, downsample_scale=1.0,
+        matchMax=1000, match_kwargs=match_kwargs,
+        ransac_kwargs=ransac_kwargs, p_roi=p_roi, q_roi=q_roi)
+    p = numpy.array(pm['matches']['p']).T
+    assert nmatch > 10
+    assert p[:, 0].min() >= p_roi[0]
+    check_offset(p, numpy.array(pm['matches']['q']).T)
+
+
+def test_guided_matching(tile_pair_uris):
+    rows, cols = TILE_SHAPE
+    dr, dc = TILE_OFFSET
+    ts_p = make_tilespec('p', 0, 0, cols, rows)
+    ts_q = make_tilespec('q', dc + 5, dr - 5, cols, rows)
+    pq_tform = predicted_pq_affine(ts_p, ts_q)
+    numpy.testing.assert_allclose(
+        pq_tform[:2, 2], [-dc - 5, -dr + 5], atol=1e-6)
+
+    puri, quri = tile_pair_uris
+    pm, nmatch, nfeat_p, nfeat_q = process_matches(
+        'p', 'g', puri, 'q', 'g', quri, downsample_scale=1.0,
+        matchMax=1000, match_kwargs=match_kwargs,
+        ransac_kwargs=ransac_kwargs,
+        pq_tform=pq_tform, guided_search_radius=20.)
+    assert nmatch > 10
+    check_offset(numpy.array(pm['matches']['p']).T,
+                 numpy.array(pm['matches']['q']).T)
+
+
+def test_guided_ratio_test_needs_second_neighbor():
+    rng = numpy.random.RandomState(0)
+    des_q = rng.rand(2, 128).astype(numpy.float32) * 100
+    loc_q = numpy.array([[10., 10.], [500., 500.]])
+    index = GuidedIndex(loc_q, des_q, numpy.eye(3), search_radius=20.)
+    # an unrelated descriptor with a single candidate in the radius, and
+    # a near copy of q 0 with both q keypoints as candidates
+    des_p = numpy.vstack([rng.rand(1, 128) * 100, des_q[:1] + 0.1])
+    loc_p = numpy.array([[12., 12.], [11., 11.]])
+    idx, dist = index.knn_search(des_p, k=2, loc_p=loc_p)
+    assert numpy.isfinite(dist[0, 0]) and numpy.isinf(dist[0, 1])
+    assert list(ratio_test(idx, dist, 0.7)[0]) == []
+
+    index = GuidedIndex(loc_q, des_q, numpy.eye(3), search_radius=1000.)
+    idx, dist = index.knn_search(des_p, k=2, loc_p=loc_p)
+    p_ind, q_ind = ratio_test(idx, dist, 0.7)
+    assert list(p_ind) == [1] and list(q_ind) == [0]
+
+
+def test_mipmap_level_for_scale():
+    ip = renderapi.image_pyramid.ImagePyramid({
+        lvl: renderapi.image_pyramid.MipMap(imageUrl='file:///{}'.format(lvl))
+        for lvl in range(4)})
+    assert mipmap_level_for_scale(ip, 0.3) == (1, 0.6)
+    assert mipmap_level_for_scale(ip, 0.25) == (2, 1.0)
+    assert mipmap_level_for_scale(ip, 0.01) == (3, 0.08)
+    assert mipmap_level_for_scale(ip, 1.0) == (0, 1.0)
+
+
+def test_process_matches_mipmap_level(tile_pair, tmpdir):
+    uris = []
+    for fn, im in zip(['p1.png', 'q1.png'], tile_pair):
+        fp = str(tmpdir.join(fn))
+        cv2.imwrite(fp, cv2.resize(im, (0, 0), fx=0.5, fy=0.5,
+                                   interpolation=cv2.INTER_AREA))
+        uris.append((pathlib.Path(fp).as_uri(), None))
+    pm, nmatch, nfeat_p, nfeat_q = process_matches(
+        'p', 'g', uris[0], 'q', 'g', uris[1], downsample_scale=0.5,
+        matchMax=1000, match_kwargs=match_kwargs,
+        ransac_kwargs=ransac_kwargs, p_level=1, q_level=1)
+    assert nmatch > 10
+    check_offset(numpy.array(pm['matches']['p']).T,
+                 numpy.array(pm['matches']['q']).T)
+
+
+@pytest.mark.parametrize("fn", ["matches.jsonl", "matches.jsonl.gz"])
+def test_jsonl_match_sink(tmpdir, fn):
+    path = str(tmpdir.join(fn))
+    pms = [make_pm(('p{}'.format(i), 'q{}'.format(i)), ('g', 'g'),
+                   numpy.random.rand(5, 2), numpy.random.rand(5, 2))
+           for i in range(5)]
+    with JsonLinesMatchSink(path, batch_size=2) as sink:
+        for pm in pms:
+            sink.add(pm)
+        assert sink.count == 4
+    assert sink.count == 5
+    assert list(iter_matches_jsonl(path)) == pms
+
+
+def test_render_match_sink(monkeypatch):
+    imports = []
+    monkeypatch.setattr(
+        renderapi.pointmatch, "import_matches",
+        lambda collection, matches, render=None: imports.append(
+            (collection, list(matches), render)))
+    render = object()
+    pms = [make_pm(('p{}'.format(i), 'q{}'.format(i)), ('g', 'g'),
+                   numpy.random.rand(5, 2), numpy.random.rand(5, 2))
+           for i in range(7)]
+    sink = RenderMatchSink(render, 'collection', batch_size=3)
+    for pm in pms:
+        sink.add(pm)
+    sink.add(None)
+    # full batches are imported as they fill, the remainder on close
+    assert [len(m) for c, m, r in imports] == [3, 3]
+    assert sink.count == 6
+    sink.close()
+    assert [len(m) for c, m, r in imports] == [3, 3, 1]
+    assert sink.count == 7
+    assert all(c == 'collection' and r is render for c, m, r in imports)
+    assert [pm for c, m, r in imports for pm in m] == pms
+
+    # closing an empty sink imports nothing
+    RenderMatchSink(render, 'collection', batch_size=3).close()
+    assert len(imports) == 3
+
+
+def make_tpjson(pairs):
+    return {"neighborPairs": [
+        {"p": {"groupId": pg, "id": p}, "q": {"groupId": qg, "id": q}}
+        for (pg, p), (qg, q) in pairs]}
+
+
+def test_parse_tileids():
+    tpjson = make_tpjson([
+        (('1.0', 'c'), ('1.0', 'a')),
+        (('1.0', 'a'), ('2.0', 'b')),
+        (('1.0', 'c'), ('2.0', 'b'))])
+    unique_ids, tile_index = parse_tileids(tpjson)
+    numpy.testing.assert_array_equal(unique_ids, ['a', 'b', 'c'])
+    numpy.testing.assert_array_equal(tile_index, [[2, 0], [0, 1], [2, 1]])
+    assert parse_tile_groupids(tpjson) == {'a': '1.0', 'b': '2.0', 'c': '1.0'}
+
+
+def test_load_resolvedtiles(monkeypatch):
+    zs = {'1.0': 1., '2.0': 2.}
+    tilespecs = {
+        1.: [make_tilespec('a', 0, 0, 10, 10),
+             make_tilespec('c', 0, 0, 10, 10)],
+        2.: [make_tilespec('b', 0, 0, 10, 10)]}
+    monkeypatch.setattr(
+        renderapi.stack, "get_section_z_value",
+        lambda stack, groupId, **kwargs: zs[groupId])
+    monkeypatch.setattr(
+        renderapi.resolvedtiles, "get_resolved_tiles_from_z",
+        lambda stack, z, **kwargs: renderapi.resolvedtiles.ResolvedTiles(
+            tilespecs=tilespecs[z], transformList=[]))
+
+    tspecs, ref_tforms = load_resolvedtiles(
+        None, 'stack', ['a', 'b', 'c'],
+        {'a': '1.0', 'b': '2.0', 'c': '1.0'})
+    assert [ts.tileId for ts in tspecs] == ['a', 'b', 'c']
+    assert ref_tforms == []
+
+
+def test_stratified_subsample():
+    rng = numpy.random.RandomState(0)
+    # a dense cluster in one corner and sparse matches elsewhere
+    dense = rng.rand(900, 2) * 100
+    sparse = 250 + rng.rand(100, 2) * 750
+    loc = numpy.vstack([dense, sparse])
+
+    ind = stratified_subsample(loc, 200, grid=4)
+    assert ind.size == 200
+    assert numpy.unique(ind).size == 200
+    # every sparse match survives, the cluster fills the remainder
+    assert numpy.isin(numpy.arange(900, 1000), ind).all()
+
+    priority = numpy.arange(loc.shape[0])[::-1]
+    ind = stratified_subsample(loc, 150, grid=4, priority=priority)
+    assert numpy.isin(numpy.arange(900, 1000), ind).all()
+    assert (ind[ind < 900] >= 900 - 50).all()
+
+    assert (stratified_subsample(loc[:10], 200) == numpy.arange(10)).all()
+
+
+def test_resume_from_journal(tmpdir):
+    tpjson = make_tpjson([
+        (('1.0', 'a'), ('1.0', 'b')),
+        (('1.0', 'b'), ('1.0', 'c')),
+        (('1.0', 'c'), ('2.0', 'd'))])
+    journal = CompletionJournal(str(tmpdir.join('journal.jsonl')))
+    assert journal.completed() == set()
+
+    # matches may be stored with p and q swapped
+    journal.record([
+        make_pm(('c', 'b'), ('1.0', '1.0'), numpy.zeros((1, 2)),
+                numpy.zeros((1, 2)))])
+    journal.close()
+    remaining = remove_completed_pairs(
+        tpjson['neighborPairs'], journal.completed())
+    assert [(m['p']['id'], m['q']['id']) for m in remaining] == [
+        ('a', 'b'), ('c', 'd')]
+
+
+@pytest.mark.parametrize("ext", ["", ".gz"])
+def test_resume_truncated_records(tmpdir, ext):
+    tpjson = make_tpjson([
+        (('1.0', 'a'), ('1.0', 'b')),
+        (('1.0', 'b'), ('1.0', 'c')),
+        (('1.0', 'c'), ('1.0', 'd'))])
+    pms = [make_pm((p, q), ('1.0', '1.0'), numpy.zeros((1, 2)),
+                   numpy.zeros((1, 2)))
+           for p, q in [('a', 'b'), ('b', 'c'), ('c', 'd')]]
+    journal_file = str(tmpdir.join('journal.jsonl' + ext))
+    match_file = str(tmpdir.join('matches.jsonl' + ext))
+
+    # a run killed while writing the second pair of each file
+    with JsonLinesMatchSink(match_file, batch_size=1,
+                            journal=CompletionJournal(journal_file)) as sink:
+        sink.add(pms[0])
+    for fn, line in [(journal_file, json.dumps([['1.0', 'b'], ['1.0', 'c']])),
+                     (match_file, json.dumps(pms[1]))]:
+        with (gzip.open(fn, 'ab') if ext else open(fn, 'ab')) as f:
+            f.write(line[:len(line) // 2].encode())
+        if ext:
+            with open(fn, 'rb+') as f:
+                f.truncate(os.path.getsize(fn) - 4)
+
+    module = types.SimpleNamespace(args={
+        "completion_journal": journal_file, "match_sink": "jsonl",
+        "match_output_file": match_file})
+    remaining = GeneratePointMatchesOpenCV.remove_completed(
+        module, None, tpjson['neighborPairs'])
+    assert [(m['p']['id'], m['q']['id']) for m in remaining] == [
+        ('b', 'c'), ('c', 'd')]
+
+    # resumed appends start on a line of their own
+    with JsonLinesMatchSink(match_file, batch_size=1,
+                            journal=CompletionJournal(journal_file)) as sink:
+        for pm in pms[1:]:
+            sink.add(pm)
+    assert list(iter_matches_jsonl(match_file)) == pms
+    assert CompletionJournal(journal_file).completed() == {
+        (('1.0', p), ('1.0', q)) for p, q in [('a', 'b'), ('b', 'c'),
+                                              ('c', 'd')]}
+
+
+def make_match_args(**kwargs):
+    args = {
+        "downsample_scale": 1.0, "CLAHE_grid": None, "CLAHE_clip": None,
+        "SIFT_nfeature": 20000, "SIFT_noctave": 3, "SIFT_sigma": 1.6,
+        "detector": "SIFT", "ORB_nfeature": 5000, "AKAZE_threshold": 0.001,
+        "ndiv": 2, "FLANN_ntree": 5, "ratio_of_dist": 0.7,
+        "FLANN_ncheck": 50, "guided_max_candidates": 32,
+        "binary_matcher": "LSH", "LSH_table_number": 6, "LSH_key_size": 12,
+        "LSH_multi_probe_level": 1,
+        "RANSAC_outlier": 5.0, "RANSAC_model": "HOMOGRAPHY",
+        "RANSAC_method": "RANSAC", "RANSAC_max_iter": 2000,
+        "RANSAC_confidence": 0.995, "matchMax": 1000,
+        "match_decimation": "random", "decimation_grid": 16,
+        "decimation_prefer_low_residual": False, "escalation_tiers": [],
+        "escalation_min_matches": 50, "escalation_max_residual": None}
+    args.update(kwargs)
+    return args
+
+
+def test_staged_pipeline_matches(tile_pair_uris):
+    args = make_match_args()
+    fargs = [[list(tile_pair_uris), ['p', 'q'], ['g', 'g'], args, {}]] * 3
+    expected = find_matches(fargs[0])
+
+    results = []
+    StagedPipeline(
+        read_pair, match_pair, results.append,
+        io_threads=2, ncpus=2, max_in_flight=2, writer_queue_size=1
+    ).run(fargs)
+    assert len(results) == 3
+    for r in results:
+        # RANSAC sampling differs between processes
+        assert r[1:3] == expected[1:3]
+        assert abs(r[3] - expected[3]) < 0.05 * expected[3]
+        check_offset(numpy.array(r[5]['matches']['p']).T,
+                     numpy.array(r[5]['matches']['q']).T)
+
+
+def test_benchmark_detectors(tile_pair_uris):
+    args = make_match_args(feature_cache_dir=None)
+    rargs = [read_pair([list(tile_pair_uris), ['p', 'q'], ['g', 'g'],
+                        args, {}])]
+    summaries = benchmark_detectors(rargs, ["SIFT", "ORB"])
+    assert [s["detector"] for s in summaries] == ["SIFT", "ORB"]
+    assert summaries[0]["relative_speed"] == 1.0
+    assert summaries[0]["relative_yield"] == 1.0
+    for s in summaries:
+        assert s["pairs"] == 1
+        assert s["matches_per_pair"] > 10
+        assert s["median_residual"] < 2.0
+        assert s["median_reference_residual"] < 2.0
+
+
+def test_escalation_tiers(tile_pair_uris):
+    tiers = [
+        {"downsample_scale": 0.25, "SIFT_nfeature": 20, "ndiv": None},
+        {"downsample_scale": 0.5, "SIFT_nfeature": None, "ndiv": 1}]
+    args = make_match_args(escalation_tiers=tiers)
+    assert tier_args(args, 0)["SIFT_nfeature"] == 20
+    assert tier_args(args, 0)["ndiv"] == args["ndiv"]
+    assert tier_args(args, 1)["downsample_scale"] == 0.5
+    assert tier_args(args, 2) is args
+    assert tier_args(args, None) is args
+
+    fargs = [list(tile_pair_uris), ['p', 'q'], ['g', 'g'], args,
+             {"escalation_tier": 0}]
+    # 20 features cannot give enough matches, the second tier can
+    r = find_matches_escalating(fargs)
+    assert r[6] == 1
+    assert r[1:3] == find_matches(
+        fargs[:4] + [{"escalation_tier": 1}])[1:3]
+    check_offset(numpy.array(r[5]['matches']['p']).T,
+                 numpy.array(r[5]['matches']['q']).T)
+
+    # an unattainable residual bound escalates to the module settings
+    args = make_match_args(
+        escalation_tiers=tiers, escalation_max_residual=1e-6)
+    r = find_matches_escalating(fargs[:3] + [args, {"escalation_tier": 0}])
+    assert r[6] == 2 and r[3] > 50
+
+    # without escalation results are find_matches results
+    r = find_matches_escalating(fargs[:3] + [make_match_args(), {}])
+    assert r[6] is None and len(r) == 7
+
+
+def test_staged_pipeline_write_error():
+    def fail(r):
+        raise ValueError(r)
+    with pytest.raises(ValueError):
+        StagedPipeline(abs, abs, fail, ncpus=1).run(range(-5, 0))
+
+
+def test_partition_pairs():
+    # 4 x 4 grid of tiles with right and bottom neighbor pairs
+    centers = numpy.array(
+        [[c * 10., r * 10.] for r in range(4) for c in range(4)])
+    tile_index = numpy.array(
+        [[i, i + 1] for i in range(16) if i % 4 != 3] +
+        [[i, i + 4] for i in range(12)])
+    batches = partition_pairs(tile_index, centers, batch_size=5)
+    order = numpy.concatenate(batches)
+    assert sorted(order) == list(range(tile_index.shape[0]))
+    assert [len(b) for b in batches] == [5, 5, 5, 5, 4]
+    # pairs are ordered by strip and batches span at most three rows
+    pair_y = centers[tile_index[order]].mean(axis=1)[:, 1]
+    assert numpy.all(numpy.diff(numpy.floor(pair_y / 10.)) >= 0)
+    for b in batches:
+        assert numpy.ptp(centers[tile_index[b].ravel(), 1]) <= 20.
+
+    centers[0] = numpy.nan
+    numpy.testing.assert_array_equal(
+        numpy.concatenate(partition_pairs(tile_index, centers)),
+        numpy.arange(tile_index.shape[0]))
+
+
+def test_lru_cache():
+    lru = LRUCache(maxsize=2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    assert lru.get('a') == 1
+    lru.put('c', 3)
+    assert lru.get('b') is None
+    assert lru.get('a') == 1 and lru.get('c') == 3
+
+
+def test_find_matches_batch_overlap_cache(tile_pair_uris, monkeypatch):
+    rows, cols = TILE_SHAPE
+    dr, dc = TILE_OFFSET
+    ts_p = make_tilespec('p', 0, 0, cols, rows)
+    ts_q = make_tilespec('q', dc, dr, cols, rows)
+    args = make_match_args(feature_cache_dir=None)
+    fargs = []
+    for margin in [10., 40.]:
+        p_roi, q_roi = overlap_rois(ts_p, ts_q, margin=margin)
+        fargs.append([list(tile_pair_uris), ['p', 'q'], ['g', 'g'], args,
+                      {"p_roi": p_roi, "q_roi": q_roi}])
+
+    # features are extracted from the union of the overlap regions
+    feature_rois = tile_feature_rois(fargs)
+    assert feature_rois == {"p": fargs[1][4]["p_roi"],
+                            "q": fargs[1][4]["q_roi"]}
+    assert tile_feature_rois(fargs + [[
+        list(tile_pair_uris), ['p', 'r'], ['g', 'g'], args, {}]])["p"] is None
+
+    lru = LRUCache()
+    monkeypatch.setattr(generate_point_matches_opencv, "_tile_lru", lru)
+    results = find_matches_batch([fargs, 4, feature_rois])
+    # tile features are cached once and cropped for each pair
+    assert (lru.misses, lru.hits) == (2, 2)
+    for r, (_, _, _, _, pair_kwargs) in zip(results, fargs):
+        p = numpy.array(r[5]['matches']['p']).T
+        assert r[3] > 10
+        assert p[:, 0].min() >= pair_kwargs["p_roi"][0]
+        check_offset(p, numpy.array(r[5]['matches']['q']).T)
+
+    features = list(lru.store.values())[0]
+    assert features.origin[0] == int(numpy.floor(feature_rois["p"][0]))
+    assert features.shape[1] < cols
+    roi = fargs[0][4]["p_roi"]
+    cropped = crop_features(features, roi)
+    inside = numpy.all((features.loc >= numpy.floor(roi[:2])) &
+                       (features.loc < numpy.ceil(roi[2:])), axis=1)
+    numpy.testing.assert_array_equal(cropped.loc, features.loc[inside])
+    assert cropped.des.shape[0] == inside.sum()
+    assert cropped.origin == (int(numpy.floor(roi[0])), 0)
+    assert crop_features(features, None) is features
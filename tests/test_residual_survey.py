@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+test the stack-wide residual survey and its quantile sketches
+"""
+import json
+
+import numpy as np
+import pytest
+import renderapi
+
+from asap.residuals.quantile_sketch import KeyedQuantileSketch
+from asap.residuals.residual_survey import (
+    ResidualSurvey, read_columns, survey_blocks)
+
+
+def test_keyed_quantile_sketch():
+    rng = np.random.default_rng(0)
+    values = rng.lognormal(0, 1.5, 20000)
+    keys = rng.integers(0, 20, values.size)
+    a = KeyedQuantileSketch(alpha=0.01)
+    b = KeyedQuantileSketch(alpha=0.01)
+    a.add(keys[:5000], values[:5000])
+    b.add(keys[5000:], values[5000:])
+    a.merge(b)
+
+    popped = a.pop([3])
+    assert list(popped.summary()[0]) == [3]
+    a.merge(popped)
+    a.relabel(np.arange(20) + 100)
+    skeys, count, mean, q = a.summary([0.5, 0.9, 0.99])
+    assert list(skeys) == list(range(100, 120))
+    for k in range(20):
+        v = values[keys == k]
+        assert count[k] == v.size
+        assert mean[k] == pytest.approx(v.mean())
+        expected = np.quantile(v, [0.5, 0.9, 0.99], method="lower")
+        assert np.all(np.abs(q[k] / expected - 1) <= 0.01 + 1e-9)
+
+    with pytest.raises(ValueError):
+        a.merge(KeyedQuantileSketch(alpha=0.02))
+
+
+def test_survey_blocks():
+    assert survey_blocks([5, 1, 2, 3, 4], 2, 0) == [
+        ([1, 2], []), ([3, 4], []), ([5], [])]
+    assert survey_blocks([1, 2, 3, 5, 6], 2, 2) == [
+        ([1, 2], [3]), ([3, 5], [6]), ([6], [])]
+
+
+def synthetic_stack(zs, ntiles=4, npts=30, seed=0):
+    """tilespecs by z with slightly wrong affines, matches within sections
+    between neighboring tiles and between the same tile of adjacent
+    sections
+    """
+    rng = np.random.default_rng(seed)
+    tspecs = {z: [
+        renderapi.tilespec.TileSpec(
+            tileId="%d_%d" % (z, i), z=z, width=100, height=100,
+            layout=renderapi.tilespec.Layout(sectionId=str(float(z))),
+            tforms=[renderapi.transform.AffineModel(
+                M00=1 + rng.normal(0, 0.01), B0=90. * i + rng.normal(0, 2),
+                B1=rng.normal(0, 2))])
+        for i in range(ntiles)] for z in zs}
+
+    def match(p_ts, q_ts, dx):
+        p = np.stack([rng.uniform(dx, 100, npts), rng.uniform(0, 100, npts)])
+        q = p - np.array([[dx], [0.]])
+        return {"pId": p_ts.tileId, "qId": q_ts.tileId,
+                "pGroupId": p_ts.layout.sectionId,
+                "qGroupId": q_ts.layout.sectionId,
+                "matches": {"p": p.tolist(), "q": q.tolist(),
+                            "w": [1.] * npts}}
+
+    within = {str(float(z)): [match(a, b, 90.) for a, b in zip(
+        tspecs[z][:-1], tspecs[z][1:])] for z in zs}
+    cross = {(str(float(z)), str(float(z2))): [
+        match(a, b, 0.) for a, b in zip(tspecs[z], tspecs[z2])]
+        for z, z2 in zip(zs[:-1], zs[1:])}
+    return tspecs, within, cross
+
+
+def match_residuals(tspecs, m):
+    tforms = {ts.tileId: ts.tforms[-1] for t in tspecs.values() for ts in t}
+    return np.linalg.norm(
+        tforms[m["pId"]].tform(np.transpose(m["matches"]["p"])) -
+        tforms[m["qId"]].tform(np.transpose(m["matches"]["q"])), axis=1)
+
+
+def test_residual_survey(monkeypatch, tmpdir):
+    zs = [1, 2, 3, 4, 5]
+    tspecs, within, cross = synthetic_stack(zs)
+    monkeypatch.setattr(
+        renderapi.stack, "get_z_values_for_stack",
+        lambda stack, render=None, **kwargs: zs)
+    monkeypatch.setattr(
+        renderapi.tilespec, "get_tile_specs_from_z",
+        lambda stack, z, render=None, **kwargs: tspecs[z])
+    monkeypatch.setattr(
+        renderapi.pointmatch, "get_matches_within_group",
+        lambda collection, group, render=None, **kwargs: within[group])
+    monkeypatch.setattr(
+        renderapi.pointmatch, "get_matches_from_group_to_group",
+        lambda collection, p, q, render=None, **kwargs: cross[(p, q)])
+
+    output_json = str(tmpdir.join("output.json"))
+    mod = ResidualSurvey(input_data={
+        "render": {"host": "localhost", "port": 8080, "owner": "o",
+                   "project": "p", "client_scripts": str(tmpdir)},
+        "input_stack": "stack",
+        "match_collection": "collection",
+        "minZ": 1,
+        "maxZ": 5,
+        "zNeighborDistance": 1,
+        "sections_per_job": 2,
+        "tile_rows_per_file": 7,
+        "pool_size": 2,
+        "output_dir": str(tmpdir.join("survey")),
+        "output_json": output_json}, args=[])
+    mod.run()
+    with open(output_json) as f:
+        output = json.load(f)
+
+    def check(summary, res):
+        assert summary["count"] == res.size
+        assert summary["mean"] == pytest.approx(res.mean())
+        for q in [50, 90, 99]:
+            expected = np.quantile(res, q / 100., method="lower")
+            assert summary["p%d" % q] == pytest.approx(expected, rel=0.011)
+
+    sections = read_columns([output["sections_file"]])
+    tiles = read_columns(output["tile_files"])
+    assert len(output["tile_files"]) == 6
+
+    section_res = {}
+    tile_res = {}
+    for cross_section, groups in [(False, within), (True, cross)]:
+        for group, matches in groups.items():
+            z = float(group if not cross_section else group[0])
+            for m in matches:
+                res = match_residuals(tspecs, m)
+                section_res.setdefault((z, cross_section), []).append(res)
+                for tileId in [m["pId"], m["qId"]]:
+                    tile_res.setdefault(
+                        (tileId, cross_section), []).append(res)
+
+    assert len(sections["z"]) == len(section_res)
+    for i in range(len(sections["z"])):
+        check({k: v[i] for k, v in sections.items()}, np.concatenate(
+            section_res[(sections["z"][i], sections["cross_section"][i])]))
+    assert len(tiles["tileId"]) == len(tile_res)
+    for i in range(len(tiles["tileId"])):
+        assert tiles["z"][i] == int(tiles["tileId"][i].split("_")[0])
+        check({k: v[i] for k, v in tiles.items()}, np.concatenate(
+            tile_res[(tiles["tileId"][i], tiles["cross_section"][i])]))
+    for summary in output["stack_summary"]:
+        check(summary, np.concatenate([
+            np.concatenate(v) for (z, c), v in section_res.items()
+            if c == summary["cross_section"]]))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+test robust transform fitting on synthetic matches with outliers
+"""
+import numpy
+import pytest
+
+from asap.pointmatch.robust_fit import (
+    MODEL_FITS, TRANSFORM_MODELS, robust_fit, vectorized_ransac)
+from asap.pointmatch.schemas import PointMatchOpenCVParameters
+
+
+def schema_choices(field):
+    return PointMatchOpenCVParameters().fields[field].metadata[
+        "validator"].choices
+
+
+def make_matches(model, n=400, outlier_fraction=0.4, seed=1):
+    rng = numpy.random.RandomState(seed)
+    src = rng.rand(n, 2) * 1000
+    theta = 0.1
+    M = numpy.eye(3)
+    M[:2, 2] = [120., -35.]
+    if model != "TRANSLATION":
+        M[:2, :2] = [[numpy.cos(theta), -numpy.sin(theta)],
+                     [numpy.sin(theta), numpy.cos(theta)]]
+    if model in ("SIMILARITY", "AFFINE", "HOMOGRAPHY"):
+        M[:2, :2] *= 1.05
+    if model in ("AFFINE", "HOMOGRAPHY"):
+        M[0, 1] += 0.03
+    if model == "HOMOGRAPHY":
+        M[2, :2] = [1e-5, -2e-5]
+    h = numpy.hstack([src, numpy.ones((n, 1))]).dot(M.T)
+    dst = h[:, :2] / h[:, 2:] + rng.randn(n, 2) * 0.5
+    outliers = rng.rand(n) < outlier_fraction
+    dst[outliers] = rng.rand(outliers.sum(), 2) * 1000
+    return src, dst, ~outliers, M
+
+
+@pytest.mark.parametrize("model", TRANSFORM_MODELS)
+def test_minimal_fits_are_exact(model):
+    src, dst, _, M = make_matches(model, n=20, outlier_fraction=0.)
+    h = numpy.hstack([src, numpy.ones((20, 1))]).dot(M.T)
+    exact = h[:, :2] / h[:, 2:]
+    fit = MODEL_FITS[model](src[None], exact[None])[0]
+    numpy.testing.assert_allclose(fit, M, rtol=1e-6, atol=1e-6)
+
+
+@pytest.mark.parametrize("model", TRANSFORM_MODELS)
+def test_vectorized_ransac(model):
+    src, dst, inliers, M = make_matches(model)
+    fit, mask = vectorized_ransac(src, dst, model=model, threshold=3.0)
+    # all but a few noisy true inliers are found, no outliers kept
+    assert (mask & inliers).sum() > 0.95 * inliers.sum()
+    assert (mask & ~inliers).sum() <= 2
+    numpy.testing.assert_allclose(fit[:2, 2], M[:2, 2], atol=2.0)
+
+    # deterministic for a seed
+    fit2, mask2 = vectorized_ransac(src, dst, model=model, threshold=3.0)
+    numpy.testing.assert_array_equal(mask, mask2)
+
+
+@pytest.mark.parametrize("model", schema_choices("RANSAC_model"))
+@pytest.mark.parametrize("method", schema_choices("RANSAC_method"))
+def test_robust_fit_methods(model, method):
+    src, dst, inliers, M = make_matches(model)
+    fit, mask = robust_fit(src, dst, model=model, method=method,
+                           threshold=3.0)
+    assert fit.shape == (3, 3)
+    assert (mask & inliers).sum() > 0.9 * inliers.sum()
+    assert (mask & ~inliers).sum() <= 2
+
+
+def test_too_few_matches():
+    fit, mask = vectorized_ransac(
+        numpy.zeros((2, 2)), numpy.zeros((2, 2)), model="AFFINE")
+    assert fit is None and not mask.any()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+test coarse-to-fine section matching on a synthetic section pair
+"""
+import pathlib
+
+import cv2
+import numpy
+import pytest
+import renderapi
+
+from asap.pointmatch import generate_section_point_matches
+from asap.pointmatch.feature_cache import FeatureCache
+from asap.pointmatch.generate_section_point_matches import (
+    coarse_to_fine_matches, match_section_batch, pyramid_scales,
+    section_pairs, section_pyramid_features)
+from asap.pointmatch.schemas import (
+    PointMatchOpenCVParameters, SectionPointMatchParameters)
+from test_pointmatch_opencv import make_match_args
+
+SECTION_SHAPE = (800, 800)
+BORDER = 100
+
+
+def make_section(shape, seed=0):
+    # structure at several scales so coarse levels have features
+    rng = numpy.random.RandomState(seed)
+    im = numpy.zeros(shape, dtype='float32')
+    for sigma in (2., 8., 32.):
+        n = cv2.GaussianBlur(
+            rng.rand(*shape).astype('float32'), (0, 0), sigma)
+        im += (n - n.mean()) / n.std()
+    im = (im - im.min()) / (im.max() - im.min()) * 255
+    return im.astype('uint8')
+
+
+@pytest.fixture(scope='module')
+def section_pair(tmpdir_factory):
+    rows, cols = SECTION_SHAPE
+    big = make_section((rows + 2 * BORDER, cols + 2 * BORDER))
+    center = (cols / 2. + BORDER, rows / 2. + BORDER)
+    A = cv2.getRotationMatrix2D(center, 4.0, 1.02)
+    A[:, 2] += [15., -25.]
+    warped = cv2.warpAffine(big, A, big.shape[::-1])
+
+    d = tmpdir_factory.mktemp('sections')
+    uris = []
+    for fn, im in (('p.png', big), ('q.png', warped)):
+        fp = str(d.join(fn))
+        cv2.imwrite(fp, im[BORDER:BORDER + rows, BORDER:BORDER + cols])
+        uris.append([pathlib.Path(fp).as_uri(), None])
+
+    # the transform in the coordinates of the cropped sections
+    T = numpy.array([[1., 0., BORDER], [0., 1., BORDER], [0., 0., 1.]])
+    expected = numpy.linalg.inv(T).dot(numpy.vstack([A, [0, 0, 1]])).dot(T)
+    return uris, expected
+
+
+def check_matches(p, q, expected, atol=1.0):
+    pred = p.dot(expected[:2, :2].T) + expected[:2, 2]
+    assert numpy.median(numpy.linalg.norm(pred - q, axis=1)) < atol
+
+
+def test_pyramid_scales():
+    assert pyramid_scales([0.5, 0.125, 0.5], 1.0) == [0.125, 0.5, 1.0]
+    assert pyramid_scales([0.25, 0.5], 0.5) == [0.25, 0.5]
+
+
+def test_coarse_to_fine_matches(section_pair):
+    uris, expected = section_pair
+    args = make_match_args()
+    scales = [0.125, 0.25, 0.5]
+    p_features, q_features = [
+        section_pyramid_features(
+            uri, scales, sift_kwargs={"nfeatures": 20000})
+        for uri in uris]
+    assert [f.shape for f in p_features] == [
+        (100, 100), (200, 200), (400, 400)]
+
+    loc_p, loc_q, pq_tform = coarse_to_fine_matches(
+        p_features, q_features, scales,
+        match_kwargs=dict(ndiv=2, ratio_of_dist=0.7),
+        ransac_kwargs={"RANSAC_outlier": args["RANSAC_outlier"]},
+        refine_search_radius=16.)
+    assert loc_p.shape[0] > 100
+    check_matches(loc_p / 0.5, loc_q / 0.5, expected)
+    numpy.testing.assert_allclose(pq_tform, expected, atol=0.5)
+
+
+def test_match_section_batch_reuses_features(section_pair, monkeypatch):
+    uris, expected = section_pair
+    args = make_match_args(
+        downsample_scale=0.5, coarse_scales=[0.25], coarse_model="RIGID",
+        refine_search_radius=16.)
+    fargs = [uris, ['p', 'q'], ['1.0', '2.0'], args]
+
+    calls = []
+    extract = generate_section_point_matches.section_pyramid_features
+
+    def counting_extract(*a, **kw):
+        calls.append(a[0])
+        return extract(*a, **kw)
+    monkeypatch.setattr(generate_section_point_matches,
+                        'section_pyramid_features', counting_extract)
+
+    results = match_section_batch([[fargs, fargs[:]], 4])
+    assert len(calls) == 2
+    for r in results:
+        assert r[3] > 100
+        assert len(r[5]['matches']['w']) == min(r[3], args['matchMax'])
+        assert (r[5]['pGroupId'], r[5]['qGroupId']) == ('1.0', '2.0')
+        check_matches(numpy.array(r[5]['matches']['p']).T,
+                      numpy.array(r[5]['matches']['q']).T, expected)
+
+
+def test_section_features_cache(section_pair, tmpdir, monkeypatch):
+    uris, _ = section_pair
+    cache = FeatureCache(str(tmpdir.join('features')))
+    scales = [0.125, 0.25]
+    kwargs = dict(sift_kwargs={"nfeatures": 2000}, tileId='p',
+                  feature_cache=cache)
+    computed = section_pyramid_features(uris[0], scales, **kwargs)
+    assert len(tmpdir.join('features').listdir()) == 2
+
+    def fail(*a, **kw):
+        raise AssertionError("section image read despite cache")
+    monkeypatch.setattr(generate_section_point_matches,
+                        'read_downsample_equalize_mask_uri', fail)
+    cached = section_pyramid_features(uris[0], scales, **kwargs)
+    for c, f in zip(cached, computed):
+        numpy.testing.assert_allclose(c.loc, f.loc, rtol=1e-6)
+        numpy.testing.assert_array_equal(c.des, f.des)
+        assert c.shape == f.shape
+
+
+def test_section_schema_options():
+    tile_only = ["restrict_to_overlap", "guided_matching",
+                 "use_mipmap_levels", "pipeline", "tile_affinity",
+                 "escalation_tiers"]
+    section_fields = SectionPointMatchParameters().fields
+    tile_fields = PointMatchOpenCVParameters().fields
+    for field in tile_only:
+        assert field in tile_fields
+        assert field not in section_fields
+    for field in ["feature_cache_dir", "tile_cache_size", "match_sink"]:
+        assert field in section_fields
+
+
+def test_section_pairs():
+    tilespecs = [
+        renderapi.tilespec.TileSpec(
+            tileId="t{}".format(z), z=z, sectionId=str(float(z)))
+        for z in (3, 0, 1, 2, 5)]
+    pairs = section_pairs(tilespecs, zNeighborDistance=2)
+    assert [(m['p']['id'], m['q']['id']) for m in pairs] == [
+        ('t0', 't1'), ('t0', 't2'), ('t1', 't2'), ('t1', 't3'),
+        ('t2', 't3'), ('t3', 't5')]
+    assert pairs[0]['p']['groupId'] == '0.0'
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+test the synthetic ground truth point match benchmark
+"""
+import json
+
+import cv2
+import numpy
+import pytest
+
+from asap.pointmatch.synthetic_benchmark import (
+    SyntheticPointMatchBenchmark, matcher_defaults, parameter_cases,
+    synthetic_tile_pairs)
+
+
+@pytest.mark.parametrize("distortion", ["affine", "tps"])
+def test_synthetic_pair_ground_truth(distortion):
+    pair, = synthetic_tile_pairs(1, (200, 300), distortion=distortion,
+                                 noise_sigma=0., gain_range=0.,
+                                 bias_range=0.)
+    assert pair.pim.shape == pair.qim.shape == (200, 300)
+
+    # q pixels mapped through the ground truth land on the same texture
+    q = numpy.array([[5., 20.], [10., 150.], [15., 90.]])
+    p = pair.warp(q) + pair.q_origin - pair.p_origin
+    numpy.testing.assert_allclose(pair.residuals(p, q), 0., atol=1e-9)
+    assert pair.residuals(p + [3., 4.], q) == pytest.approx([5.] * 3)
+
+    # and so do the images
+    p_values = cv2.remap(
+        pair.pim, p[:, 0].astype('float32')[None],
+        p[:, 1].astype('float32')[None], cv2.INTER_LINEAR)[0]
+    q_values = pair.qim[q[:, 1].astype(int), q[:, 0].astype(int)]
+    numpy.testing.assert_allclose(
+        p_values.astype(float), q_values.astype(float), atol=8)
+
+
+def test_parameter_cases():
+    cases = parameter_cases({"ndiv": [1, 2], "SIFT_nfeature": [10, 20]})
+    assert len(cases) == 4
+    assert {"ndiv": 2, "SIFT_nfeature": 10} in cases
+    assert parameter_cases({}) == [{}]
+    assert matcher_defaults()["ratio_of_dist"] == 0.7
+
+
+def test_synthetic_benchmark_module(tmpdir):
+    # memory of the calling process is not counted in the cases
+    ballast = numpy.ones(2 ** 29 // 8)
+    output_json = str(tmpdir.join("output.json"))
+    mod = SyntheticPointMatchBenchmark(input_data={
+        "npairs": 2,
+        "tile_shape": [300, 400],
+        "overlap": 0.3,
+        "parameter_grid": {"downsample_scale": [1.0], "ndiv": [1, 2]},
+        "output_json": output_json}, args=[])
+    mod.run()
+
+    with open(output_json) as f:
+        cases = json.load(f)["cases"]
+    assert len(cases) == 4
+    assert {c["distortion"] for c in cases} == {"affine", "tps"}
+    for c in cases:
+        assert c["pairs"] == 2
+        assert c["pairs_per_second"] > 0
+        assert c["features_per_second"] > 0
+        assert 0 < c["peak_rss_mb"] < ballast.nbytes / 2. ** 20
+        assert c["matches_per_pair"] > 10
+        assert c["correct_fraction"] > 0.9
+        assert c["median_residual"] < 1.0
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+test per-worker thread budgets and their calibration
+"""
+import json
+import multiprocessing
+import os
+
+import cv2
+import renderapi
+
+from asap.pointmatch.calibrate_threads import (
+    CalibrateThreads, calibration_splits)
+from asap.utilities.threads import threads_for_workers, worker_pool_kwargs
+
+
+def worker_threads(i):
+    return cv2.getNumThreads(), os.environ.get("OMP_NUM_THREADS")
+
+
+def test_threads_for_workers():
+    cpus = multiprocessing.cpu_count()
+    assert threads_for_workers(-1) == 1
+    assert threads_for_workers(1) == cpus
+    assert threads_for_workers(2 * cpus) == 1
+    assert threads_for_workers(4, 3) == 3
+
+
+def test_worker_pool_kwargs():
+    with renderapi.client.WithPool(2, **worker_pool_kwargs(2, 3)) as pool:
+        assert set(pool.map(worker_threads, range(4))) == {(3, "3")}
+
+    # a budget of 0 leaves the workers alone
+    with renderapi.client.WithPool(2, **worker_pool_kwargs(2, 0)) as pool:
+        assert set(pool.map(worker_threads, range(4))) == {
+            worker_threads(0)}
+
+
+def test_calibration_splits():
+    assert calibration_splits(8) == [(1, 8), (2, 4), (4, 2), (8, 1)]
+    assert calibration_splits(6) == [(1, 6), (2, 3), (4, 1), (6, 1)]
+    assert calibration_splits(4, [3, 5]) == [(3, 1)]
+
+
+def test_calibrate_threads(tmpdir):
+    output_json = str(tmpdir.join("output.json"))
+    mod = CalibrateThreads(input_data={
+        "cpus": 2,
+        "pairs_per_cpu": 1,
+        "distinct_pairs": 1,
+        "tile_shape": [200, 300],
+        "matching_parameters": {"downsample_scale": 1.0, "ndiv": 1},
+        "output_json": output_json}, args=[])
+    mod.run()
+
+    with open(output_json) as f:
+        output = json.load(f)
+    assert [(t["workers"], t["threads_per_worker"])
+            for t in output["trials"]] == [(1, 2), (2, 1)]
+    best = max(output["trials"], key=lambda t: t["pairs_per_second"])
+    assert output["recommended_workers"] == best["workers"]
+    assert output["recommended_threads_per_worker"] == 2 // best["workers"]
@@ -1,5 +1,8 @@
 import os
 
+import marshmallow
+import pytest
+
 pool_size = os.environ.get('ASAP_POOL_SIZE', 5)
 
 MATERIALIZED_IMAGE_WIDTH = os.environ.get(
@@ -39,3 +42,10 @@ TEST_MATERIALIZATION_JSON = {
     "maxZ": MATERIALIZED_MAXZ,
     "ext": MATERIALIZED_EXT
 }
+
+# whether to run wall-clock timing tests, which depend on the machine
+test_timing = marshmallow.fields.Boolean().deserialize(os.environ.get(
+    "ASAP_TEST_TIMING", False))
+timing_test = pytest.mark.skipif(not test_timing, reason=(
+    "timing not tested -- to test, set environment variable "
+    "ASAP_TEST_TIMING"))